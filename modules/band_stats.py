@@ -0,0 +1,188 @@
+"""
+反射率のバンドごとの統計量 (件数, 平均, M2, 最小, 最大, ヒストグラム) を逐次計算するためのモジュール
+
+ortho_scene で .npy を保存する際に, 配列がメモリにあるうちに BandStats.from_cube で統計量を計算して stats/<id>.npz に保存し,
+build_band_stats で全サンプル (全ワーカー・全シャード) の統計量を Chan らの方法でまとめて band_stats.npz に保存する.
+正規化のために全ての .npy を読み直す必要はない.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+BAND_STATS_NAME = "band_stats"
+
+# ヒストグラムの範囲とビン数. 範囲外の値は両端のビンに入れる
+HIST_RANGE = (0.0, 1.5)
+HIST_BINS = 150
+
+
+class BandStats:
+    """
+    バンドごとの統計量. merge で別の BandStats (別のサンプル・ワーカー・シャード) をまとめられる.
+    平均と分散は数値的に安定な Welford/Chan の方法で更新する.
+    """
+
+    def __init__(self, bands, bins=HIST_BINS, value_range=HIST_RANGE):
+        self.count = np.zeros(bands, dtype=np.int64)
+        self.mean = np.zeros(bands, dtype=np.float64)
+        self.m2 = np.zeros(bands, dtype=np.float64)
+        self.min = np.full(bands, np.inf)
+        self.max = np.full(bands, -np.inf)
+        self.value_range = tuple(float(v) for v in value_range)
+        self.hist = np.zeros((bands, bins), dtype=np.int64)
+
+    @property
+    def bands(self):
+        return self.count.shape[0]
+
+    @property
+    def variance(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 0, self.m2 / self.count, np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @classmethod
+    def from_cube(cls, cube, spec=None, **kwargs):
+        """
+        (height, width, bands) の配列の統計量を作成する.
+        spec (precision_spec) を指定した場合は nodata の画素を除き, scale, offset で反射率に戻してから計算する.
+        """
+        stats = cls(cube.shape[-1], **kwargs)
+        stats.update(cube, spec)
+        return stats
+
+    def update(self, cube, spec=None):
+        """
+        (height, width, bands) の配列の値を統計量に加える.
+        """
+        values = cube.reshape(-1, cube.shape[-1])
+        if spec is not None:
+            values = values.astype(np.float64)
+            valid = (values != spec["nodata"]) & np.isfinite(values)
+            values = values * spec["scale"] + spec["offset"]
+        else:
+            values = values.astype(np.float64)
+            valid = np.isfinite(values)
+
+        # 配列全体の統計量を計算し, これまでの統計量とまとめる
+        other = BandStats(self.bands, self.hist.shape[1], self.value_range)
+        other.count = valid.sum(axis=0)
+        total = np.where(valid, values, 0.0).sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            other.mean = np.where(other.count > 0, total / other.count, 0.0)
+        other.m2 = np.where(valid, (values - other.mean) ** 2, 0.0).sum(axis=0)
+        other.min = np.where(valid, values, np.inf).min(axis=0, initial=np.inf)
+        other.max = np.where(valid, values, -np.inf).max(axis=0, initial=-np.inf)
+        other.hist = self._histogram(values, valid)
+        self.merge(other)
+        return self
+
+    def _histogram(self, values, valid):
+        bins = self.hist.shape[1]
+        low, high = self.value_range
+        index = np.floor((values - low) / (high - low) * bins)
+        index = np.clip(np.nan_to_num(index), 0, bins - 1).astype(np.int64)
+        # バンドごとのビンを1つの bincount にまとめて数える
+        index += np.arange(self.bands) * bins
+        counts = np.bincount(index[valid], minlength=self.bands * bins)
+        return counts.reshape(self.bands, bins)
+
+    def merge(self, other):
+        """
+        other の統計量をまとめる (Chan らの並列アルゴリズム).
+        """
+        if other.bands != self.bands or other.hist.shape != self.hist.shape:
+            raise ValueError(
+                f"バンド数 {self.bands}, {other.bands} またはヒストグラムのビンが一致しません."
+            )
+        if other.value_range != self.value_range:
+            raise ValueError("ヒストグラムの範囲が一致しません.")
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ratio = np.where(count > 0, other.count / count, 0.0)
+        self.mean = self.mean + delta * ratio
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * ratio
+        self.count = count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.hist = self.hist + other.hist
+        return self
+
+    def save(self, path):
+        np.savez(
+            path,
+            count=self.count,
+            mean=self.mean,
+            m2=self.m2,
+            min=self.min,
+            max=self.max,
+            hist=self.hist,
+            value_range=np.array(self.value_range),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            stats = cls(
+                data["count"].shape[0], data["hist"].shape[1], data["value_range"]
+            )
+            for key in ("count", "mean", "m2", "min", "max", "hist"):
+                setattr(stats, key, data[key])
+        return stats
+
+    def summary(self):
+        """
+        正規化に使う統計量 (json に保存できる辞書) を返す.
+        """
+        # 有効な画素がないバンドの値 (nan, inf) は null にする
+        return {
+            "count": self.count.tolist(),
+            **{
+                key: [float(v) if np.isfinite(v) else None for v in values]
+                for key, values in (
+                    ("mean", np.where(self.count > 0, self.mean, np.nan)),
+                    ("std", self.std),
+                    ("min", self.min),
+                    ("max", self.max),
+                )
+            },
+        }
+
+
+def merge_band_stats(paths):
+    """
+    BandStats を保存した .npz をまとめた BandStats を返す.
+    """
+    merged = None
+    for path in paths:
+        stats = BandStats.load(path)
+        merged = stats if merged is None else merged.merge(stats)
+    if merged is None:
+        raise FileNotFoundError("バンドの統計量のファイルが見つかりませんでした.")
+    return merged
+
+
+def build_band_stats(dataset_dir, stats_dir=None, meta_dir=None):
+    """
+    dataset_dir の stats/*.npz をまとめ, band_stats.npz と band_stats.json (平均, 標準偏差など) に保存する.
+    band_stats.json には meta/<id>.json の波長も記録する.
+    """
+    dataset_dir = Path(dataset_dir)
+    stats_dir = Path(stats_dir or dataset_dir / "stats")
+    meta_dir = Path(meta_dir or dataset_dir / "meta")
+    merged = merge_band_stats(sorted(stats_dir.glob("*.npz")))
+    merged.save(dataset_dir / f"{BAND_STATS_NAME}.npz")
+    summary = merged.summary()
+    for meta_path in sorted(meta_dir.glob("*.json"))[:1]:
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        summary["wavelengths"] = meta.get("wavelengths")
+    (dataset_dir / f"{BAND_STATS_NAME}.json").write_text(
+        json.dumps(summary, indent=2), encoding="utf-8"
+    )
+    return merged
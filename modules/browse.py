@@ -0,0 +1,138 @@
+"""
+EMIT のブラウズ画像 (PNG) をオルソ補正して, Cloud Optimized GeoTIFF またはタイル分割した PNG に書き出すモジュール
+
+ブラウズ画像は L2A と同じ生データの解像度 (downtrack, crosstrack) なので, L2A の GLT で uint8 のままオルソ補正する.
+GLT の復号結果はワーカーの GranuleCache に保持し, 同じグラニュールのブラウズ画像 (L2A, L2B など) で使い回す.
+多数の画像は executors のエグゼキュータでグラニュールごとにまとめて並列に書き出す.
+
+    jobs = [(l2a_fp, browse_url(l2a_url), "browse/<granule_id>.tif"), ...]
+    render_browses(jobs, get_executor("affinity"))
+"""
+
+import re
+from pathlib import Path
+
+import numpy as np
+from lazy_import import lazy_module
+
+from emit_tools import emit_xarray, ds_glt_index, ortho_browse
+from granule_cache import current_cache, granule_key, local_opener
+
+rasterio = lazy_module("rasterio")
+
+BROWSE_FORMATS = ["cog", "png"]
+
+# ブラウズ画像は公開バケットに, グラニュールのファイル名の拡張子を .png にした名前で置かれている
+# https://data.lpdaac.earthdatacloud.nasa.gov/lp-prod-protected/EMITL2ARFL.001/<id>/<id>.nc
+# -> https://data.lpdaac.earthdatacloud.nasa.gov/lp-prod-public/EMITL2ARFL.001/<id>/<id>.png
+PROTECTED_BUCKET_PATTERN = r"/lp-prod-protected/"
+
+
+def browse_url(granule_url):
+    """
+    グラニュールの URL からブラウズ画像 (PNG) の URL を返す.
+    """
+    url = re.sub(PROTECTED_BUCKET_PATTERN, "/lp-prod-public/", str(granule_url))
+    return re.sub(r"\.(nc|tif)$", ".png", url)
+
+
+def browse_grid(l2a_fp, l2a_ds):
+    """
+    L2A (emit_xarray(ortho=False) の結果) から, ortho_browse に渡す GLT の復号結果と座標系を返す.
+    ワーカーの GranuleCache がある場合は, 同じグラニュールの GLT の復号結果を使い回す.
+
+    Returns:
+    index, spatial_ref, geotransform
+    """
+    cache = current_cache()
+    if cache is not None:
+        index = cache.glt_index(l2a_fp, l2a_ds)
+    else:
+        index = ds_glt_index(l2a_ds)
+    return index, l2a_ds.attrs["spatial_ref"], l2a_ds.attrs["geotransform"]
+
+
+def _profile(da, driver):
+    return {
+        "driver": driver,
+        "width": da.sizes["x"],
+        "height": da.sizes["y"],
+        "count": da.sizes["band"],
+        "dtype": da.dtype.name,
+        "crs": da.rio.crs,
+        "transform": da.rio.transform(),
+    }
+
+
+def write_cog(da, out_path, blocksize=512):
+    """
+    ortho_browse の結果を Cloud Optimized GeoTIFF (deflate 圧縮, オーバービュー付き) に書き出す.
+    """
+    profile = _profile(da, "COG")
+    profile.update(
+        compress="deflate", blocksize=blocksize, overview_resampling="average"
+    )
+    with rasterio.open(out_path, "w", **profile) as dst:
+        dst.write(da.data)
+    return [Path(out_path)]
+
+
+def write_png_tiles(da, out_path, tile_size=512):
+    """
+    ortho_browse の結果を tile_size x tile_size の PNG に分割して out_path (拡張子を除いたディレクトリ) に書き出す.
+    タイルの名前は <row>_<col>.png で, 位置はワールドファイル (.wld) に書き込む.
+    """
+    out_dir = Path(out_path).with_suffix("")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    transform = da.rio.transform()
+    paths = []
+    for row in range(0, da.sizes["y"], tile_size):
+        for col in range(0, da.sizes["x"], tile_size):
+            tile = da.isel(y=slice(row, row + tile_size), x=slice(col, col + tile_size))
+            profile = _profile(tile, "PNG")
+            profile["transform"] = transform * rasterio.Affine.translation(col, row)
+            path = out_dir / f"{row // tile_size}_{col // tile_size}.png"
+            with rasterio.open(path, "w", worldfile="YES", **profile) as dst:
+                dst.write(np.ascontiguousarray(tile.data))
+            paths.append(path)
+    return paths
+
+
+WRITERS = {"cog": write_cog, "png": write_png_tiles}
+
+
+def render_browse(l2a_fp, browse, out_path, fmt="cog", white_background=True):
+    """
+    browse (ブラウズ画像のパス・URL, または復号済みの配列) を l2a_fp の GLT でオルソ補正して out_path に書き出す.
+
+    Returns:
+    paths: 書き出したファイルのリスト
+    """
+    if isinstance(l2a_fp, Path):
+        l2a_fp = str(l2a_fp)
+    cache = current_cache()
+    opener = cache.open_group if cache is not None else local_opener(l2a_fp)
+    l2a_ds = emit_xarray(l2a_fp, ortho=False, opener=opener)
+    index, spatial_ref, geotransform = browse_grid(l2a_fp, l2a_ds)
+    da = ortho_browse(
+        browse, None, spatial_ref, geotransform, white_background, index=index
+    )
+    Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+    return WRITERS[fmt](da, out_path)
+
+
+def render_browses(jobs, executor, fmt="cog", white_background=True):
+    """
+    jobs ((l2a_fp, browse, out_path) のリスト) を executor で並列に書き出す.
+    affinity のエグゼキュータでは同じグラニュールのジョブを同じワーカーで続けて処理し, GLT を使い回す.
+
+    Returns:
+    paths: 書き出したファイルのリスト
+    """
+    options = {"fmt": fmt, "white_background": white_background}
+    tasks = [((l2a_fp, browse, out_path), options) for l2a_fp, browse, out_path in jobs]
+    keys = [granule_key(l2a_fp) for l2a_fp, _, _ in jobs]
+    paths = []
+    for written in executor.run(render_browse, tasks, keys=keys):
+        paths.extend(written)
+    return paths
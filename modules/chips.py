@@ -0,0 +1,159 @@
+"""
+位置合わせ済みの L2A, L2B の .npy から固定サイズの学習用チップを切り出すためのモジュール
+
+チップはシャード単位で連続した .npy (N, size, size, bands) に書き出し,
+チップごとのメタデータは <prefix>-index.csv にまとめる.
+"""
+
+import csv
+from pathlib import Path
+
+import numpy as np
+
+INDEX_COLUMNS = [
+    "chip_id",
+    "shard",
+    "offset",
+    "geojson_id",
+    "row",
+    "col",
+    "plume_pixels",
+    "label",
+]
+
+
+def chip_offsets(shape, size, stride):
+    """
+    (height, width) の画像を size x size のチップで stride ごとに覆う左上座標 (row, col) を返す.
+    端が余る場合は最後のチップを画像の端に揃える.
+    """
+
+    def starts(length):
+        if length <= size:
+            return np.array([0])
+        offsets = np.arange(0, length - size + 1, stride)
+        if offsets[-1] != length - size:
+            offsets = np.append(offsets, length - size)
+        return offsets
+
+    rows, cols = np.meshgrid(starts(shape[0]), starts(shape[1]), indexing="ij")
+    return np.stack([rows.ravel(), cols.ravel()], axis=-1)
+
+
+def plume_pixel_counts(mask, offsets, size):
+    """
+    積分画像を使って, 各チップ内のプルーム画素数をまとめて計算する.
+    """
+    integral = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    integral[1:, 1:] = np.cumsum(np.cumsum(mask, axis=0), axis=1)
+    r0, c0 = offsets[:, 0], offsets[:, 1]
+    r1 = np.minimum(r0 + size, mask.shape[0])
+    c1 = np.minimum(c0 + size, mask.shape[1])
+    return integral[r1, c1] - integral[r0, c1] - integral[r1, c0] + integral[r0, c0]
+
+
+def select_chips(counts, pos_ratio=0.5, min_plume_pixels=1, rng=None):
+    """
+    プルームを含むチップ (正例) と含まないチップ (負例) の比率が pos_ratio になるように選ぶ.
+    pos_ratio が None の場合は全てのチップを返す.
+
+    Returns:
+    selected: 選ばれたチップのインデックス (昇順)
+    """
+    if pos_ratio is None:
+        return np.arange(len(counts))
+    rng = rng or np.random.default_rng()
+    positives = np.flatnonzero(counts >= min_plume_pixels)
+    negatives = np.flatnonzero(counts < min_plume_pixels)
+    if pos_ratio <= 0:
+        n_negatives = len(negatives)
+    else:
+        n_negatives = int(round(len(positives) * (1 - pos_ratio) / pos_ratio))
+    n_negatives = min(n_negatives, len(negatives))
+    negatives = rng.choice(negatives, size=n_negatives, replace=False)
+    return np.sort(np.concatenate([positives, negatives]))
+
+
+def pad_to(array, size):
+    """
+    先頭2次元が size に満たない配列を0で埋めて size x size 以上にする.
+    """
+    pad_rows = max(size - array.shape[0], 0)
+    pad_cols = max(size - array.shape[1], 0)
+    if pad_rows == 0 and pad_cols == 0:
+        return array
+    pad_width = [(0, pad_rows), (0, pad_cols)] + [(0, 0)] * (array.ndim - 2)
+    return np.pad(array, pad_width)
+
+
+class ChipWriter:
+    """
+    チップをシャードごとに連続した .npy に書き出し, <prefix>-index.csv を作成するクラス.
+
+    shard-XXXXX.l2a.npy: (N, size, size, bands)
+    shard-XXXXX.l2b.npy: (N, size, size)
+    """
+
+    def __init__(self, outdir, size, shard_size=1024, prefix="shard"):
+        self.outdir = Path(outdir)
+        self.outdir.mkdir(parents=True, exist_ok=True)
+        self.size = size
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.shard = 0
+        self.chip_id = 0
+        self.l2a_chips, self.l2b_chips = [], []
+        self.index = []
+
+    def add(self, geojson_id, l2a, l2b, offsets, counts, min_plume_pixels=1):
+        """
+        1サンプルから切り出すチップの左上座標 offsets とプルーム画素数 counts を受け取り追加する.
+        """
+        l2a, l2b = pad_to(l2a, self.size), pad_to(l2b, self.size)
+        for (row, col), count in zip(offsets, counts):
+            self.l2a_chips.append(l2a[row : row + self.size, col : col + self.size])
+            self.l2b_chips.append(l2b[row : row + self.size, col : col + self.size])
+            self.index.append(
+                {
+                    "chip_id": self.chip_id,
+                    "shard": self.shard_name(self.shard),
+                    "offset": len(self.l2a_chips) - 1,
+                    "geojson_id": geojson_id,
+                    "row": int(row),
+                    "col": int(col),
+                    "plume_pixels": int(count),
+                    "label": int(count >= min_plume_pixels),
+                }
+            )
+            self.chip_id += 1
+            if len(self.l2a_chips) >= self.shard_size:
+                self.flush()
+
+    def shard_name(self, shard):
+        return f"{self.prefix}-{shard:05d}"
+
+    def flush(self):
+        """
+        バッファ中のチップを1つのシャードとして書き出す.
+        """
+        if not self.l2a_chips:
+            return
+        name = self.shard_name(self.shard)
+        np.save(self.outdir / f"{name}.l2a.npy", np.stack(self.l2a_chips))
+        np.save(self.outdir / f"{name}.l2b.npy", np.stack(self.l2b_chips))
+        print(f"{name} に {len(self.l2a_chips)} 件のチップを書き出しました.")
+        self.l2a_chips, self.l2b_chips = [], []
+        self.shard += 1
+
+    def close(self):
+        """
+        残りのチップを書き出し, <prefix>-index.csv を保存する.
+        """
+        self.flush()
+        index_path = self.outdir / f"{self.prefix}-index.csv"
+        with index_path.open("w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=INDEX_COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.index)
+        print(f"{self.chip_id} 件のチップの index を {index_path} に書き出しました.")
+        return index_path
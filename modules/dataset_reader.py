@@ -0,0 +1,282 @@
+"""
+ortho_scene で作成した L2A, L2B の .npy を学習用に読み込むためのモジュール (PyTorch などには依存しない)
+
+.npy は mmap_mode="r" で開き, パッチ・バンドを指定した読み込みでは必要な部分だけを読む.
+L2B が SparseL2B (.npz) の場合はプルームの画素だけを読み込み, パッチの範囲だけを密な配列にする.
+centered=True ではプルームの画素を中心にパッチを選ぶ (SparseL2B では L2B 全体を走査せずに済む).
+BatchLoader はスレッドプールで先読みしながら, 複数のサンプルを連続した配列のバッチにまとめて返す.
+
+    dataset = EmitDataset("data/dataset")
+    loader = BatchLoader(dataset, batch_size=32, size=64, shuffle=True)
+    for l2a, l2b, ids in loader:
+        ...
+    print(loader.samples_per_second)
+"""
+
+import concurrent.futures
+import json
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+
+from granule_cache import LRUCache
+from labels import SparseL2B, binarize, open_l2b
+from manifest import MANIFEST_NAME
+from precision import decode
+
+
+class EmitDataset:
+    """
+    L2A, L2B の .npy のペアのデータセット.
+
+    manifest.parquet がある場合はそのパスと精度の情報を使い,
+    ない場合は l2b_dir の .npy (または SparseL2B の .npz) と同じ名前の l2a_dir の .npy をペアにする.
+    開いた memmap は最大 cache_size 件まで保持する.
+    """
+
+    def __init__(
+        self,
+        dataset_dir,
+        l2a_dir="EMITL2ARFL",
+        l2b_dir="EMITL2BCH4PLM",
+        ids=None,
+        decode=False,
+        cache_size=256,
+    ):
+        self.dataset_dir = Path(dataset_dir)
+        self.decode = decode
+        self.samples = self._find_samples(l2a_dir, l2b_dir)
+        if ids is not None:
+            ids = [str(geojson_id) for geojson_id in ids]
+            self.samples = {geojson_id: self.samples[geojson_id] for geojson_id in ids}
+        self.ids = list(self.samples)
+        self.arrays = LRUCache(cache_size)
+        self.lock = threading.Lock()
+
+    def _find_samples(self, l2a_dir, l2b_dir):
+        manifest_path = self.dataset_dir / MANIFEST_NAME
+        if manifest_path.exists():
+            from manifest import read_manifest
+
+            manifest = read_manifest(manifest_path)
+            return {
+                row.geojson_id: {
+                    "l2a": self.dataset_dir / row.l2a_path,
+                    "l2b": self.dataset_dir / row.l2b_path,
+                    "precision": {
+                        "scale": row.precision_scale,
+                        "offset": row.precision_offset,
+                        "nodata": row.precision_nodata,
+                    },
+                }
+                for row in manifest.itertuples(index=False)
+            }
+        samples = {}
+        l2b_paths = (self.dataset_dir / l2b_dir).glob("*.np[yz]")
+        for l2b_path in sorted(l2b_paths):
+            l2a_path = self.dataset_dir / l2a_dir / f"{l2b_path.stem}.npy"
+            if l2a_path.exists():
+                samples[l2b_path.stem] = {
+                    "l2a": l2a_path,
+                    "l2b": l2b_path,
+                    "precision": self._meta_precision(l2b_path.stem),
+                }
+        return samples
+
+    def _meta_precision(self, geojson_id):
+        meta_path = self.dataset_dir / "meta" / f"{geojson_id}.json"
+        if not meta_path.exists():
+            return None
+        return json.loads(meta_path.read_text(encoding="utf-8")).get("precision")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def open(self, index):
+        """
+        index 番目のサンプルの (l2a, l2b) の memmap (L2B が .npz の場合は SparseL2B) を返す.
+        """
+        geojson_id = self.ids[index]
+        sample = self.samples[geojson_id]
+        # BatchLoader のスレッドから同時に呼ばれるため, キャッシュの更新はロックする
+        with self.lock:
+            return self.arrays.get(
+                geojson_id,
+                lambda: (
+                    np.load(sample["l2a"], mmap_mode="r"),
+                    open_l2b(sample["l2b"]),
+                ),
+            )
+
+    def shape(self, index):
+        return self.open(index)[0].shape
+
+    def read(self, index, window=None, bands=None):
+        """
+        index 番目のサンプルの window (row, col, height, width) の範囲, bands のバンドだけを読み込む.
+        window, bands が None の場合は全体を読み込む.
+        """
+        l2a, l2b = self.open(index)
+        rows, cols = slice(None), slice(None)
+        if window is not None:
+            row, col, height, width = window
+            rows, cols = slice(row, row + height), slice(col, col + width)
+        l2a = l2a[rows, cols] if bands is None else l2a[rows, cols][..., bands]
+        return self._decode(index, np.array(l2a)), np.array(l2b[rows, cols])
+
+    def _decode(self, index, l2a):
+        spec = self.samples[self.ids[index]]["precision"]
+        if not self.decode or spec is None:
+            return l2a
+        return decode(l2a, spec)
+
+    def plume_pixels(self, index):
+        """
+        index 番目のサンプルのプルームの画素の (rows, cols) を返す.
+        """
+        l2b = self.open(index)[1]
+        if isinstance(l2b, SparseL2B):
+            return l2b.pixels()[:2]
+        return np.nonzero(binarize(np.asarray(l2b)))
+
+    def plume_bbox(self, index):
+        """
+        index 番目のサンプルのプルームを囲む (row_start, col_start, row_stop, col_stop). プルームが無い場合は None.
+        """
+        l2b = self.open(index)[1]
+        if isinstance(l2b, SparseL2B):
+            return l2b.bbox
+        rows, cols = self.plume_pixels(index)
+        if rows.size == 0:
+            return None
+        return (
+            int(rows.min()),
+            int(cols.min()),
+            int(rows.max()) + 1,
+            int(cols.max()) + 1,
+        )
+
+    def random_window(self, index, size, rng, centered=False):
+        """
+        index 番目のサンプルの中から size x size のウィンドウをランダムに選ぶ.
+        サンプルが size より小さい場合は左上から (足りない部分は read_batch で0埋めする).
+        centered=True の場合はランダムに選んだプルームの画素を中心にする (プルームが無い場合は全体から選ぶ).
+        """
+        height, width = self.shape(index)[:2]
+        max_row, max_col = max(height - size, 0), max(width - size, 0)
+        if centered:
+            rows, cols = self.plume_pixels(index)
+            if rows.size:
+                k = rng.integers(rows.size)
+                row = min(max(int(rows[k]) - size // 2, 0), max_row)
+                col = min(max(int(cols[k]) - size // 2, 0), max_col)
+                return row, col, size, size
+        row = rng.integers(0, max_row + 1)
+        col = rng.integers(0, max_col + 1)
+        return int(row), int(col), size, size
+
+    def read_batch(self, indices, size, bands=None, rng=None, centered=False):
+        """
+        indices のサンプルから size x size のパッチを1つずつ読み込み, 連続した配列にまとめる.
+
+        Returns:
+        l2a: (N, size, size, bands), l2b: (N, size, size). サンプルより外側は0
+        """
+        rng = rng or np.random.default_rng()
+        l2a_batch, l2b_batch = None, None
+        for k, index in enumerate(indices):
+            window = self.random_window(index, size, rng, centered)
+            l2a, l2b = self.read(index, window, bands)
+            if l2a_batch is None:
+                l2a_batch = np.zeros(
+                    (len(indices), size, size, l2a.shape[-1]), l2a.dtype
+                )
+                l2b_batch = np.zeros((len(indices), size, size), l2b.dtype)
+            height, width = l2b.shape
+            l2a_batch[k, :height, :width] = l2a
+            l2b_batch[k, :height, :width] = l2b
+        return l2a_batch, l2b_batch
+
+
+class BatchLoader:
+    """
+    EmitDataset からバッチをスレッドプールで先読みしながら返すイテレータ.
+    memmap の読み込み (ページフォールト) は GIL を解放するため, スレッドで並列に読み込める.
+
+    prefetch: 先に読み込んでおくバッチ数
+    centered: プルームの画素を中心にパッチを選ぶ
+    samples_per_second: 直近の繰り返しでのスループット
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size=32,
+        size=64,
+        bands=None,
+        shuffle=True,
+        drop_last=False,
+        workers=4,
+        prefetch=4,
+        seed=0,
+        centered=False,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.size = size
+        self.bands = bands
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.workers = workers
+        self.prefetch = prefetch
+        self.centered = centered
+        self.rng = np.random.default_rng(seed)
+        self.samples = 0
+        self.elapsed = 0.0
+
+    def __len__(self):
+        n = len(self.dataset)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+    @property
+    def samples_per_second(self):
+        return self.samples / self.elapsed if self.elapsed > 0 else 0.0
+
+    def _batches(self):
+        order = np.arange(len(self.dataset))
+        if self.shuffle:
+            self.rng.shuffle(order)
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start : start + self.batch_size]
+            if self.drop_last and len(indices) < self.batch_size:
+                break
+            # スレッドごとに独立した乱数でパッチの位置を決める
+            yield indices, np.random.default_rng(self.rng.integers(2**32))
+
+    def _load(self, indices, rng):
+        l2a, l2b = self.dataset.read_batch(
+            indices, self.size, self.bands, rng, self.centered
+        )
+        return l2a, l2b, [self.dataset.ids[i] for i in indices]
+
+    def __iter__(self):
+        self.samples, self.elapsed = 0, 0.0
+        start = time.perf_counter()
+        batches = self._batches()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            pending = deque(
+                executor.submit(self._load, *batch)
+                for _, batch in zip(range(self.prefetch), batches)
+            )
+            while pending:
+                l2a, l2b, ids = pending.popleft().result()
+                # 取り出した分だけ次のバッチを投入し, 常に prefetch 個を先読みしておく
+                for batch in batches:
+                    pending.append(executor.submit(self._load, *batch))
+                    break
+                self.samples += len(ids)
+                self.elapsed = time.perf_counter() - start
+                yield l2a, l2b, ids
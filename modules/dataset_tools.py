@@ -0,0 +1,498 @@
+"""
+データセット作成用の L2A, L2B データの読み込み・位置合わせの関数をまとめたモジュール
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+from affine import Affine
+
+from emit_tools import apply_glt, ds_glt_array, emit_xarray, glt_index
+from granule_cache import current_cache, local_opener
+from manifest import sample_record
+from labels import SparseL2B
+from mosaic import lattice_index, mosaic_window
+from band_stats import BandStats
+from spectral_select import (
+    binned_encoder,
+    binned_wavelengths,
+    select_spectral,
+    split_binning,
+)
+from precision import encoder, precision_spec
+from lazy_import import lazy_module
+
+# rasterio (GDAL, boto3) の import は重いため, ワーカーが最初に L2B を開く時まで遅延させる
+rasterio = lazy_module("rasterio", "rasterio.crs", "rasterio.warp", "rasterio.windows")
+
+
+def is_same_grid(src_transform, dst_transform, atol=1e-9):
+    """
+    dst_transform のグリッドが src_transform のグリッドと画素サイズ・回転が同じで,
+    原点が整数画素だけずれている (= ウィンドウ読み込みで済む) 場合に True を返す.
+    """
+    if not np.allclose(
+        [src_transform.a, src_transform.b, src_transform.d, src_transform.e],
+        [dst_transform.a, dst_transform.b, dst_transform.d, dst_transform.e],
+        rtol=0,
+        atol=atol,
+    ):
+        return False
+    col, row = ~src_transform * (dst_transform.c, dst_transform.f)
+    return np.allclose([col, row], np.round([col, row]), rtol=0, atol=1e-6)
+
+
+def read_l2b(src, dst_transform=None, dst_shape=None, dst_crs=None, fill_value=0):
+    """
+    L2B の GeoTIFF を読み込む.
+
+    dst_transform, dst_shape を指定しない場合はそのままのグリッドで全体を読み込む.
+    指定した場合, 同じグリッド上であればそのウィンドウだけを読み込み,
+    異なるグリッドであれば全バンドを1回の reproject で dst のグリッドに合わせる.
+
+    Parameters:
+    src: rasterio で開いた L2B のデータセット
+    dst_transform: 出力グリッドの Affine
+    dst_shape: 出力グリッドの (height, width)
+    dst_crs: 出力グリッドの CRS (None の場合は src.crs)
+    fill_value: 範囲外の画素に入れる値
+
+    Returns:
+    l2b_data: (height, width) または (bands, height, width) の numpy 配列
+    transform: l2b_data の Affine
+    """
+    dst_crs = dst_crs or src.crs
+    if dst_transform is None:
+        dst_transform, dst_shape = src.transform, src.shape
+    out = np.empty((src.count, *dst_shape), dtype=src.dtypes[0])
+
+    if dst_crs == src.crs and is_same_grid(src.transform, dst_transform):
+        # 同じグリッド: 重なる部分だけをウィンドウで直接出力バッファに読み込む
+        col_off, row_off = np.round(~src.transform * (dst_transform.c, dst_transform.f))
+        window = rasterio.windows.Window(
+            int(col_off), int(row_off), dst_shape[1], dst_shape[0]
+        )
+        inside = (
+            window.col_off >= 0
+            and window.row_off >= 0
+            and window.col_off + window.width <= src.width
+            and window.row_off + window.height <= src.height
+        )
+        # はみ出す場合のみ boundless (VRT 経由) で読み込む
+        src.read(
+            window=window,
+            out=out,
+            boundless=not inside,
+            fill_value=fill_value,
+        )
+    else:
+        # 異なるグリッド: 全バンドをまとめて1回でワープする
+        out.fill(fill_value)
+        rasterio.warp.reproject(
+            source=rasterio.band(src, list(range(1, src.count + 1))),
+            destination=out,
+            src_transform=src.transform,
+            src_crs=src.crs,
+            dst_transform=dst_transform,
+            dst_crs=dst_crs,
+            dst_nodata=fill_value,
+            resampling=rasterio.warp.Resampling.nearest,
+        )
+    return out.squeeze(), dst_transform
+
+
+def l2a_grid(l2a_geo):
+    """
+    オルソ補正済みの L2A データセットのグリッド (Affine, (height, width)) を返す.
+    """
+    transform = Affine.from_gdal(*l2a_geo.attrs["geotransform"])
+    return transform, (l2a_geo.sizes["latitude"], l2a_geo.sizes["longitude"])
+
+
+def target_grid(grid_transform, grid_shape, bounds, clip=True):
+    """
+    bounds (left, bottom, right, top) を覆う grid 上のウィンドウと, その Affine を返す.
+    ウィンドウは grid の画素境界にスナップし, clip=True の場合は grid の範囲内に収める.
+    """
+    left, bottom, right, top = bounds
+    # 浮動小数点の誤差で1画素ずれないように丸めてからスナップする
+    col_start, row_start = np.round(~grid_transform * (left, top), 6)
+    col_stop, row_stop = np.round(~grid_transform * (right, bottom), 6)
+    col_start, row_start = int(np.floor(col_start)), int(np.floor(row_start))
+    col_stop, row_stop = int(np.ceil(col_stop)), int(np.ceil(row_stop))
+    if clip:
+        col_start, row_start = max(col_start, 0), max(row_start, 0)
+        col_stop = min(col_stop, grid_shape[1])
+        row_stop = min(row_stop, grid_shape[0])
+    if col_stop <= col_start or row_stop <= row_start:
+        raise ValueError(f"bounds {bounds} が L2A のグリッドと重なっていません.")
+    window = rasterio.windows.Window(
+        col_start, row_start, col_stop - col_start, row_stop - row_start
+    )
+    return window, rasterio.windows.transform(window, grid_transform)
+
+
+def grid_info(window, grid_transform, crs, l2a_ds, bin_factor=None):
+    """
+    共通グリッドの情報 (meta/<id>.json に保存する内容) の辞書を返す.
+    bin_factor を指定した場合, wavelengths はビニング後の中心波長にする.
+    """
+    wavelengths = (
+        binned_wavelengths(l2a_ds, bin_factor)
+        if bin_factor
+        else l2a_ds["wavelengths"].values
+    )
+    return {
+        "transform": list(rasterio.windows.transform(window, grid_transform).to_gdal()),
+        "crs": str(crs),
+        "shape": [int(window.height), int(window.width)],
+        "bounds": list(rasterio.windows.bounds(window, grid_transform)),
+        "granule_id": l2a_ds.attrs.get("granule_id"),
+        "wavelengths": wavelengths.tolist(),
+    }
+
+
+def coregister_pair(l2a_geo, l2b_src):
+    """
+    L2A と L2B を, L2B の範囲を覆う L2A グリッド上の共通グリッドに揃える.
+
+    Returns:
+    l2a_cropped: (height, width, bands) の L2A の numpy 配列
+    l2b_data: (height, width) の L2B の numpy 配列
+    grid: 共通グリッドの情報 (transform, crs, shape, bounds) の辞書
+    """
+    grid_transform, grid_shape = l2a_grid(l2a_geo)
+    window, transform = target_grid(grid_transform, grid_shape, l2b_src.bounds)
+    shape = (int(window.height), int(window.width))
+
+    rows, cols = window.toslices()
+    l2a_cropped = l2a_geo.reflectance.isel(latitude=rows, longitude=cols).data
+    l2b_data, _ = read_l2b(l2b_src, transform, shape, dst_crs=l2a_geo.rio.crs)
+
+    if l2a_cropped.shape[:2] != l2b_data.shape[-2:]:
+        raise ValueError(
+            f"L2A {l2a_cropped.shape} と L2B {l2b_data.shape} の形状が一致しません."
+        )
+    grid = grid_info(window, grid_transform, l2a_geo.rio.crs, l2a_geo)
+    return l2a_cropped, l2b_data, grid
+
+
+def scene_grid(l2a_ds):
+    """
+    オルソ補正前の L2A データセットの, オルソ補正後のグリッド (Affine, (height, width)) を返す.
+    """
+    transform = Affine.from_gdal(*l2a_ds.attrs["geotransform"])
+    return transform, l2a_ds["glt_x"].shape
+
+
+def ortho_window(
+    l2a_ds, window, glt_array=None, fill_value=-9999, dtype=np.float32, encode=None
+):
+    """
+    オルソ補正前の L2A データセットの reflectance を, オルソ補正後のグリッドの window の範囲だけオルソ補正する.
+    GLT が参照する生データの範囲だけを読み込むため, シーン全体を ortho_xr するより軽い.
+    結果は ortho_xr の結果を window で切り出したものと同じになる.
+
+    glt_array: ds_glt_array で作成したシーン全体の GLT 配列 (None の場合は l2a_ds から作成する)
+    """
+    if glt_array is None:
+        glt_array = ds_glt_array(l2a_ds)
+    rows, cols = window.toslices()
+    valid, raw_rows, raw_cols = glt_index(glt_array[rows, cols])
+    reflectance = l2a_ds["reflectance"]
+    if raw_rows.size == 0:
+        raw = np.zeros((0, 0, reflectance.shape[-1]), dtype=reflectance.dtype)
+        index = (valid, [], [])
+        return apply_glt(raw, None, fill_value, dtype=dtype, encode=encode, index=index)
+
+    row_start, col_start = raw_rows.min(), raw_cols.min()
+    raw = reflectance[
+        row_start : raw_rows.max() + 1, col_start : raw_cols.max() + 1
+    ].values
+    index = (valid, raw_rows - row_start, raw_cols - col_start)
+    return apply_glt(raw, None, fill_value, dtype=dtype, encode=encode, index=index)
+
+
+def coregister_mosaic(l2a_ds, l2b_src, adjacent, spec, bin_factor=None):
+    """
+    L2B の範囲がシーンの外 (GLT が無効な画素) にはみ出している場合に, 隣接シーンをつなぎ合わせて共通グリッドに揃える.
+    ウィンドウは l2a_ds のグリッド上で L2B の範囲全体を覆うように取る (シーンの範囲内に収めない).
+    はみ出していない場合や, 隣接シーンから補える画素が無い場合は None を返す.
+
+    adjacent: オルソ補正前の隣接シーンのデータセットのリストを返す関数 (はみ出している場合だけ呼ぶ)
+    """
+    grid_transform, grid_shape = scene_grid(l2a_ds)
+    window, transform = target_grid(
+        grid_transform, grid_shape, l2b_src.bounds, clip=False
+    )
+    shape = (int(window.height), int(window.width))
+    crs = rasterio.crs.CRS.from_user_input(l2a_ds.attrs["spatial_ref"])
+
+    l2b_data, _ = read_l2b(l2b_src, transform, shape, dst_crs=crs)
+    plume = np.isfinite(l2b_data) & (l2b_data != 0)
+    if l2b_src.nodata is not None:
+        plume &= l2b_data != l2b_src.nodata
+    first_index = lattice_index(l2a_ds, transform, shape)
+    valid = first_index[0]
+    if not (plume & ~valid).any():
+        return None
+    scenes = adjacent()
+    if not scenes:
+        return None
+
+    l2a_cropped, sources = mosaic_window(
+        [l2a_ds, *scenes],
+        transform,
+        shape,
+        fill_value=spec["nodata"],
+        dtype=spec["dtype"],
+        encode=binned_encoder(encoder(spec), bin_factor),
+        first_index=first_index,
+    )
+    used = np.unique(sources[sources > 0])
+    if used.size == 0:
+        # 隣接シーンにも無い画素だけの場合は通常のウィンドウで切り出す
+        return None
+    grid = grid_info(window, grid_transform, crs, l2a_ds, bin_factor)
+    grid["adjacent_granules"] = [
+        scenes[k - 1].attrs.get("granule_id") for k in used.tolist()
+    ]
+    print(
+        f"シーン外の {int((plume & ~valid).sum())} 画素を隣接シーン "
+        f"{grid['adjacent_granules']} から補いました"
+    )
+    return l2a_cropped, l2b_data, grid
+
+
+def coregister_scene_pair(
+    l2a_ds, l2b_src, glt_array=None, spec=None, adjacent=None, bin_factor=None
+):
+    """
+    coregister_pair と同じ共通グリッドに, オルソ補正前の L2A をウィンドウだけオルソ補正して揃える.
+    spec (precision_spec) の dtype で L2A を出力する.
+    bin_factor を指定した場合は, ウィンドウの画素を集めた後に隣り合うバンドを平均する.
+    adjacent を指定した場合, L2B がシーンの外にはみ出していれば coregister_mosaic で隣接シーンをつなぎ合わせる.
+    """
+    spec = spec or precision_spec("float32")
+    if adjacent is not None:
+        stitched = coregister_mosaic(l2a_ds, l2b_src, adjacent, spec, bin_factor)
+        if stitched is not None:
+            return stitched
+    grid_transform, grid_shape = scene_grid(l2a_ds)
+    window, transform = target_grid(grid_transform, grid_shape, l2b_src.bounds)
+    shape = (int(window.height), int(window.width))
+    crs = rasterio.crs.CRS.from_user_input(l2a_ds.attrs["spatial_ref"])
+
+    l2a_cropped = ortho_window(
+        l2a_ds,
+        window,
+        glt_array,
+        fill_value=spec["nodata"],
+        dtype=spec["dtype"],
+        encode=binned_encoder(encoder(spec), bin_factor),
+    )
+    l2b_data, _ = read_l2b(l2b_src, transform, shape, dst_crs=crs)
+
+    if l2a_cropped.shape[:2] != l2b_data.shape[-2:]:
+        raise ValueError(
+            f"L2A {l2a_cropped.shape} と L2B {l2b_data.shape} の形状が一致しません."
+        )
+    grid = grid_info(window, grid_transform, crs, l2a_ds, bin_factor)
+    return l2a_cropped, l2b_data, grid
+
+
+def ortho_scene(
+    l2a_fp,
+    pairs,
+    l2a_outdir,
+    l2b_outdir,
+    meta_outdir=None,
+    spectral=None,
+    precision="float32",
+    opener=None,
+    adjacent=None,
+    l2b_format="npy",
+):
+    """
+    同じ L2A グラニュールを共有するペアをまとめて処理する.
+    L2A は1回だけ開き, 各 L2B の範囲のウィンドウだけをオルソ補正して L2B と共通のグリッドの .npy に保存する.
+    共通グリッドの情報は meta_outdir (既定は l2a_outdir の1つ上の meta) に json で,
+    バンドごとの統計量は meta_outdir と同じ階層の stats に npz で保存する.
+    spectral を指定した場合は select_spectral でオルソ補正の前にバンドを選択する.
+    ビニング (bin_factor) はシーン全体を読み込まないように, ウィンドウの画素を集めた後に行う.
+    precision (float32, float16, int16) の dtype でオルソ補正の結果を直接出力する.
+    l2b_format="sparse" の場合は L2B をプルームの画素だけの SparseL2B (.npz) で保存する.
+
+    pairs: (geojson_id, l2b_fp) のリスト
+    opener: L2A を開く emit_xarray の opener (リモートのファイルでは h5_planner.planned_opener など)
+    adjacent: 同じ軌道の隣接シーンの (l2a_fp, opener) のリスト, またはそのリストを返す関数.
+        L2B がシーンの外にはみ出しているペアがある場合だけ, 関数を呼んで (隣接シーンの検索など) 隣接シーンを開き, つなぎ合わせる
+        (opener が None の場合は L2A と同じ方法で開く). l2a_fp がファイルオブジェクトの場合は処理の最後に閉じる
+    Returns: 保存した geojson_id のリスト
+    """
+    # 出力ファイル名を生成
+    meta_outdir = Path(meta_outdir or Path(l2a_outdir).parent / "meta")
+    stats_outdir = meta_outdir.parent / "stats"
+    meta_outdir.mkdir(parents=True, exist_ok=True)
+    stats_outdir.mkdir(parents=True, exist_ok=True)
+    l2b_suffix = ".npz" if l2b_format == "sparse" else ".npy"
+    outputs = {
+        geojson_id: (
+            l2a_outdir / f"{geojson_id}.npy",
+            l2b_outdir / f"{geojson_id}{l2b_suffix}",
+            meta_outdir / f"{geojson_id}.json",
+            stats_outdir / f"{geojson_id}.npz",
+        )
+        for geojson_id, _ in pairs
+    }
+
+    todo = []
+    for geojson_id, l2b_fp in pairs:
+        l2a_dst, l2b_dst, _, _ = outputs[geojson_id]
+        if l2a_dst.exists() and l2b_dst.exists():
+            print(
+                f"\nファイル {l2a_dst} および {l2b_dst} は既に存在しています。スキップします。"
+            )
+        else:
+            todo.append((geojson_id, l2b_fp))
+    if not todo:
+        return []
+
+    print(f"\n以下の L2A を {len(todo)} 件のペアで処理します:\n  L2A: {l2a_fp}")
+
+    try:
+        if isinstance(l2a_fp, Path):
+            l2a_fp = str(l2a_fp)
+        # init_worker で作成したキャッシュがあれば, 同じグラニュールのハンドルと GLT を再利用する
+        # ローカルのファイルは memmap で開き, ortho_window で必要な範囲だけを読み込む
+        cache = current_cache()
+        if opener is None:
+            opener = cache.open_group if cache else local_opener(l2a_fp)
+        l2a_ds = emit_xarray(l2a_fp, ortho=False, opener=opener)
+        glt_array = cache.glt(l2a_fp, l2a_ds) if cache else ds_glt_array(l2a_ds)
+        selection, bin_factor = split_binning(spectral)
+        if selection:
+            # 不要なバンドは読み込み・オルソ補正の前に落とす
+            l2a_ds = select_spectral(l2a_ds, **selection)
+        spec = precision_spec(precision)
+    except Exception as e:
+        print(
+            f"L2A {l2a_fp} の読み込みでエラーが発生しました。エラー内容: {e}. このグラニュールのペアはスキップします。"
+        )
+        return []
+
+    adjacent_scenes = None
+    adjacent_files = []
+
+    def open_adjacent():
+        # 隣接シーンは必要になった時に1回だけ探して開く
+        nonlocal adjacent_scenes
+        if adjacent_scenes is None:
+            adjacent_scenes = []
+            try:
+                candidates = adjacent() if callable(adjacent) else adjacent
+            except Exception as e:
+                print(f"隣接シーンの検索でエラーが発生しました。エラー内容: {e}")
+                candidates = []
+            for adjacent_fp, adjacent_opener in candidates:
+                if isinstance(adjacent_fp, Path):
+                    adjacent_fp = str(adjacent_fp)
+                if not isinstance(adjacent_fp, str):
+                    adjacent_files.append(adjacent_fp)
+                if adjacent_opener is None:
+                    adjacent_opener = (
+                        cache.open_group if cache else local_opener(adjacent_fp)
+                    )
+                try:
+                    ds = emit_xarray(adjacent_fp, ortho=False, opener=adjacent_opener)
+                    if selection:
+                        ds = select_spectral(ds, **selection)
+                    adjacent_scenes.append(ds)
+                except Exception as e:
+                    print(
+                        f"隣接シーン {adjacent_fp} の読み込みでエラーが発生しました。エラー内容: {e}"
+                    )
+        return adjacent_scenes
+
+    saved = []
+    try:
+        for geojson_id, l2b_fp in todo:
+            l2a_dst, l2b_dst, meta_dst, stats_dst = outputs[geojson_id]
+            print(f"\n以下のファイルを処理します:\n  L2A: {l2a_fp}\n  L2B: {l2b_fp}")
+            try:
+                # L2B の範囲だけオルソ補正し, L2B を L2A のグリッドに揃えて読み込む
+                # 欠損値 (-9999) は precision の nodata (float は 0) に置き換える
+                with rasterio.open(l2b_fp) as src:
+                    print(f"bbox: {src.bounds}")
+                    l2a_cropped, l2b_data, grid = coregister_scene_pair(
+                        l2a_ds,
+                        src,
+                        glt_array,
+                        spec,
+                        adjacent=open_adjacent if adjacent else None,
+                        bin_factor=bin_factor,
+                    )
+                grid["precision"] = spec
+
+                # データを保存
+                np.save(l2a_dst, l2a_cropped)
+                if l2b_format == "sparse":
+                    SparseL2B.from_dense(l2b_data).save(l2b_dst)
+                else:
+                    np.save(l2b_dst, l2b_data)
+                # 配列がメモリにあるうちにマニフェスト用の統計量を計算しておく
+                grid.update(
+                    sample_record(
+                        l2a_dst,
+                        l2a_cropped,
+                        l2b_dst,
+                        l2b_data,
+                        nodata=spec["nodata"],
+                        root=meta_outdir.parent,
+                    )
+                )
+                # 正規化用のバンドごとの統計量 (build_band_stats でまとめる)
+                BandStats.from_cube(l2a_cropped, spec).save(stats_dst)
+                meta_dst.write_text(json.dumps(grid, indent=2), encoding="utf-8")
+                print(f"保存完了:\n  L2A -> {l2a_dst}\n  L2B -> {l2b_dst}")
+                saved.append(geojson_id)
+            except Exception as e:
+                print(
+                    f"{geojson_id} のペアの処理でエラーが発生しました。エラー内容: {e}. このペアはスキップします。"
+                )
+                # 途中で生成されたファイルがあれば削除
+                for dst in (l2a_dst, l2b_dst, meta_dst, stats_dst):
+                    if dst.exists():
+                        dst.unlink()
+    finally:
+        # 隣接シーンとして開いたファイルを閉じる
+        for adjacent_file in adjacent_files:
+            adjacent_file.close()
+    return saved
+
+
+def ortho_file_pair(
+    geojson_id,
+    l2a_fp,
+    l2b_fp,
+    l2a_outdir,
+    l2b_outdir,
+    meta_outdir=None,
+    spectral=None,
+    precision="float32",
+    l2b_format="npy",
+):
+    """
+    1組の L2A, L2B を ortho_scene で処理する.
+    """
+    ortho_scene(
+        l2a_fp,
+        [(geojson_id, l2b_fp)],
+        l2a_outdir,
+        l2b_outdir,
+        meta_outdir=meta_outdir,
+        spectral=spectral,
+        precision=precision,
+        l2b_format=l2b_format,
+    )
@@ -12,24 +12,34 @@ TO DO:
 """
 
 # Packages used
-import netCDF4 as nc
 import os
-from spectral.io import envi
-from osgeo import gdal
 import numpy as np
-import math
-from skimage import io
-import pandas as pd
-import geopandas as gpd
-import xarray as xr
-import rasterio as rio
-import rioxarray as rxr
-import s3fs
-from rioxarray.merge import merge_arrays
-from fsspec.implementations.http import HTTPFile
+from lazy_import import lazy_module
 
+# Heavy dependencies are imported on first use so that importing this module (e.g. only for apply_glt)
+# or spinning up a worker process stays cheap. rioxarray is loaded with xarray to register the .rio accessor.
+xr = lazy_module("xarray", "rioxarray")
+envi = lazy_module("spectral.io.envi")
+io = lazy_module("skimage.io")
+rxr_merge = lazy_module("rioxarray.merge")
 
-def emit_xarray(filepath, ortho=False, qmask=None, unpacked_bmask=None):
+
+def _is_file_type(filepath, module, name):
+    """
+    Check the type of a file object by name so that s3fs/fsspec do not have to be imported.
+    """
+    file_type = type(filepath)
+    return file_type.__module__.startswith(module) and file_type.__name__ == name
+
+
+def open_group(filepath, group=None, engine="h5netcdf"):
+    """
+    Open a group of an EMIT netCDF file as an xarray.Dataset. This is the default opener used by emit_xarray.
+    """
+    return xr.open_dataset(filepath, engine=engine, group=group)
+
+
+def emit_xarray(filepath, ortho=False, qmask=None, unpacked_bmask=None, opener=None):
     """
     This function utilizes other functions in this module to streamline opening an EMIT dataset as an xarray.Dataset.
 
@@ -38,6 +48,7 @@ def emit_xarray(filepath, ortho=False, qmask=None, unpacked_bmask=None):
     ortho: True or False, whether to orthorectify the dataset or leave in crosstrack/downtrack coordinates.
     qmask: a numpy array output from the quality_mask function used to mask pixels based on quality flags selected in that function. Any non-orthorectified array with the proper crosstrack and downtrack dimensions can also be used.
     unpacked_bmask: a numpy array from  the band_mask function that can be used to mask band-specific pixels that have been interpolated.
+    opener: optional function (filepath, group) -> xarray.Dataset used instead of `open_group`, e.g. to reuse cached handles.
 
     Returns:
     out_xr: an xarray.Dataset constructed based on the parameters provided.
@@ -45,18 +56,18 @@ def emit_xarray(filepath, ortho=False, qmask=None, unpacked_bmask=None):
     """
     # Grab granule filename to check product
 
-    if type(filepath) == s3fs.core.S3File:
+    if _is_file_type(filepath, "s3fs", "S3File"):
         granule_id = filepath.info()["name"].split("/", -1)[-1].split(".", -1)[0]
-    elif type(filepath) == HTTPFile:
+    elif _is_file_type(filepath, "fsspec.implementations.http", "HTTPFile"):
         granule_id = filepath.path.split("/", -1)[-1].split(".", -1)[0]
     else:
         granule_id = os.path.splitext(os.path.basename(filepath))[0]
 
     # Read in Data as Xarray Datasets
-    engine, wvl_group = "h5netcdf", None
+    opener, wvl_group = opener or open_group, None
 
-    ds = xr.open_dataset(filepath, engine=engine)
-    loc = xr.open_dataset(filepath, engine=engine, group="location")
+    ds = opener(filepath, None)
+    loc = opener(filepath, "location")
 
     # Check if mineral dataset and read in groups (only ds/loc for minunc)
 
@@ -68,7 +79,7 @@ def emit_xarray(filepath, ortho=False, qmask=None, unpacked_bmask=None):
     wvl = None
 
     if wvl_group:
-        wvl = xr.open_dataset(filepath, engine=engine, group=wvl_group)
+        wvl = opener(filepath, wvl_group)
 
     # Building Flat Dataset from Components
     data_vars = {**ds.variables}
@@ -145,39 +156,94 @@ def get_pixel_center_coords(ds):
     return x_geo, y_geo
 
 
+# Function to decode the GLT into indices that can be reused for every variable
+def glt_index(glt_array, GLT_NODATA_VALUE=0):
+    """
+    This function decodes a GLT array into the valid pixel mask and zero based raw space indices used by `apply_glt`.
+
+    Parameters:
+    glt_array: a GLT array constructed from EMIT GLT data
+    GLT_NODATA_VALUE: no data value for the GLT tables, 0 by default
+
+    Returns:
+    valid_glt, rows, cols: boolean mask of valid GLT pixels, and the downtrack/crosstrack indices of those pixels
+    """
+    valid_glt = np.all(glt_array != GLT_NODATA_VALUE, axis=-1)
+    # Adjust for One based Index
+    rows = glt_array[valid_glt, 1] - 1
+    cols = glt_array[valid_glt, 0] - 1
+    return valid_glt, rows, cols
+
+
+def ds_glt_array(ds, GLT_NODATA_VALUE=0):
+    """
+    This function builds the GLT array (glt_x, glt_y stacked on the last axis) of an unorthorectified dataset
+    (emit_xarray with ortho=False).
+    """
+    return np.nan_to_num(
+        np.stack([ds["glt_x"].data, ds["glt_y"].data], axis=-1), nan=GLT_NODATA_VALUE
+    ).astype(int)
+
+
+def ds_glt_index(ds, GLT_NODATA_VALUE=0):
+    """
+    This function builds the GLT array of an unorthorectified dataset and decodes it with `glt_index`.
+    """
+    glt_ds = ds_glt_array(ds, GLT_NODATA_VALUE=GLT_NODATA_VALUE)
+    return glt_index(glt_ds, GLT_NODATA_VALUE=GLT_NODATA_VALUE)
+
+
 # Function to Apply the GLT to an array
-def apply_glt(ds_array, glt_array, fill_value=-9999, GLT_NODATA_VALUE=0):
+def apply_glt(
+    ds_array,
+    glt_array,
+    fill_value=-9999,
+    GLT_NODATA_VALUE=0,
+    dtype=np.float32,
+    encode=None,
+    index=None,
+):
     """
     This function applies the GLT array to a numpy array of either 2 or 3 dimensions.
 
     Parameters:
     ds_array: numpy array of the desired variable
-    glt_array: a GLT array constructed from EMIT GLT data
+    glt_array: a GLT array constructed from EMIT GLT data (may be None if index is provided)
+    dtype: dtype of the output array, float32 by default
+    encode: optional function applied to the gathered pixels to convert them to dtype (e.g. scaled int16)
+    index: optional output of `glt_index`, to avoid decoding the same GLT again
 
     Returns:
     out_ds: a numpy array of orthorectified data.
     """
+    if index is None:
+        index = glt_index(glt_array, GLT_NODATA_VALUE=GLT_NODATA_VALUE)
+    valid_glt, rows, cols = index
 
     # Build Output Dataset
     if ds_array.ndim == 2:
         ds_array = ds_array[:, :, np.newaxis]
+    values = ds_array[rows, cols, :]
+    if encode is not None:
+        values = encode(values)
+    # encode may change the number of bands (e.g. spectral binning), so size the output after it
     out_ds = np.full(
-        (glt_array.shape[0], glt_array.shape[1], ds_array.shape[-1]),
+        (valid_glt.shape[0], valid_glt.shape[1], values.shape[-1]),
         fill_value,
-        dtype=np.float32,
+        dtype=dtype,
     )
-    valid_glt = np.all(glt_array != GLT_NODATA_VALUE, axis=-1)
-
-    # Adjust for One based Index - make a copy to prevent decrementing multiple times inside ortho_xr when applying the glt to elev
-    glt_array_copy = glt_array.copy()
-    glt_array_copy[valid_glt] -= 1
-    out_ds[valid_glt, :] = ds_array[
-        glt_array_copy[valid_glt, 1], glt_array_copy[valid_glt, 0], :
-    ]
+    out_ds[valid_glt, :] = values
     return out_ds
 
 
-def ortho_xr(ds, GLT_NODATA_VALUE=0, fill_value=-9999):
+def ortho_xr(
+    ds,
+    GLT_NODATA_VALUE=0,
+    fill_value=-9999,
+    dtype=np.float32,
+    encode=None,
+    glt=None,
+):
     """
     This function uses `apply_glt` to create an orthorectified xarray dataset.
 
@@ -185,16 +251,17 @@ def ortho_xr(ds, GLT_NODATA_VALUE=0, fill_value=-9999):
     ds: an xarray dataset produced by emit_xarray
     GLT_NODATA_VALUE: no data value for the GLT tables, 0 by default
     fill_value: the fill value for EMIT datasets, -9999 by default
+    dtype: dtype of the orthorectified data variables, float32 by default
+    encode: optional function passed to `apply_glt` to convert data variables to dtype
+    glt: optional output of `glt_index` for this dataset (e.g. cached per granule)
 
     Returns:
     ortho_ds: an orthocorrected xarray dataset.
 
     """
-    # Build glt_ds
-
-    glt_ds = np.nan_to_num(
-        np.stack([ds["glt_x"].data, ds["glt_y"].data], axis=-1), nan=GLT_NODATA_VALUE
-    ).astype(int)
+    # Decode the GLT once for all variables
+    if glt is None:
+        glt = ds_glt_index(ds, GLT_NODATA_VALUE=GLT_NODATA_VALUE)
 
     # List Variables
     var_list = list(ds.data_vars)
@@ -211,7 +278,14 @@ def ortho_xr(ds, GLT_NODATA_VALUE=0, fill_value=-9999):
         raw_ds = ds[var].data
         var_dims = ds[var].dims
         # Apply GLT to dataset
-        out_ds = apply_glt(raw_ds, glt_ds, GLT_NODATA_VALUE=GLT_NODATA_VALUE)
+        out_ds = apply_glt(
+            raw_ds,
+            None,
+            fill_value=fill_value,
+            dtype=dtype,
+            encode=encode,
+            index=glt,
+        )
 
         # Update variables - Only works for 2 or 3 dimensional arays
         if raw_ds.ndim == 2:
@@ -228,10 +302,7 @@ def ortho_xr(ds, GLT_NODATA_VALUE=0, fill_value=-9999):
     )  # Reorder this function to make sense in case of multiple variables
 
     # Apply GLT to elevation
-    elev_ds = apply_glt(ds["elev"].data, glt_ds)
-
-    # Delete glt_ds - no longer needed
-    del glt_ds
+    elev_ds = apply_glt(ds["elev"].data, None, index=glt)
 
     # Create Coordinate Dictionary
     coords = {
@@ -624,7 +695,7 @@ def is_adjacent(scene: str, same_orbit: list):
     return all(b - a == 1 for a, b in zip(scene_nums[:-1], scene_nums[1:]))
 
 
-def merge_emit(datasets: dict, gdf: gpd.GeoDataFrame):
+def merge_emit(datasets: dict, gdf: "gpd.GeoDataFrame"):
     """
     A function to merge xarray datasets formatted using emit_xarray. This could probably be improved,
     lots of shuffling data around to keep in xarray and get it to merge properly. Note: GDF may only work with a
@@ -685,7 +756,7 @@ def merge_emit(datasets: dict, gdf: gpd.GeoDataFrame):
     # Merge the arrays using rioxarray.merge_arrays()
     merged = {}
     for _var in transposed_dict:
-        merged[_var] = merge_arrays(
+        merged[_var] = rxr_merge.merge_arrays(
             list(transposed_dict[_var].values()),
             bounds=gdf.unary_union.bounds,
             nodata=-9999,
@@ -700,32 +771,42 @@ def merge_emit(datasets: dict, gdf: gpd.GeoDataFrame):
     return merged_ds
 
 
-def ortho_browse(url, glt, spatial_ref, geotransform, white_background=True):
+def ortho_browse(
+    url, glt, spatial_ref, geotransform, white_background=True, index=None
+):
     """
     Use an EMIT GLT, geotransform, and spatial ref to orthorectify a browse image. (browse images are in native resolution)
+
+    Parameters:
+    url: path or URL of the browse PNG, or an already decoded (downtrack, crosstrack, band) array
+    glt: a GLT array constructed from EMIT GLT data (may be None if index is provided)
+    index: optional output of `glt_index`, to reuse the GLT decoded for the same granule
+
+    Returns:
+    da: an xarray.DataArray (band, y, x) with the dtype of the browse image (uint8)
     """
     # Read Data
-    data = io.imread(url)
-    # Orthorectify using GLT and transpose so band is first dimension
-    if white_background == True:
-        fill = 255
-    else:
-        fill = 0
-    ortho_data = apply_glt(data, glt, fill_value=fill).transpose(2, 0, 1)
+    data = io.imread(url) if isinstance(url, (str, os.PathLike)) else np.asarray(url)
+    if index is None:
+        index = glt_index(glt)
+    shape = index[0].shape
+    # Orthorectify using GLT in the dtype of the image and transpose so band is first dimension
+    fill = 255 if white_background else 0
+    ortho_data = apply_glt(
+        data, None, fill_value=fill, dtype=data.dtype, index=index
+    ).transpose(2, 0, 1)
     coords = {
         "y": (
             ["y"],
             (geotransform[3] + 0.5 * geotransform[5])
-            + np.arange(glt.shape[0]) * geotransform[5],
+            + np.arange(shape[0]) * geotransform[5],
         ),
         "x": (
             ["x"],
             (geotransform[0] + 0.5 * geotransform[1])
-            + np.arange(glt.shape[1]) * geotransform[1],
+            + np.arange(shape[1]) * geotransform[1],
         ),
     }
-    ortho_data = ortho_data.astype(int)
-    ortho_data[ortho_data == -1] = 0
     # Place in xarray.datarray
     da = xr.DataArray(ortho_data, dims=["band", "y", "x"], coords=coords)
     da.rio.write_crs(spatial_ref, inplace=True)
@@ -0,0 +1,395 @@
+"""
+ペアの処理を並列実行するためのエグゼキュータ (local / dask / ray) をまとめたモジュール
+
+どのバックエンドも run(fn, tasks, keys) でタスクを投入し, 完了したものから結果を返す.
+keys (タスクごとのグラニュールなど) を使うのは affinity のみで, 他のバックエンドでは無視する.
+ワーカーが落ちた場合は retries 回まで再実行する.
+local, affinity のワーカーは granule_cache のキャッシュを持つ.
+dask, ray は使用する場合のみ import する.
+dask, ray のワーカーでも modules 以下を import できるように PYTHONPATH を設定しておくこと.
+"""
+
+import concurrent.futures
+import multiprocessing
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+from units import parse_memory
+
+BACKENDS = ["local", "affinity", "dask", "ray"]
+
+# ワーカーがタスクを開始したことを親プロセスに知らせるパイプ (_init_worker で設定する)
+_started = None
+
+
+def _init_worker(cache_size, started=None):
+    global _started
+    # executors の import を軽く保つため, granule_cache (emit_tools) はワーカーの中で import する
+    from granule_cache import init_worker
+
+    _started = started
+    init_worker(cache_size)
+
+
+def _run_tracked(fn, token, args, kwargs):
+    # 落ちたワーカーで実行中だったタスクを特定できるように, 開始を記録してから実行する
+    if _started is not None:
+        _started.send(token)
+    return fn(*args, **kwargs)
+
+
+class StartLog:
+    """
+    ワーカーが開始したタスクの記録. プールが壊れた時に, 実行中だったタスクと待機中だったタスクを区別する.
+    パイプへの書き込みは同期的なため, ワーカーが直後に落ちても記録は失われない.
+    SimpleQueue と違いロックを使わないため, プールが壊れた時に書き込み中のワーカーが終了させられても詰まらない
+    (記録は PIPE_BUF より小さいため, 複数のワーカーの書き込みが混ざることもない).
+    パイプが詰まらないように, 親プロセスのスレッドで読み続ける.
+    """
+
+    def __init__(self):
+        self._reader, self.queue = multiprocessing.Pipe(duplex=False)
+        self.started = set()
+        self._synced = threading.Condition()
+        self._marks = 0
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        while True:
+            token = self._reader.recv()
+            if token is None:
+                return
+            with self._synced:
+                if isinstance(token, tuple) and token[0] == "sync":
+                    self._marks = token[1]
+                    self._synced.notify_all()
+                else:
+                    self.started.add(token)
+
+    def sync(self):
+        """
+        これまでにワーカーが書き込んだ記録を全て読み込むまで待つ.
+        """
+        with self._synced:
+            mark = self._marks + 1
+            self.queue.send(("sync", mark))
+            self._synced.wait_for(lambda: self._marks >= mark)
+
+    def was_started(self, token):
+        with self._synced:
+            return token in self.started
+
+    def close(self):
+        self.queue.send(None)
+        self._thread.join()
+        self._reader.close()
+        self.queue.close()
+
+
+class LocalExecutor:
+    """
+    ProcessPoolExecutor を使うエグゼキュータ. プールが壊れた場合は作り直して再実行する.
+    再実行の回数は, プールが壊れた時に実行中だったタスクにだけ数える.
+    実行中だったタスクが複数ある場合は, どのタスクで落ちたかを特定するために1つずつ単独で再実行する.
+    """
+
+    def __init__(self, max_workers=8, retries=1, cache_size=2):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.cache_size = cache_size
+
+    def run(self, fn, tasks, keys=None):
+        """
+        tasks: (args, kwargs) のリスト. 完了したタスクの結果を順に返す.
+        """
+        tasks = list(tasks)
+        attempts = [0] * len(tasks)
+        pending = list(range(len(tasks)))
+        isolated = []  # 落ちた原因の候補として単独で再実行するタスク
+        log = StartLog()
+        round_id = 0
+        try:
+            while pending or isolated:
+                if isolated:
+                    batch, workers = [isolated.pop(0)], 1
+                else:
+                    batch, pending, workers = pending, [], self.max_workers
+                round_id += 1
+                broken = []
+                with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=_init_worker,
+                    initargs=(self.cache_size, log.queue),
+                ) as executor:
+                    futures = {
+                        executor.submit(_run_tracked, fn, (round_id, i), *tasks[i]): i
+                        for i in batch
+                    }
+                    for future in concurrent.futures.as_completed(futures):
+                        try:
+                            yield future.result()
+                        except BrokenProcessPool:
+                            broken.append(futures[future])
+                if not broken:
+                    continue
+                # ワーカーが落ちた (メモリ不足など) 場合は新しいプールで再実行する
+                log.sync()
+                running = [i for i in broken if log.was_started((round_id, i))]
+                if len(batch) == 1 or len(running) <= 1:
+                    # 実行中だったタスク (特定できない場合は全て) にだけ再実行の回数を数える
+                    charged = running or broken
+                    for i in charged:
+                        if attempts[i] >= self.retries:
+                            raise BrokenProcessPool(
+                                f"タスク {i} の実行中にワーカーが {attempts[i] + 1} 回落ちました."
+                            )
+                        attempts[i] += 1
+                    pending.extend(broken)
+                else:
+                    # 実行中だったタスクが複数ある場合は, 1つずつ単独で実行して原因を特定する
+                    isolated.extend(running)
+                    pending.extend(i for i in broken if i not in running)
+        finally:
+            log.close()
+
+    def close(self):
+        pass
+
+
+class AffinityExecutor:
+    """
+    1プロセスずつのワーカーを max_workers 個持ち, 同じキーのタスクを同じワーカーで続けて処理するエグゼキュータ.
+    ワーカーは run を呼び出しても作り直さず, granule_cache のキャッシュを保持し続ける.
+    キーはタスク数が多いものから順に, 割り当てたタスク数が最も少ないワーカーに割り当てる.
+    ワーカーは1プロセスのため, 落ちた時に実行中だったタスクにだけ再実行の回数を数える.
+    """
+
+    def __init__(self, max_workers=8, retries=1, cache_size=2):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.cache_size = cache_size
+        self.workers = [None] * max_workers
+        self.log = None
+        self.rounds = 0
+
+    def _worker(self, index):
+        if self.log is None:
+            self.log = StartLog()
+        if self.workers[index] is None:
+            self.workers[index] = concurrent.futures.ProcessPoolExecutor(
+                max_workers=1,
+                initializer=_init_worker,
+                initargs=(self.cache_size, self.log.queue),
+            )
+        return self.workers[index]
+
+    def assign(self, keys):
+        """
+        keys (タスクごとのキー) から, タスクごとのワーカー番号のリストを返す.
+        """
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(key, []).append(i)
+        loads = [0] * self.max_workers
+        assignment = [0] * len(keys)
+        for key in sorted(groups, key=lambda k: (-len(groups[k]), str(k))):
+            worker = loads.index(min(loads))
+            loads[worker] += len(groups[key])
+            for i in groups[key]:
+                assignment[i] = worker
+        return assignment
+
+    def run(self, fn, tasks, keys=None):
+        """
+        tasks: (args, kwargs) のリスト, keys: タスクごとのキー (None の場合はタスクごとに別のキー).
+        """
+        tasks = list(tasks)
+        keys = list(range(len(tasks))) if keys is None else list(keys)
+        assignment = self.assign(keys)
+        # 各ワーカーは投入順に処理するため, キーごとにまとめて投入する
+        order = sorted(range(len(tasks)), key=lambda i: (str(keys[i]), i))
+        attempts = [0] * len(tasks)
+        pending = order
+        while pending:
+            self.rounds += 1
+            broken = []
+            futures = {}
+            for i in pending:
+                token = (self.rounds, i)
+                future = self._worker(assignment[i]).submit(
+                    _run_tracked, fn, token, *tasks[i]
+                )
+                futures[future] = i
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    broken.append(futures[future])
+            if not broken:
+                break
+            # 落ちたワーカーだけを作り直し, 実行中だったタスクにだけ再実行の回数を数える
+            self.log.sync()
+            for worker in sorted({assignment[i] for i in broken}):
+                self.workers[worker].shutdown(wait=False, cancel_futures=True)
+                self.workers[worker] = None
+                on_worker = [i for i in broken if assignment[i] == worker]
+                running = [
+                    i for i in on_worker if self.log.was_started((self.rounds, i))
+                ]
+                # 開始したタスクが無い (初期化で落ちたなど) 場合はワーカーのタスク全てに数える
+                for i in running or on_worker:
+                    if attempts[i] >= self.retries:
+                        raise BrokenProcessPool(
+                            f"タスク {i} の実行中にワーカーが {attempts[i] + 1} 回落ちました."
+                        )
+                    attempts[i] += 1
+            broken = set(broken)
+            pending = [i for i in order if i in broken]
+
+    def close(self):
+        for worker in self.workers:
+            if worker is not None:
+                worker.shutdown()
+        self.workers = [None] * self.max_workers
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+class DaskExecutor:
+    """
+    dask.distributed を使うエグゼキュータ.
+    address を指定しない場合はプロセス内の LocalCluster を作成する (テスト用).
+    memory を指定した場合は MEMORY リソースとしてスケジューラに渡すため,
+    ワーカーは --resources MEMORY=<bytes> を付けて起動しておく必要がある.
+    """
+
+    def __init__(self, address=None, max_workers=8, retries=1, memory=None):
+        from dask.distributed import Client, LocalCluster
+
+        if address:
+            self.cluster = None
+            self.client = Client(address)
+        else:
+            self.cluster = LocalCluster(
+                n_workers=1, threads_per_worker=max_workers, processes=False
+            )
+            self.client = Client(self.cluster)
+        self.retries = retries
+        self.memory = parse_memory(memory)
+
+    def run(self, fn, tasks, keys=None):
+        from dask.distributed import as_completed
+
+        options = {"retries": self.retries, "pure": False}
+        if self.memory:
+            options["resources"] = {"MEMORY": self.memory}
+        futures = [
+            self.client.submit(fn, *args, **kwargs, **options) for args, kwargs in tasks
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+    def close(self):
+        self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
+
+
+class RayExecutor:
+    """
+    Ray を使うエグゼキュータ.
+    address を指定しない場合はローカルに Ray を起動する (テスト用).
+    memory はタスクごとの必要メモリとして Ray のスケジューラに渡す.
+    """
+
+    def __init__(self, address=None, max_workers=8, retries=1, memory=None):
+        import ray
+
+        self.ray = ray
+        if not ray.is_initialized():
+            if address:
+                ray.init(address=address)
+            else:
+                ray.init(num_cpus=max_workers)
+        self.retries = retries
+        self.memory = parse_memory(memory)
+
+    def run(self, fn, tasks, keys=None):
+        options = {"max_retries": self.retries}
+        if self.memory:
+            options["memory"] = self.memory
+        remote_fn = self.ray.remote(**options)(fn)
+        pending = [remote_fn.remote(*args, **kwargs) for args, kwargs in tasks]
+        while pending:
+            done, pending = self.ray.wait(pending, num_returns=1)
+            yield self.ray.get(done[0])
+
+    def close(self):
+        self.ray.shutdown()
+
+
+def get_executor(
+    backend="local", address=None, max_workers=8, retries=1, memory=None, cache_size=2
+):
+    """
+    backend (local, affinity, dask, ray) に応じたエグゼキュータを返す.
+    """
+    if backend == "local":
+        return LocalExecutor(max_workers, retries, cache_size)
+    if backend == "affinity":
+        return AffinityExecutor(max_workers, retries, cache_size)
+    if backend == "dask":
+        return DaskExecutor(address, max_workers, retries, memory)
+    if backend == "ray":
+        return RayExecutor(address, max_workers, retries, memory)
+    raise ValueError(f"未対応のバックエンドです: {backend}")
+
+
+def add_executor_arguments(parser, max_workers=8):
+    """
+    エグゼキュータのコマンドライン引数を parser に追加する.
+    """
+    parser.add_argument(
+        "--executor",
+        type=str,
+        choices=BACKENDS,
+        default="local",
+        help="Executor backend for processing pairs",
+    )
+    parser.add_argument(
+        "--address",
+        type=str,
+        default=None,
+        help="Scheduler address for dask/ray (default: start a local cluster)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=max_workers, help="Number of local workers"
+    )
+    parser.add_argument(
+        "--retries", type=int, default=1, help="Retries when a worker fails"
+    )
+    parser.add_argument(
+        "--task_memory",
+        type=str,
+        default=None,
+        help="Memory hint per task for the scheduler (e.g. 8GB)",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=2,
+        help="Granules whose handles and GLT are cached per local/affinity worker",
+    )
+
+
+def executor_from_args(args):
+    return get_executor(
+        args.executor,
+        address=args.address,
+        max_workers=args.workers,
+        retries=args.retries,
+        memory=args.task_memory,
+        cache_size=args.cache_size,
+    )
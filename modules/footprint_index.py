@@ -0,0 +1,133 @@
+"""
+プルームの geojson のフットプリントの空間インデックス (STRtree) を作成・保存するためのモジュール
+
+フットプリントは GeoParquet (footprints.parquet) にファイルの更新時刻・サイズとともに保存し,
+update では追加・更新されたファイルだけを読み直し, 削除されたファイルを取り除く.
+STRtree は保存したジオメトリから読み込み時に作り直す (GEOS 内で作成するため数万件でも数十ミリ秒).
+
+    index = FootprintIndex.update("data/dataset/geojsons", "data/dataset/footprints.parquet")
+    index.query_bbox(-105, 31, -103, 33)
+    index.query_granules(pairs["geometry_l2a"].values)
+"""
+
+import os
+import tempfile
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from footprints import load_footprints
+
+FOOTPRINT_INDEX_NAME = "footprints.parquet"
+
+
+class FootprintIndex:
+    """
+    フットプリントの GeoDataFrame (load_footprints の列 + mtime_ns, size) とその STRtree.
+    """
+
+    def __init__(self, footprints):
+        self.footprints = footprints.reset_index(drop=True)
+        self.geometries = self.footprints.geometry.values
+        self._tree = None
+
+    def __len__(self):
+        return len(self.footprints)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = shapely.STRtree(self.geometries)
+        return self._tree
+
+    @classmethod
+    def load(cls, path):
+        return cls(gpd.read_parquet(path))
+
+    def save(self, path):
+        # 書き込み途中のファイルを他のプロセスが読まないように, 一時ファイルから置き換える
+        # 一時ファイルの名前は保存ごとに変え, 同時に保存するプロセス (ノード) の書き込みが混ざらないようにする
+        path = Path(path)
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, prefix=f"{path.name}.", suffix=".tmp", delete=False
+        ) as f:
+            tmp = Path(f.name)
+        try:
+            self.footprints.to_parquet(tmp, index=False)
+            tmp.replace(path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+    @classmethod
+    def update(cls, geojson_dir, path=None):
+        """
+        geojson_dir の geojson からインデックスを作成する.
+        path に保存済みのインデックスがある場合は, 追加・更新されたファイルだけを読み直す. path を指定した場合は保存する.
+        """
+        geojson_dir = Path(geojson_dir)
+        stats = {file.name: os.stat(file) for file in geojson_dir.glob("*.json")}
+        kept = None
+        if path is not None and Path(path).exists():
+            previous = gpd.read_parquet(path)
+            # 更新時刻・サイズが変わっていないファイルは保存したフットプリントを使う
+            unchanged = [
+                name in stats
+                and stats[name].st_mtime_ns == mtime_ns
+                and stats[name].st_size == size
+                for name, mtime_ns, size in zip(
+                    previous["name"], previous["mtime_ns"], previous["size"]
+                )
+            ]
+            kept = previous[np.array(unchanged, dtype=bool)]
+        kept_names = set() if kept is None else set(kept["name"])
+        changed = [
+            geojson_dir / name for name in sorted(stats) if name not in kept_names
+        ]
+
+        loaded = load_footprints(geojson_dir, files=changed)
+        # 読み込むファイルが無い場合も float にならないように int64 にする
+        for column in ["mtime_ns", "size"]:
+            attr = f"st_{column}"
+            loaded[column] = np.array(
+                [getattr(stats[name], attr) for name in loaded["name"]], dtype=np.int64
+            )
+        footprints = loaded
+        if kept is not None and len(kept):
+            footprints = pd.concat([kept, loaded], ignore_index=True)
+        print(
+            f"フットプリントのインデックス: {len(footprints)} 件 "
+            f"({len(kept_names)} 件は保存済み, {len(changed)} 件を読み込み)"
+        )
+        index = cls(footprints)
+        if path is not None:
+            index.save(path)
+        return index
+
+    def _frame(self, indices):
+        return self.footprints.iloc[np.sort(np.unique(indices))]
+
+    def query_bbox(self, minx, miny, maxx, maxy):
+        """
+        bbox と交差するフットプリントを返す.
+        """
+        return self.query_polygon(shapely.box(minx, miny, maxx, maxy))
+
+    def query_polygon(self, polygon, predicate="intersects"):
+        """
+        polygon (shapely のジオメトリ) と predicate の関係にあるフットプリントを返す.
+        """
+        return self._frame(self.tree.query(polygon, predicate=predicate))
+
+    def query_granules(self, granule_geoms, predicate="intersects"):
+        """
+        グラニュールのフットプリント (ジオメトリの配列) と交差するフットプリントの組を返す.
+
+        Returns:
+        granule_idx: granule_geoms のインデックスの配列
+        fp_idx: 対応する footprints の行番号の配列
+        """
+        return self.tree.query(granule_geoms, predicate=predicate)
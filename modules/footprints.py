@@ -0,0 +1,83 @@
+"""
+プルームの geojson ファイルからフットプリント (ジオメトリと bbox) を読み込むためのモジュール
+"""
+
+import json
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+
+def feature_geometries(file):
+    """
+    geojson ファイル内のジオメトリを持つフィーチャのジオメトリを GeoJSON の文字列のリストで返す.
+    """
+    data = json.loads(Path(file).read_text(encoding="utf-8"))
+    return [
+        json.dumps(feature["geometry"])
+        for feature in data.get("features", [])
+        if feature.get("geometry")
+    ]
+
+
+def _union(geoms):
+    # 1つだけの場合は結合しない (ほとんどの geojson はフィーチャが1つ)
+    return geoms[0] if len(geoms) == 1 else shapely.union_all(geoms)
+
+
+def read_footprint(file):
+    """
+    geojson ファイル内の全フィーチャのジオメトリを結合して返す.
+    フィーチャが無い場合は None を返す.
+    """
+    geoms = shapely.from_geojson(feature_geometries(file))
+    if not len(geoms):
+        return None
+    return _union(geoms)
+
+
+def load_footprints(geojson_dir, files=None):
+    """
+    geojson_dir 内の geojson ファイル (files を指定した場合はそのファイルのみ) のフットプリントを GeoDataFrame として返す.
+
+    列: geojson_id, name, minx, miny, maxx, maxy, geometry
+    """
+    if files is None:
+        files = Path(geojson_dir).glob("*.json")
+    read_files, strings, counts = [], [], []
+    for file in files:
+        file = Path(file)
+        try:
+            geometries = feature_geometries(file)
+        except Exception as e:
+            print(f"{file} の読み込みに失敗: {e}")
+            continue
+        if not geometries:
+            continue
+        read_files.append(file)
+        strings.extend(geometries)
+        counts.append(len(geometries))
+
+    # 全ファイルのジオメトリをまとめて変換し, ファイルごとに結合する
+    geoms = shapely.from_geojson(np.array(strings, dtype=object), on_invalid="ignore")
+    groups = np.split(geoms, np.cumsum(counts)[:-1]) if counts else []
+    records = []
+    for file, group in zip(read_files, groups):
+        group = group[~shapely.is_missing(group)]
+        if not len(group):
+            print(f"{file} の読み込みに失敗: 不正なジオメトリです")
+            continue
+        records.append(
+            {"geojson_id": file.stem, "name": file.name, "geometry": _union(group)}
+        )
+
+    footprints = gpd.GeoDataFrame(
+        records, columns=["geojson_id", "name", "geometry"], crs="EPSG:4326"
+    )
+    # bbox は shapely 2 でまとめて計算する
+    footprints[["minx", "miny", "maxx", "maxy"]] = shapely.bounds(
+        footprints.geometry.values
+    )
+    return footprints
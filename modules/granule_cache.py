@@ -0,0 +1,149 @@
+"""
+ワーカープロセスごとに開いた L2A の netCDF と GLT 配列を保持するキャッシュ
+
+同じ L2A シーンを共有するプルームを同じワーカーで続けて処理すると,
+emit_xarray の netCDF のオープン (root, location, sensor_band_parameters) と GLT の読み込みを1回で済ませられる.
+キャッシュのキーはファイル名に含まれるグラニュール ID (含まれない場合はファイルのパス).
+"""
+
+import re
+from collections import OrderedDict
+from pathlib import Path
+
+from emit_tools import ds_glt_array, glt_index, open_group
+from h5_mmap import open_group_mmap
+
+GRANULE_NAME_PATTERN = r"EMIT_L2A_RFL_\d{3}_\d{8}T\d{6}_\d{7}_\d{3}"
+ORBIT_NAME_PATTERN = r"EMIT_L2A_RFL_\d{3}_\d{8}T\d{6}_(?P<orbit>\d{7})_\d{3}"
+
+_cache = None
+
+
+def granule_key(filepath):
+    """
+    filepath のキャッシュのキー (グラニュール ID, 見つからない場合はパス) を返す.
+    """
+    match = re.search(GRANULE_NAME_PATTERN, Path(filepath).name)
+    return match.group(0) if match else str(Path(filepath).resolve())
+
+
+def orbit_key(filepath):
+    """
+    filepath のワーカー割り当てのキー (軌道番号, 見つからない場合は granule_key) を返す.
+    同じ軌道のシーン (隣接シーンを含む) を同じワーカーに集め, 開いたファイルと GLT を使い回す.
+    """
+    match = re.search(ORBIT_NAME_PATTERN, Path(filepath).name)
+    return match.group("orbit") if match else granule_key(filepath)
+
+
+class LRUCache:
+    """
+    最大 maxsize 個の値を保持する LRU キャッシュ. 追い出した値は on_evict に渡す.
+    """
+
+    def __init__(self, maxsize, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, factory):
+        """
+        key の値を返す. キャッシュにない場合は factory() で作成して追加する.
+        """
+        if key in self.items:
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+        self.misses += 1
+        value = factory()
+        self.items[key] = value
+        while len(self.items) > self.maxsize:
+            _, evicted = self.items.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(evicted)
+        return value
+
+    def clear(self):
+        while self.items:
+            _, evicted = self.items.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(evicted)
+
+
+class GranuleCache:
+    """
+    グラニュールごとの netCDF のハンドルと GLT 配列を保持するキャッシュ.
+    maxsize はハンドルを保持するグラニュール数 (GLT はグラニュールごとに1つなので同じ数だけ保持する).
+    memmap で開けないファイルでは読み込んだ反射率がハンドルに残るため, maxsize に比例してメモリを使う.
+    """
+
+    def __init__(self, maxsize=2):
+        self.handles = LRUCache(maxsize * 3, on_evict=lambda ds: ds.close())
+        self.glts = LRUCache(maxsize)
+        self.indexes = LRUCache(maxsize)
+
+    def open_group(self, filepath, group=None):
+        """
+        emit_xarray の opener として使う. 同じグラニュールのグループは開いたものを返す.
+        ローカルのファイルは open_group_mmap で開く.
+        """
+        key = (granule_key(filepath), group)
+        return self.handles.get(key, lambda: local_opener(filepath)(filepath, group))
+
+    def glt(self, filepath, ds, GLT_NODATA_VALUE=0):
+        """
+        ds (emit_xarray(ortho=False) の結果) の GLT 配列 (ds_glt_array) を返す.
+        """
+        return self.glts.get(
+            granule_key(filepath),
+            lambda: ds_glt_array(ds, GLT_NODATA_VALUE=GLT_NODATA_VALUE),
+        )
+
+    def glt_index(self, filepath, ds, GLT_NODATA_VALUE=0):
+        """
+        ds の GLT を glt_index で復号した (valid, rows, cols) を返す (ortho_browse などで使う).
+        """
+        return self.indexes.get(
+            granule_key(filepath),
+            lambda: glt_index(
+                self.glt(filepath, ds, GLT_NODATA_VALUE),
+                GLT_NODATA_VALUE=GLT_NODATA_VALUE,
+            ),
+        )
+
+    def stats(self):
+        return {
+            "handle_hits": self.handles.hits,
+            "handle_misses": self.handles.misses,
+            "glt_hits": self.glts.hits,
+            "glt_misses": self.glts.misses,
+        }
+
+    def close(self):
+        self.handles.clear()
+        self.glts.clear()
+        self.indexes.clear()
+
+
+def local_opener(filepath):
+    """
+    filepath がローカルのパスの場合は open_group_mmap を, ファイルオブジェクトの場合は open_group を返す.
+    """
+    return open_group_mmap if isinstance(filepath, (str, Path)) else open_group
+
+
+def init_worker(maxsize=2):
+    """
+    ワーカープロセスの initializer. このプロセスで使う GranuleCache を作成する.
+    """
+    global _cache
+    _cache = GranuleCache(maxsize)
+
+
+def current_cache():
+    """
+    init_worker で作成したキャッシュを返す. 作成していないプロセスでは None を返す.
+    """
+    return _cache
@@ -0,0 +1,211 @@
+"""
+EMITL2ARFL と EMITL2BCH4PLM のグラニュールを対応付けるためのモジュール
+
+results_to_geopandas の出力を取得時刻と軌道/シーン番号でインデックス化し,
+許容誤差付きの merge_asof で日付範囲内のグラニュールを一括してペアにする.
+"""
+
+from pathlib import Path
+
+import earthaccess
+import pandas as pd
+
+from mosaic import adjacent_granules
+from tutorial_utils import results_to_geopandas
+
+EMITL2ARFL_CONCEPT_ID = "C2408750690-LPCLOUD"
+EMITL2BCH4PLM_CONCEPT_ID = "C2748088093-LPCLOUD"
+EMITL2BCH4ENH_CONCEPT_ID = "C2748097305-LPCLOUD"
+
+# L2B のプロダクトごとの検索・インデックス作成の設定
+# CH4PLM の native-id は軌道番号・シーン番号を持たないため, match_scene には CH4ENH を使う
+L2B_PRODUCTS = {
+    "CH4PLM": {
+        "concept_id": EMITL2BCH4PLM_CONCEPT_ID,
+        "asset": "L2B_CH4PLM",
+        "time_column": "_single_date_time",
+    },
+    "CH4ENH": {
+        "concept_id": EMITL2BCH4ENH_CONCEPT_ID,
+        "asset": "L2B_CH4ENH",
+        "time_column": "_beginning_date_time",
+    },
+}
+
+# EMIT_L2A_RFL_001_20241020T170504_2429411_003 のような native-id から
+# 取得時刻・軌道番号・シーン番号を取り出す (CH4PLM のようにシーン番号を持たないものは NaN)
+GRANULE_ID_PATTERN = r"_(?P<acquired>\d{8}T\d{6})_(?P<orbit>\d{7})_(?P<scene>\d{3})$"
+
+
+def parse_granule_ids(native_ids: pd.Series) -> pd.DataFrame:
+    """
+    native-id の列から acquired, orbit, scene の列を持つ DataFrame を返す.
+    パターンに一致しない行は NaN になる.
+    """
+    parts = native_ids.astype(str).str.extract(GRANULE_ID_PATTERN)
+    parts["acquired"] = pd.to_datetime(
+        parts["acquired"], format="%Y%m%dT%H%M%S", utc=True
+    )
+    # L2A と L2B で dtype が揃うように (欠損があっても) nullable な Int64 にする
+    parts["orbit"] = pd.to_numeric(parts["orbit"]).astype("Int64")
+    parts["scene"] = pd.to_numeric(parts["scene"]).astype("Int64")
+    return parts
+
+
+def extract_asset_urls(df, asset, key="Type", value="GET DATA"):
+    """
+    _related_urls 列から asset (RFL, CH4PLM など) のURLをまとめて取り出す.
+    get_asset_url と同じ条件で, 一致しない行は NaN になる.
+    """
+    asset = f"_{asset}_"
+    links = df["_related_urls"].explode().dropna()
+    if links.empty:
+        return pd.Series(index=df.index, dtype=object)
+    entries = pd.DataFrame(links.tolist(), index=links.index)
+    filenames = entries["URL"].str.rsplit("/", n=1).str[-1]
+    matched = (entries[key] == value) & filenames.str.contains(asset, regex=False)
+    urls = entries.loc[matched, "URL"].groupby(level=0).first()
+    return urls.reindex(df.index)
+
+
+def build_granule_index(results_gdf, time_column, asset):
+    """
+    ペア作成用に, 時刻でソートされたグラニュールのインデックスを作成する.
+    時刻の書式の違い (小数秒の有無など) は UTC の datetime に揃えて吸収する.
+    """
+    gdf = results_gdf.reset_index(drop=True)
+    index = parse_granule_ids(gdf["native-id"])
+    # 時刻の列が欠けている場合は native-id の取得時刻を使用
+    times = gdf[time_column] if time_column in gdf else pd.Series(pd.NaT, gdf.index)
+    index["time"] = pd.to_datetime(times, utc=True, format="ISO8601", errors="coerce")
+    index["time"] = index["time"].fillna(index["acquired"])
+    index["timestamp"] = gdf[time_column] if time_column in gdf else index["time"]
+    index["native_id"] = gdf["native-id"]
+    index["url"] = extract_asset_urls(gdf, asset)
+    index["cloud_cover"] = gdf["_cloud_cover"] if "_cloud_cover" in gdf else None
+    index["geometry"] = gdf.geometry
+    index = index.dropna(subset=["time", "url"])
+    return index.sort_values("time", kind="stable").reset_index(drop=True)
+
+
+def pair_granules(
+    l2a_results_gdf,
+    l2b_results_gdf,
+    tolerance="1s",
+    match_scene=False,
+    direction="nearest",
+    l2b_product="CH4PLM",
+):
+    """
+    L2B の各グラニュールに対して, 取得時刻が最も近い L2A グラニュールを対応付ける.
+
+    Parameters:
+    l2a_results_gdf, l2b_results_gdf: results_to_geopandas で作成した検索結果
+    tolerance: 対応付けを許容する時刻差 (pd.Timedelta に変換できる値)
+    match_scene: True の場合, 軌道番号とシーン番号が一致するものだけを対応付ける
+        (両方の native-id にシーン番号が含まれる CH4ENH などで使用する)
+    direction: merge_asof の direction
+    l2b_product: l2b_results_gdf のプロダクト (L2B_PRODUCTS のキー)
+
+    Returns:
+    pairs: 1行1ペアの DataFrame. L2A の雲量で昇順にソートされている.
+        L2B の URL の列は EMITL2B<l2b_product>_url (EMITL2BCH4PLM_url など)
+    """
+    product = L2B_PRODUCTS[l2b_product]
+    l2a = build_granule_index(l2a_results_gdf, "_beginning_date_time", "L2A_RFL")
+    l2b = build_granule_index(l2b_results_gdf, product["time_column"], product["asset"])
+
+    by = None
+    if match_scene:
+        by = ["orbit", "scene"]
+        l2a = l2a.dropna(subset=by)
+        l2b = l2b.dropna(subset=by)
+        if l2b.empty and not l2b_results_gdf.empty:
+            raise ValueError(
+                f"{l2b_product} の native-id に軌道番号・シーン番号が含まれていないため match_scene は使えません."
+            )
+
+    pairs = pd.merge_asof(
+        l2b,
+        l2a,
+        on="time",
+        by=by,
+        tolerance=pd.Timedelta(tolerance),
+        direction=direction,
+        suffixes=("_l2b", "_l2a"),
+    )
+    pairs = pairs.dropna(subset=["url_l2a"])
+    pairs = pairs.rename(
+        columns={
+            "timestamp_l2a": "timestamp",
+            "url_l2a": "EMITL2ARFL_url",
+            "url_l2b": f"EMITL2B{l2b_product}_url",
+        }
+    )
+    if "orbit" in pairs:
+        # match_scene の場合 orbit/scene は by のキーとして1列にまとまる
+        pairs = pairs.rename(columns={"orbit": "orbit_l2a", "scene": "scene_l2a"})
+    return pairs.sort_values("cloud_cover_l2a", kind="stable").reset_index(drop=True)
+
+
+def search_granules(date_range, polygon=None, count=-1, l2b_product="CH4PLM"):
+    """
+    date_range (と polygon) で EMITL2ARFL, L2B (l2b_product, 既定は EMITL2BCH4PLM) をまとめて検索し,
+    それぞれの検索結果を geopandas で返す.
+    """
+    search_kwargs = {"temporal": date_range, "count": count}
+    if polygon is not None:
+        search_kwargs["polygon"] = polygon
+    results = []
+    l2b_concept_id = L2B_PRODUCTS[l2b_product]["concept_id"]
+    for concept_id in (EMITL2ARFL_CONCEPT_ID, l2b_concept_id):
+        granules = earthaccess.search_data(concept_id=concept_id, **search_kwargs)
+        results.append(results_to_geopandas(granules, fields=["_cloud_cover"]))
+    return tuple(results)
+
+
+def pair_date_range(
+    date_range, polygon=None, tolerance="1s", match_scene=False, l2b_product=None
+):
+    """
+    date_range 内のグラニュールを一括で検索してペアにする.
+    l2b_product を指定しない場合, match_scene では CH4ENH, それ以外は CH4PLM と対応付ける.
+    """
+    if l2b_product is None:
+        l2b_product = "CH4ENH" if match_scene else "CH4PLM"
+    l2a_results_gdf, l2b_results_gdf = search_granules(
+        date_range, polygon, l2b_product=l2b_product
+    )
+    if l2a_results_gdf.empty or l2b_results_gdf.empty:
+        return pd.DataFrame(
+            columns=["timestamp", "EMITL2ARFL_url", f"EMITL2B{l2b_product}_url"]
+        )
+    return pair_granules(
+        l2a_results_gdf,
+        l2b_results_gdf,
+        tolerance=tolerance,
+        match_scene=match_scene,
+        l2b_product=l2b_product,
+    )
+
+
+def search_adjacent_l2a(l2a_url, window="2min"):
+    """
+    l2a_url のグラニュールと同じ軌道で隣り合う EMITL2ARFL のシーンの URL を返す.
+    取得時刻の前後 window の範囲だけを検索する.
+    """
+    acquired = parse_granule_ids(pd.Series([Path(l2a_url).stem]))["acquired"][0]
+    if pd.isna(acquired):
+        return []
+    window = pd.Timedelta(window)
+    temporal = tuple(
+        t.strftime("%Y-%m-%dT%H:%M:%SZ") for t in (acquired - window, acquired + window)
+    )
+    granules = earthaccess.search_data(
+        concept_id=EMITL2ARFL_CONCEPT_ID, temporal=temporal, count=-1
+    )
+    results_gdf = results_to_geopandas(granules)
+    if results_gdf.empty:
+        return []
+    index = build_granule_index(results_gdf, "_beginning_date_time", "L2A_RFL")
+    return adjacent_granules(l2a_url, index["url"].tolist())
@@ -0,0 +1,96 @@
+"""
+ローカルの netCDF (HDF5) の変数を np.memmap で読み込むためのモジュール
+
+圧縮されていない連続 (contiguous) レイアウトの変数は, ファイル内のバイトオフセットから np.memmap のビューを作り,
+インデックスした範囲だけをページインする (ortho_window の GLT の範囲の読み込みなど).
+チャンク化・圧縮されている変数は従来通り h5netcdf (h5py) のチャンク単位の読み込みを使う.
+"""
+
+import numpy as np
+from lazy_import import lazy_module
+
+xr = lazy_module("xarray")
+h5py = lazy_module("h5py")
+
+
+def contiguous_layout(dset):
+    """
+    h5py の Dataset が memmap できる (連続・非圧縮・フィルタなし・領域確保済み) 場合は (offset, dtype, shape) を返す.
+    できない場合は None を返す.
+    """
+    if dset is None or not isinstance(dset, h5py.Dataset):
+        return None
+    if dset.chunks is not None or dset.id.get_create_plist().get_nfilters() > 0:
+        return None
+    if dset.id.get_create_plist().get_external_count() > 0:
+        return None
+    if dset.dtype.kind not in "biuf" or dset.size == 0:
+        return None
+    offset = dset.id.get_offset()
+    if offset is None:
+        return None
+    return offset, dset.dtype, dset.shape
+
+
+def _memmap_array_class():
+    # xarray の import を遅らせるため, BackendArray のサブクラスは最初に使う時に作る
+    from xarray.backends import BackendArray
+    from xarray.core import indexing
+
+    class MemmapArray(BackendArray):
+        """
+        ファイルの offset からの np.memmap を xarray の遅延読み込みの配列として扱う.
+        """
+
+        def __init__(self, filepath, offset, dtype, shape):
+            self.filepath = filepath
+            self.offset = offset
+            self.dtype = np.dtype(dtype)
+            self.shape = tuple(shape)
+            self._memmap = None
+
+        def _open(self):
+            if self._memmap is None:
+                self._memmap = np.memmap(
+                    self.filepath,
+                    dtype=self.dtype,
+                    mode="r",
+                    offset=self.offset,
+                    shape=self.shape,
+                )
+            return self._memmap
+
+        def __getitem__(self, key):
+            return indexing.explicit_indexing_adapter(
+                key, self.shape, indexing.IndexingSupport.OUTER_1VECTOR, self._getitem
+            )
+
+        def _getitem(self, key):
+            # インデックスした範囲だけをページインしてコピーする
+            return np.asarray(self._open()[key])
+
+    return MemmapArray, indexing.LazilyIndexedArray
+
+
+def open_group_mmap(filepath, group=None):
+    """
+    emit_tools.open_group と同じ Dataset を返す. 連続・非圧縮の変数は memmap で読み込む.
+    emit_xarray の opener に指定して使う.
+    """
+    MemmapArray, LazilyIndexedArray = _memmap_array_class()
+    filepath = str(filepath)
+    raw = xr.open_dataset(filepath, engine="h5netcdf", group=group, decode_cf=False)
+    replaced = {}
+    with h5py.File(filepath, "r") as f:
+        h5group = f[group] if group else f
+        for name, var in raw.variables.items():
+            # インデックスの座標は open_dataset の時点で読み込まれている
+            if name in raw.indexes:
+                continue
+            layout = contiguous_layout(h5group.get(name))
+            if layout is None:
+                continue
+            array = LazilyIndexedArray(MemmapArray(filepath, *layout))
+            replaced[name] = xr.Variable(var.dims, array, var.attrs, var.encoding)
+    # CF の復号 (_FillValue, scale_factor など) は open_dataset と同じく遅延して適用する
+    return xr.decode_cf(raw.assign(replaced) if replaced else raw)
@@ -0,0 +1,259 @@
+"""
+リモートの netCDF (HDF5) のチャンク化された変数を, 必要なチャンクだけまとめて取得するためのモジュール
+
+h5netcdf でリモートのファイルオブジェクトから読むと, チャンクごとに小さな読み込みが順番に発生し, 遅延が支配的になる.
+ここでは HDF5 のチャンクインデックスから, 読み込む範囲 (ortho_window の生データの範囲とバンド) に必要なチャンクの
+バイト範囲を求め, 近いものをまとめて Transport.fetch_ranges で並列に取得してから展開する.
+
+open_group_planned は emit_tools.open_group と同じ Dataset を返し, 対応するフィルタ (deflate, shuffle, fletcher32)
+のみを使うチャンク化された変数をこの方法で読み込む. それ以外の変数は h5netcdf で読み込む.
+"""
+
+import zlib
+from itertools import product
+
+import numpy as np
+from lazy_import import lazy_module
+
+xr = lazy_module("xarray")
+h5py = lazy_module("h5py")
+
+# HDF5 のフィルタ ID
+H5Z_FILTER_DEFLATE = 1
+H5Z_FILTER_SHUFFLE = 2
+H5Z_FILTER_FLETCHER32 = 3
+SUPPORTED_FILTERS = {H5Z_FILTER_DEFLATE, H5Z_FILTER_SHUFFLE, H5Z_FILTER_FLETCHER32}
+
+# この間隔 (バイト) 以下しか離れていない範囲は1つのリクエストにまとめる
+DEFAULT_MAX_GAP = 256 * 2**10
+
+
+class ChunkIndex:
+    """
+    チャンク化された HDF5 の Dataset のチャンクの位置 (論理的な先頭座標 -> (byte_offset, size, filter_mask)) とフィルタ.
+    """
+
+    def __init__(self, dset):
+        self.shape = dset.shape
+        self.dtype = dset.dtype
+        self.chunk_shape = dset.chunks
+        self.fillvalue = dset.fillvalue
+        plist = dset.id.get_create_plist()
+        self.filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+        self.chunks = {}
+
+        def add(info):
+            self.chunks[tuple(info.chunk_offset)] = (
+                info.byte_offset,
+                info.size,
+                info.filter_mask,
+            )
+
+        if hasattr(dset.id, "chunk_iter"):
+            dset.id.chunk_iter(add)
+        else:
+            for i in range(dset.id.get_num_chunks()):
+                add(dset.id.get_chunk_info(i))
+
+    @classmethod
+    def from_dataset(cls, dset):
+        """
+        dset がチャンク化されていて, 対応するフィルタのみを使う場合は ChunkIndex を, それ以外は None を返す.
+        """
+        if dset is None or not isinstance(dset, h5py.Dataset) or dset.chunks is None:
+            return None
+        plist = dset.id.get_create_plist()
+        filters = {plist.get_filter(i)[0] for i in range(plist.get_nfilters())}
+        if not filters <= SUPPORTED_FILTERS or dset.dtype.kind not in "biuf":
+            return None
+        return cls(dset)
+
+
+def plan_chunks(index, selection):
+    """
+    selection (軸ごとの昇順のインデックス配列) を含むチャンクの先頭座標のリストを返す.
+    """
+    per_axis = [
+        np.unique(np.asarray(axis) // size) * size
+        for axis, size in zip(selection, index.chunk_shape)
+    ]
+    return [tuple(int(v) for v in origin) for origin in product(*per_axis)]
+
+
+def coalesce(ranges, max_gap=DEFAULT_MAX_GAP):
+    """
+    (start, end) の範囲を並べ替え, max_gap 以下の間隔のものを1つにまとめる.
+
+    Returns:
+    merged: まとめた (start, end) のリスト
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] <= max_gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(r) for r in merged]
+
+
+def fetch_chunks(index, origins, fetch, max_gap=DEFAULT_MAX_GAP):
+    """
+    origins のチャンクの生のバイト列を取得する. 割り当てられていないチャンクは None にする.
+
+    fetch: (start, end) のリストを受け取り bytes のリストを返す関数 (Transport.fetch_ranges など)
+    """
+    stored = {o: index.chunks[o] for o in origins if o in index.chunks}
+    ranges = coalesce(
+        [(offset, offset + size) for offset, size, _ in stored.values()], max_gap
+    )
+    blocks = fetch(ranges)
+    starts = np.array([start for start, _ in ranges])
+    raw = {}
+    for origin, (offset, size, _) in stored.items():
+        # チャンクを含むまとめた範囲から切り出す
+        k = np.searchsorted(starts, offset, side="right") - 1
+        begin = offset - ranges[k][0]
+        raw[origin] = bytes(blocks[k][begin : begin + size])
+    return {origin: raw.get(origin) for origin in origins}
+
+
+def unshuffle(buffer, itemsize):
+    """
+    HDF5 の shuffle フィルタを元に戻す.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    n = data.size // itemsize
+    body = data[: n * itemsize].reshape(itemsize, n).T.reshape(-1)
+    return body.tobytes() + data[n * itemsize :].tobytes()
+
+
+def decode_chunk(index, raw, filter_mask):
+    """
+    チャンクの生のバイト列をフィルタの逆順に展開し, chunk_shape の配列にする.
+    filter_mask の i ビット目が立っているフィルタはこのチャンクには適用されていない.
+    """
+    if raw is None:
+        return np.full(index.chunk_shape, index.fillvalue, dtype=index.dtype)
+    for i, filter_id in reversed(list(enumerate(index.filters))):
+        if filter_mask & (1 << i):
+            continue
+        if filter_id == H5Z_FILTER_FLETCHER32:
+            raw = raw[:-4]
+        elif filter_id == H5Z_FILTER_SHUFFLE:
+            raw = unshuffle(raw, index.dtype.itemsize)
+        elif filter_id == H5Z_FILTER_DEFLATE:
+            raw = zlib.decompress(raw)
+    return np.frombuffer(raw, dtype=index.dtype).reshape(index.chunk_shape)
+
+
+def read_selection(index, selection, fetch, max_gap=DEFAULT_MAX_GAP):
+    """
+    selection (軸ごとの昇順のインデックス配列) の値を, 必要なチャンクだけ取得して読み込む.
+    """
+    selection = [np.asarray(axis, dtype=np.int64) for axis in selection]
+    shape = tuple(axis.size for axis in selection)
+    if 0 in shape:
+        return np.empty(shape, dtype=index.dtype)
+    # selection の外接範囲をチャンクで埋めてから, 選択したインデックスを取り出す
+    lows = [int(axis.min()) for axis in selection]
+    highs = [int(axis.max()) + 1 for axis in selection]
+    box = np.empty([h - l for l, h in zip(lows, highs)], dtype=index.dtype)
+
+    origins = plan_chunks(index, selection)
+    raw = fetch_chunks(index, origins, fetch, max_gap)
+    for origin in origins:
+        filter_mask = index.chunks.get(origin, (0, 0, 0))[2]
+        chunk = decode_chunk(index, raw[origin], filter_mask)
+        src, dst = [], []
+        for o, size, low, high, length in zip(
+            origin, index.chunk_shape, lows, highs, index.shape
+        ):
+            start, stop = max(o, low), min(o + size, high, length)
+            src.append(slice(start - o, stop - o))
+            dst.append(slice(start - low, stop - low))
+        box[tuple(dst)] = chunk[tuple(src)]
+    return box[np.ix_(*[axis - low for axis, low in zip(selection, lows)])]
+
+
+def _planned_array_class():
+    # xarray の import を遅らせるため, BackendArray のサブクラスは最初に使う時に作る
+    from xarray.backends import BackendArray
+    from xarray.core import indexing
+
+    class PlannedArray(BackendArray):
+        """
+        インデックスした範囲に必要なチャンクだけを read_selection で読み込む xarray の遅延読み込みの配列.
+        """
+
+        def __init__(self, index, fetch, max_gap=DEFAULT_MAX_GAP):
+            self.index = index
+            self.fetch = fetch
+            self.max_gap = max_gap
+            self.shape = index.shape
+            self.dtype = index.dtype
+
+        def __getitem__(self, key):
+            return indexing.explicit_indexing_adapter(
+                key, self.shape, indexing.IndexingSupport.OUTER, self._getitem
+            )
+
+        def _getitem(self, key):
+            selection, squeeze = [], []
+            for axis, (k, length) in enumerate(zip(key, self.shape)):
+                if isinstance(k, slice):
+                    selection.append(np.arange(length)[k])
+                elif np.ndim(k) == 0:
+                    selection.append(np.array([int(k) % length]))
+                    squeeze.append(axis)
+                else:
+                    selection.append(np.asarray(k) % length)
+            # チャンクの計画のために昇順にしてから, 指定された順序に戻す
+            order = [np.argsort(axis, kind="stable") for axis in selection]
+            data = read_selection(
+                self.index,
+                [axis[o] for axis, o in zip(selection, order)],
+                self.fetch,
+                self.max_gap,
+            )
+            data = data[np.ix_(*[np.argsort(o, kind="stable") for o in order])]
+            return data.squeeze(axis=tuple(squeeze)) if squeeze else data
+
+    return PlannedArray, indexing.LazilyIndexedArray
+
+
+def open_group_planned(filepath, group, fetch, max_gap=DEFAULT_MAX_GAP):
+    """
+    emit_tools.open_group と同じ Dataset を返す. 対応するチャンク化された変数は read_selection で読み込む.
+
+    filepath: メタデータを読むためのファイルオブジェクト (Transport.open の結果など)
+    fetch: (start, end) のリストを受け取り bytes のリストを返す関数
+    """
+    PlannedArray, LazilyIndexedArray = _planned_array_class()
+    raw = xr.open_dataset(filepath, engine="h5netcdf", group=group, decode_cf=False)
+    replaced = {}
+    with h5py.File(filepath, "r") as f:
+        h5group = f[group] if group else f
+        for name, var in raw.variables.items():
+            if name in raw.indexes:
+                continue
+            index = ChunkIndex.from_dataset(h5group.get(name))
+            if index is None:
+                continue
+            array = LazilyIndexedArray(PlannedArray(index, fetch, max_gap))
+            replaced[name] = xr.Variable(var.dims, array, var.attrs, var.encoding)
+    # CF の復号 (_FillValue, scale_factor など) は open_dataset と同じく遅延して適用する
+    return xr.decode_cf(raw.assign(replaced) if replaced else raw)
+
+
+def planned_opener(transport, url, max_gap=DEFAULT_MAX_GAP):
+    """
+    transport で url のチャンクを並列に取得する emit_xarray の opener を返す.
+    """
+
+    def fetch(ranges):
+        return transport.fetch_ranges(url, ranges)
+
+    def opener(filepath, group=None):
+        return open_group_planned(filepath, group, fetch, max_gap)
+
+    return opener
@@ -0,0 +1,269 @@
+"""
+L2B (CH4ENH, CH4PLM) の .npy からプルームのラベル (2値マスク) を作成するためのモジュール
+
+ラベルは1画素1ビットに詰めて .npz (bits, shape) として保存する.
+L2B の値そのものは SparseL2B でプルームの画素の連続区間 (ランレングス) と値だけを .npz に保存できる.
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+# ortho_scene の L2B の保存形式 (npy: 密な配列, sparse: SparseL2B の .npz)
+L2B_FORMATS = ("npy", "sparse")
+
+
+def binarize(l2b_data, threshold=None, nodata=-9999):
+    """
+    L2B のデータを1回の比較で2値化する.
+
+    threshold が None の場合は 0 以外を 1 に (labeling_L2BCH4ENH.py の従来の挙動),
+    指定した場合は threshold より大きい画素を 1 にする. nodata の画素は 0 とする.
+    """
+    if threshold is None:
+        mask = l2b_data != 0
+        if nodata is not None:
+            mask &= l2b_data != nodata
+    else:
+        # nodata (-9999) は threshold より小さいため比較だけで除外される
+        mask = l2b_data > threshold
+    return mask
+
+
+def pack_mask(mask):
+    """
+    2値マスクを1画素1ビットに詰める.
+    """
+    return np.packbits(mask, axis=None)
+
+
+def unpack_mask(bits, shape):
+    """
+    pack_mask で詰めたマスクを shape の bool 配列に戻す.
+    """
+    count = int(np.prod(shape))
+    return np.unpackbits(bits, count=count).reshape(shape).astype(bool)
+
+
+def save_packed_mask(path, mask):
+    np.savez(path, bits=pack_mask(mask), shape=np.array(mask.shape))
+
+
+def load_packed_mask(path):
+    with np.load(path) as data:
+        return unpack_mask(data["bits"], tuple(data["shape"]))
+
+
+def mask_runs(mask):
+    """
+    2値マスクを行優先で平坦化した連続区間 (start, length) の (N, 2) 配列にする.
+    """
+    flat = np.concatenate([[0], np.ravel(mask).view(np.int8), [0]])
+    edges = np.diff(flat)
+    starts = np.flatnonzero(edges == 1)
+    return np.stack([starts, np.flatnonzero(edges == -1) - starts], axis=-1)
+
+
+def runs_to_indices(runs):
+    """
+    mask_runs の連続区間を平坦化したインデックスの配列に戻す.
+    """
+    starts, lengths = runs[:, 0], runs[:, 1]
+    total = int(lengths.sum())
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(total, dtype=np.int64) + offsets
+
+
+class SparseL2B:
+    """
+    L2B の配列のうち, プルームの画素 (binarize で 0, nodata 以外) の連続区間と値,
+    nodata の画素の連続区間だけを保持する疎な表現. それ以外の画素は 0 とみなす.
+    dense() で元の配列と同じものに戻せるほか, 2次元のスライスで必要な範囲だけを密な配列にできる.
+
+        sparse = SparseL2B.from_dense(l2b_data)
+        sparse.save("gt/1.npz")
+        sparse = SparseL2B.load("gt/1.npz")
+        sparse.bbox, sparse.pixels(), sparse[10:74, 20:84]
+    """
+
+    def __init__(self, shape, runs, values, nodata_runs, nodata=-9999):
+        self.shape = tuple(int(n) for n in shape)
+        self.runs = np.asarray(runs, dtype=np.int64).reshape(-1, 2)
+        self.values = np.asarray(values)
+        self.nodata_runs = np.asarray(nodata_runs, dtype=np.int64).reshape(-1, 2)
+        self.nodata = nodata
+        self._indices = None
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @classmethod
+    def from_dense(cls, l2b_data, nodata=-9999):
+        l2b_data = np.asarray(l2b_data)
+        plume = binarize(l2b_data, nodata=nodata)
+        runs = mask_runs(plume)
+        values = l2b_data.ravel()[runs_to_indices(runs)]
+        nodata_runs = mask_runs(l2b_data == nodata) if nodata is not None else []
+        return cls(l2b_data.shape, runs, values, nodata_runs, nodata)
+
+    def save(self, path):
+        np.savez(
+            path,
+            shape=np.array(self.shape),
+            runs=self.runs,
+            values=self.values,
+            nodata_runs=self.nodata_runs,
+            nodata=np.array(np.nan if self.nodata is None else self.nodata),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            nodata = data["nodata"].item()
+            return cls(
+                data["shape"],
+                data["runs"],
+                data["values"],
+                data["nodata_runs"],
+                None if np.isnan(nodata) else nodata,
+            )
+
+    @property
+    def indices(self):
+        """
+        プルームの画素の平坦化したインデックス (values と同じ順).
+        """
+        if self._indices is None:
+            self._indices = runs_to_indices(self.runs)
+        return self._indices
+
+    @property
+    def plume_pixels(self):
+        return int(self.runs[:, 1].sum()) if len(self.runs) else 0
+
+    def pixels(self):
+        """
+        プルームの画素の (rows, cols, values) を返す.
+        """
+        rows, cols = np.divmod(self.indices, self.shape[1])
+        return rows, cols, self.values
+
+    @property
+    def bbox(self):
+        """
+        プルームの画素を囲む (row_start, col_start, row_stop, col_stop). プルームが無い場合は None.
+        """
+        if not len(self.runs):
+            return None
+        rows, cols, _ = self.pixels()
+        return (
+            int(rows.min()),
+            int(cols.min()),
+            int(rows.max()) + 1,
+            int(cols.max()) + 1,
+        )
+
+    def mask(self):
+        """
+        プルームの2値マスク (binarize の threshold=None と同じ) を返す.
+        """
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.ravel()[self.indices] = True
+        return mask
+
+    def dense(self):
+        out = np.zeros(self.shape, dtype=self.dtype)
+        flat = out.ravel()
+        if self.nodata is not None and len(self.nodata_runs):
+            flat[runs_to_indices(self.nodata_runs)] = self.nodata
+        flat[self.indices] = self.values
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.dense()
+        return out if dtype is None else out.astype(dtype)
+
+    def __getitem__(self, key):
+        """
+        (rows, cols) のスライスの範囲だけを密な配列にする (範囲外のプルームの画素は読み飛ばす).
+        整数, Ellipsis, 配列などスライス以外を含む key は密な配列にしてから numpy と同じように取り出す.
+        """
+        rows, cols = (
+            key if isinstance(key, tuple) and len(key) == 2 else (key, slice(None))
+        )
+        if not (isinstance(rows, slice) and isinstance(cols, slice)):
+            return self.dense()[key]
+        row_start, row_stop, row_step = rows.indices(self.shape[0])
+        col_start, col_stop, col_step = cols.indices(self.shape[1])
+        if row_step != 1 or col_step != 1:
+            return self.dense()[rows, cols]
+        height = max(row_stop - row_start, 0)
+        width = max(col_stop - col_start, 0)
+        out = np.zeros((height, width), dtype=self.dtype)
+
+        def fill(indices, values):
+            r, c = np.divmod(indices, self.shape[1])
+            inside = (
+                (r >= row_start) & (r < row_stop) & (c >= col_start) & (c < col_stop)
+            )
+            values = values[inside] if np.ndim(values) else values
+            out[r[inside] - row_start, c[inside] - col_start] = values
+
+        if self.nodata is not None and len(self.nodata_runs):
+            fill(runs_to_indices(self.nodata_runs), self.nodata)
+        fill(self.indices, self.values)
+        return out
+
+
+def is_sparse_l2b(path):
+    """
+    path の .npz が SparseL2B (ラベルの .npz ではない) かを返す.
+    """
+    with np.load(path) as data:
+        return "runs" in data.files
+
+
+def find_l2b_files(directory):
+    """
+    directory の L2B のファイル (.npy と SparseL2B の .npz) を返す. ラベルの .npz は含めない.
+    """
+    paths = Path(directory).glob("*.np[yz]")
+    return sorted(
+        path for path in paths if path.suffix == ".npy" or is_sparse_l2b(path)
+    )
+
+
+def open_l2b(path):
+    """
+    L2B を開く. .npy は memmap, SparseL2B の .npz は SparseL2B で返す (どちらも2次元のスライスで読める).
+    """
+    if Path(path).suffix == ".npz":
+        return SparseL2B.load(path)
+    return np.load(path, mmap_mode="r")
+
+
+def label_file(l2b_path, outdir, threshold=None, nodata=-9999):
+    """
+    L2B の .npy をメモリマップで (SparseL2B の .npz はプルームの画素から) 読み込んでラベルを作成し, outdir/<id>.npz に保存する.
+
+    Returns:
+    record: id, height, width, plume_pixels を持つ辞書
+    """
+    l2b_path = Path(l2b_path)
+    l2b_data = open_l2b(l2b_path)
+    if isinstance(l2b_data, SparseL2B) and threshold is None:
+        mask = l2b_data.mask()
+    else:
+        mask = binarize(np.asarray(l2b_data), threshold, nodata)
+    save_packed_mask(Path(outdir) / f"{l2b_path.stem}.npz", mask)
+    return {
+        "id": l2b_path.stem,
+        "height": mask.shape[0],
+        "width": mask.shape[-1],
+        "plume_pixels": int(np.count_nonzero(mask)),
+    }
@@ -0,0 +1,40 @@
+"""
+重い依存パッケージを最初に使われるまで import しないためのモジュール
+
+    xr = lazy_module("xarray", "rioxarray")
+
+のように書くと, xr の属性に最初にアクセスした時点で xarray (と rioxarray) を import する.
+"""
+
+import importlib
+
+
+class LazyModule:
+    """
+    属性に最初にアクセスした時点で import されるモジュールの代理オブジェクト.
+    also に指定したモジュール (xarray のアクセサを登録する rioxarray など) も同時に import する.
+    """
+
+    def __init__(self, name, *also):
+        self._name = name
+        self._also = also
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            for name in self._also:
+                importlib.import_module(name)
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_module(name, *also):
+    return LazyModule(name, *also)
@@ -0,0 +1,163 @@
+"""
+データセットのサンプルごとの統計量をまとめたマニフェスト (Parquet) を作成・読み込むためのモジュール
+
+ortho_scene が .npy を保存する際に, 配列がメモリにあるうちに sample_record で統計量を計算して meta/<id>.json に書き込み,
+build_manifest で meta/*.json と dataset.csv (取得時刻, URL, 雲量) を1つの manifest.parquet にまとめる.
+学習時のフィルタや層別サンプリングは .npy を開かずにマニフェストだけで行える.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+from lazy_import import lazy_module
+
+from labels import binarize
+
+pd = lazy_module("pandas")
+
+MANIFEST_NAME = "manifest.parquet"
+
+# EMIT_L2A_RFL_001_20241020T170504_2429411_003 のようなグラニュール ID の取得時刻・軌道番号・シーン番号
+ACQUIRED_PATTERN = r"_(?P<acquired>\d{8}T\d{6})_(?P<orbit>\d{7})_(?P<scene>\d{3})$"
+
+
+def array_layout(path, array):
+    """
+    np.save で path に保存した array の, ファイル内のデータの位置と形式を返す.
+    .npy のデータはヘッダの後に連続して置かれるため, ファイルサイズから先頭のオフセットが分かる.
+    SparseL2B の .npz は連続したデータを持たないため, offset は None, nbytes はファイルサイズとする.
+    """
+    if Path(path).suffix == ".npz":
+        return {
+            "offset": None,
+            "nbytes": Path(path).stat().st_size,
+            "shape": list(array.shape),
+            "dtype": str(array.dtype),
+            "format": "sparse",
+        }
+    nbytes = int(array.nbytes)
+    return {
+        "offset": Path(path).stat().st_size - nbytes,
+        "nbytes": nbytes,
+        "shape": list(array.shape),
+        "dtype": str(array.dtype),
+    }
+
+
+def sample_record(
+    l2a_path, l2a_data, l2b_path, l2b_data, nodata=0, threshold=None, root=None
+):
+    """
+    保存した L2A, L2B の配列のサンプルごとの統計量を返す (meta/<id>.json に追加する).
+
+    root: パスの基準にするデータセットのディレクトリ (実行ディレクトリによらず読めるように相対パスで保存する)
+    nodata: L2A の欠損値 (precision の nodata). 全バンドが nodata または NaN の画素を無効とする
+    threshold: プルーム画素の閾値 (labels.binarize と同じ)
+    """
+    valid = np.any((l2a_data != nodata) & np.isfinite(l2a_data), axis=-1)
+    plume = binarize(l2b_data, threshold=threshold)
+    return {
+        "l2a": {"path": _relative(l2a_path, root), **array_layout(l2a_path, l2a_data)},
+        "l2b": {"path": _relative(l2b_path, root), **array_layout(l2b_path, l2b_data)},
+        "valid_fraction": float(valid.mean()) if valid.size else 0.0,
+        "plume_pixels": int(np.count_nonzero(plume)),
+    }
+
+
+def _relative(path, root):
+    if root is None:
+        return str(path)
+    try:
+        return str(Path(path).resolve().relative_to(Path(root).resolve()))
+    except ValueError:
+        return str(path)
+
+
+def meta_row(geojson_id, meta):
+    """
+    meta/<id>.json の内容をマニフェストの1行 (入れ子のない辞書) にする.
+    """
+    left, bottom, right, top = meta["bounds"]
+    height, width = meta["shape"]
+    row = {
+        "geojson_id": str(geojson_id),
+        "granule_id": meta.get("granule_id"),
+        "height": height,
+        "width": width,
+        "bands": len(meta.get("wavelengths", [])),
+        "crs": meta["crs"],
+        "transform": meta["transform"],
+        "minx": left,
+        "miny": bottom,
+        "maxx": right,
+        "maxy": top,
+        "valid_fraction": meta.get("valid_fraction"),
+        "plume_pixels": meta.get("plume_pixels"),
+        "plume_fraction": (
+            meta["plume_pixels"] / (height * width) if "plume_pixels" in meta else None
+        ),
+    }
+    precision = meta.get("precision", {})
+    for key in ("scale", "offset", "nodata"):
+        row[f"precision_{key}"] = precision.get(key)
+    for name in ("l2a", "l2b"):
+        layout = meta.get(name, {})
+        row[f"{name}_path"] = layout.get("path")
+        row[f"{name}_dtype"] = layout.get("dtype")
+        row[f"{name}_offset"] = layout.get("offset")
+        row[f"{name}_nbytes"] = layout.get("nbytes")
+        row[f"{name}_format"] = layout.get("format", "npy")
+    return row
+
+
+def build_manifest(dataset_dir, meta_dir=None, csv_path=None, output=None):
+    """
+    dataset_dir の meta/*.json と dataset.csv からマニフェストを作成し, manifest.parquet に保存する.
+    dataset.csv がない場合 (ortho_dataset) は取得時刻などの列は granule_id からのみ作成する.
+    """
+    dataset_dir = Path(dataset_dir)
+    meta_dir = Path(meta_dir or dataset_dir / "meta")
+    csv_path = Path(csv_path or dataset_dir / "dataset.csv")
+    output = Path(output or dataset_dir / MANIFEST_NAME)
+
+    rows = [
+        meta_row(path.stem, json.loads(path.read_text(encoding="utf-8")))
+        for path in sorted(meta_dir.glob("*.json"))
+    ]
+    if not rows:
+        raise FileNotFoundError(f"{meta_dir} に meta の json が見つかりませんでした.")
+    manifest = pd.DataFrame(rows)
+
+    # グラニュール ID から L2A の取得時刻・軌道番号・シーン番号を取り出す
+    parts = manifest["granule_id"].astype(str).str.extract(ACQUIRED_PATTERN)
+    manifest["acquired"] = pd.to_datetime(
+        parts["acquired"], format="%Y%m%dT%H%M%S", utc=True
+    )
+    manifest["orbit"] = pd.to_numeric(parts["orbit"])
+    manifest["scene"] = pd.to_numeric(parts["scene"])
+
+    if csv_path.exists():
+        dataset = pd.read_csv(csv_path, dtype={"geojson_id": str})
+        dataset = dataset.drop_duplicates("geojson_id", keep="last")
+        dataset["timestamp"] = pd.to_datetime(dataset["timestamp"], utc=True)
+        manifest = manifest.merge(dataset, on="geojson_id", how="left")
+
+    manifest.to_parquet(output, index=False)
+    return manifest
+
+
+def read_manifest(path, columns=None, filters=None):
+    """
+    manifest.parquet を読み込む. columns, filters は pyarrow にそのまま渡す.
+    (例) filters=[("plume_pixels", ">", 0), ("valid_fraction", ">=", 0.9)]
+    """
+    return pd.read_parquet(path, columns=columns, filters=filters)
+
+
+def stratified_sample(manifest, column, n_per_group, seed=0):
+    """
+    column の値ごとに最大 n_per_group 件ずつサンプリングする.
+    """
+    shuffled = manifest.sample(frac=1, random_state=seed)
+    return shuffled.groupby(column, dropna=False).head(n_per_group)
@@ -0,0 +1,134 @@
+"""
+シーンの境界をまたぐプルームのために, 同じ軌道の隣接シーンを共通グリッドのウィンドウ上でつなぎ合わせるモジュール
+
+merge_emit のようにシーン全体をオルソ補正してから結合するのではなく,
+出力ウィンドウの画素中心を各シーンのオルソ補正後のグリッドに対応付けて GLT を引き (最近傍),
+先のシーンで埋まらなかった画素だけを次のシーンの生データから読み込む.
+読み込むのは各シーンの GLT のウィンドウに対応する部分と, 必要な生データの範囲だけなので, メモリはウィンドウの大きさで抑えられる.
+"""
+
+import re
+from pathlib import Path
+
+import numpy as np
+from affine import Affine
+
+from emit_tools import is_adjacent
+
+# EMIT_L2A_RFL_001_20241020T170504_2429411_003 の軌道番号とシーン番号
+SCENE_PATTERN = r"EMIT_L2A_RFL_\d{3}_\d{8}T\d{6}_(?P<orbit>\d{7})_(?P<scene>\d{3})"
+
+
+def scene_number(name):
+    """
+    ファイル名・URL から (軌道番号, シーン番号) を返す. 含まれない場合は None を返す.
+    """
+    match = re.search(SCENE_PATTERN, Path(str(name)).name)
+    return (match.group("orbit"), int(match.group("scene"))) if match else None
+
+
+def adjacent_granules(name, candidates):
+    """
+    candidates (ファイル名・URL のリスト) から, name と同じ軌道で隣り合うシーンを返す.
+    同じグラニュールの候補が複数ある場合は最初のものだけを返す.
+    """
+    key = scene_number(name)
+    if key is None:
+        return []
+    adjacent = {}
+    for candidate in candidates:
+        other = scene_number(candidate)
+        if other is None or other[0] != key[0] or other == key:
+            continue
+        # is_adjacent は拡張子付きのファイル名をシーン番号の昇順に並べて渡す
+        same_orbit = [Path(str(n)).name for n in (name, candidate)]
+        if is_adjacent(name, sorted(same_orbit, key=lambda n: scene_number(n)[1])):
+            adjacent.setdefault(other, candidate)
+    return list(adjacent.values())
+
+
+def lattice_index(l2a_ds, transform, shape, GLT_NODATA_VALUE=0):
+    """
+    transform, shape のグリッドの各画素中心に対応する l2a_ds (オルソ補正前) の生データの位置を返す.
+    グリッドが l2a_ds のオルソ補正後のグリッドと一致する場合は glt_index の結果と同じになる.
+    GLT は出力ウィンドウに対応する範囲だけを読み込む.
+
+    Returns:
+    valid, rows, cols: glt_index と同じ形式 (valid は shape の bool 配列)
+    """
+    scene_transform = Affine.from_gdal(*l2a_ds.attrs["geotransform"])
+    height, width = l2a_ds["glt_x"].shape
+    # 北が上で回転のないグリッドを前提に, 行と列を別々に対応付ける
+    x = transform.c + (np.arange(shape[1]) + 0.5) * transform.a
+    y = transform.f + (np.arange(shape[0]) + 0.5) * transform.e
+    scene_cols = np.floor((x - scene_transform.c) / scene_transform.a).astype(int)
+    scene_rows = np.floor((y - scene_transform.f) / scene_transform.e).astype(int)
+    col_inside = (scene_cols >= 0) & (scene_cols < width)
+    row_inside = (scene_rows >= 0) & (scene_rows < height)
+
+    valid = np.zeros(shape, dtype=bool)
+    if not col_inside.any() or not row_inside.any():
+        return valid, np.empty(0, dtype=int), np.empty(0, dtype=int)
+    row_start, row_stop = scene_rows[row_inside].min(), scene_rows[row_inside].max() + 1
+    col_start, col_stop = scene_cols[col_inside].min(), scene_cols[col_inside].max() + 1
+    glt = [
+        np.nan_to_num(
+            l2a_ds[name][row_start:row_stop, col_start:col_stop].values,
+            nan=GLT_NODATA_VALUE,
+        ).astype(int)
+        for name in ("glt_x", "glt_y")
+    ]
+    ix = np.ix_(scene_rows[row_inside] - row_start, scene_cols[col_inside] - col_start)
+    glt_x, glt_y = glt[0][ix], glt[1][ix]
+    inside = np.ix_(row_inside, col_inside)
+    valid[inside] = (glt_x != GLT_NODATA_VALUE) & (glt_y != GLT_NODATA_VALUE)
+    inner = valid[inside]
+    # Adjust for One based Index
+    return valid, glt_y[inner] - 1, glt_x[inner] - 1
+
+
+def mosaic_window(
+    scenes,
+    transform,
+    shape,
+    fill_value=-9999,
+    dtype=np.float32,
+    encode=None,
+    first_index=None,
+):
+    """
+    scenes (オルソ補正前の L2A データセットのリスト, 優先する順) の reflectance を transform, shape のグリッドにつなぎ合わせる.
+    前のシーンで埋まった画素は後のシーンでは読み込まない.
+    first_index: scenes[0] の lattice_index の結果 (呼び出し側で計算済みの場合は GLT を読み直さない)
+
+    Returns:
+    out: (height, width, bands) の配列
+    sources: 各画素の値を取ったシーンの番号 (どのシーンにもない画素は -1)
+    """
+    # encode でバンド数が変わる場合 (ビニング) もあるため, 空の画素を encode して出力のバンド数を決める
+    reflectance = scenes[0]["reflectance"]
+    probe = np.zeros((0, reflectance.shape[-1]), dtype=reflectance.dtype)
+    bands = (encode(probe) if encode is not None else probe).shape[-1]
+    out = np.full((*shape, bands), fill_value, dtype=dtype)
+    sources = np.full(shape, -1, dtype=np.int16)
+    for k, l2a_ds in enumerate(scenes):
+        if k == 0 and first_index is not None:
+            valid, rows, cols = first_index
+        else:
+            valid, rows, cols = lattice_index(l2a_ds, transform, shape)
+        take = valid & (sources < 0)
+        if not take.any():
+            continue
+        selected = take[valid]
+        rows, cols = rows[selected], cols[selected]
+        row_start, col_start = rows.min(), cols.min()
+        # 必要な生データの範囲だけを読み込む
+        raw = l2a_ds["reflectance"][
+            row_start : rows.max() + 1, col_start : cols.max() + 1
+        ].values
+        values = raw[rows - row_start, cols - col_start]
+        out[take] = encode(values) if encode is not None else values
+        sources[take] = k
+        if (sources >= 0).all():
+            break
+    return out, sources
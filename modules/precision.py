@@ -0,0 +1,72 @@
+"""
+反射率の出力精度 (float32 / float16 / スケール付き int16) を扱うためのモジュール
+
+encoder で作成した関数を apply_glt に渡すことで, オルソ補正の際に直接目的の dtype で出力する.
+"""
+
+import numpy as np
+
+EMIT_FILL_VALUE = -9999
+
+# nodata: 欠損画素に入れる値. float は従来通り 0, int16 は予約値を使う
+PRECISIONS = {
+    "float32": {"dtype": "float32", "scale": 1.0, "offset": 0.0, "nodata": 0},
+    "float16": {"dtype": "float16", "scale": 1.0, "offset": 0.0, "nodata": 0},
+    "int16": {"dtype": "int16", "scale": 1e-4, "offset": 0.0, "nodata": -32768},
+}
+
+
+def precision_spec(name="float32", scale=None, offset=None):
+    """
+    出力精度の設定 (dtype, scale, offset, nodata) の辞書を返す.
+    """
+    spec = dict(PRECISIONS[name])
+    if scale is not None:
+        spec["scale"] = scale
+    if offset is not None:
+        spec["offset"] = offset
+    return spec
+
+
+def encoder(spec, fill_value=EMIT_FILL_VALUE):
+    """
+    反射率 (float32) を spec の dtype に変換する関数を返す. fill_value と NaN の画素は nodata にする.
+    (h5netcdf が _FillValue を復号した場合, 欠損画素は fill_value ではなく NaN になる)
+    """
+    dtype = np.dtype(spec["dtype"])
+    nodata = spec["nodata"]
+
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        # nodata の予約値は有効な値の範囲から外す
+        low = info.min + 1 if nodata == info.min else info.min
+        high = info.max - 1 if nodata == info.max else info.max
+
+        def encode(values):
+            missing = (values == fill_value) | np.isnan(values)
+            out = np.rint((values - spec["offset"]) / spec["scale"])
+            # NaN のまま整数に変換すると警告が出るため, 先に埋めておく
+            out[missing] = 0
+            np.clip(out, low, high, out=out)
+            out = out.astype(dtype)
+            out[missing] = nodata
+            return out
+
+    else:
+
+        def encode(values):
+            missing = (values == fill_value) | np.isnan(values)
+            out = values.astype(dtype)
+            out[missing] = nodata
+            return out
+
+    return encode
+
+
+def decode(data, spec):
+    """
+    spec で保存された配列を float32 の反射率に戻す. nodata の画素は NaN にする.
+    """
+    out = data.astype(np.float32) * spec["scale"] + spec["offset"]
+    out[data == spec["nodata"]] = np.nan
+    return out
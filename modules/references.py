@@ -0,0 +1,196 @@
+"""
+EMIT の netCDF (HDF5) のグラニュールの参照インデックス (kerchunk 形式) を作成・キャッシュするためのモジュール
+
+参照インデックスは各変数のチャンクを (URL, バイトオフセット, サイズ) に対応付けた Zarr (v2) のメタデータで,
+fsspec の reference ファイルシステムを通して仮想的な Zarr ストアとして開ける.
+一度作成すればリモートの HDF5 のメタデータ (スーパーブロック, グループ, チャンクの B-tree) を読み直す必要がなく,
+チャンクの取得は Zarr がまとめて並列に行う.
+
+    refs = ReferenceCache("data/references").get(url, transport)
+    ds = emit_xarray(url, opener=reference_opener(refs, transport.fs))
+"""
+
+import json
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from lazy_import import lazy_module
+
+from h5_planner import (
+    H5Z_FILTER_DEFLATE,
+    H5Z_FILTER_FLETCHER32,
+    H5Z_FILTER_SHUFFLE,
+    ChunkIndex,
+)
+from h5_mmap import contiguous_layout
+
+xr = lazy_module("xarray")
+h5py = lazy_module("h5py")
+fsspec = lazy_module("fsspec")
+
+
+def _json_value(value):
+    """
+    HDF5 の属性の値を json に保存できる値に変換する.
+    """
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, np.ndarray):
+        return [_json_value(v) for v in value.tolist()]
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return str(value)
+    return value
+
+
+def _fill_value(value, dtype):
+    # Zarr の .zarray は NaN, Infinity を文字列で表す
+    if value is None:
+        return None
+    value = np.asarray(value, dtype=dtype).item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return "NaN" if np.isnan(value) else ("Infinity" if value > 0 else "-Infinity")
+    return value
+
+
+def _codecs(index):
+    """
+    HDF5 のフィルタのパイプラインを Zarr (numcodecs) の filters に変換する.
+    Zarr は filters を逆順に適用して復号するため, HDF5 と同じ順序で並べる.
+    """
+    codecs = {
+        H5Z_FILTER_SHUFFLE: {"id": "shuffle", "elementsize": index.dtype.itemsize},
+        H5Z_FILTER_DEFLATE: {"id": "zlib", "level": 4},
+        H5Z_FILTER_FLETCHER32: {"id": "fletcher32"},
+    }
+    return [codecs[filter_id] for filter_id in index.filters] or None
+
+
+def variable_references(name, dset, var, url):
+    """
+    1つの変数の参照 (.zarray, .zattrs, チャンクのキー -> [url, offset, size]) を返す.
+    """
+    if dset.dtype.kind not in "biuf":
+        raise ValueError(f"{name} の dtype {dset.dtype} には対応していません.")
+    attrs = {k: _json_value(v) for k, v in var.attrs.items() if k != "_FillValue"}
+    attrs["_ARRAY_DIMENSIONS"] = list(var.dims)
+    zarray = {
+        "zarr_format": 2,
+        "shape": list(dset.shape),
+        "dtype": dset.dtype.str,
+        "order": "C",
+        "compressor": None,
+        "fill_value": _fill_value(var.attrs.get("_FillValue"), dset.dtype),
+    }
+    refs = {}
+    separator = "." if dset.ndim else ""
+    if dset.chunks is None:
+        layout = contiguous_layout(dset)
+        if layout is None:
+            raise ValueError(f"{name} は memmap できないレイアウトです.")
+        zarray.update(chunks=list(dset.shape) or [], filters=None)
+        key = separator.join(["0"] * dset.ndim) or "0"
+        refs[f"{name}/{key}"] = [url, int(layout[0]), int(dset.id.get_storage_size())]
+    else:
+        index = ChunkIndex.from_dataset(dset)
+        if index is None:
+            raise ValueError(f"{name} は未対応のフィルタを使っています.")
+        zarray.update(chunks=list(dset.chunks), filters=_codecs(index))
+        for origin, (offset, size, filter_mask) in index.chunks.items():
+            if filter_mask:
+                raise ValueError(f"{name} にフィルタを省略したチャンクがあります.")
+            key = separator.join(str(o // c) for o, c in zip(origin, dset.chunks))
+            refs[f"{name}/{key}"] = [url, int(offset), int(size)]
+    refs[f"{name}/.zarray"] = json.dumps(zarray)
+    refs[f"{name}/.zattrs"] = json.dumps(attrs)
+    return refs
+
+
+def build_references(fileobj, url, groups=(None, "location", "sensor_band_parameters")):
+    """
+    fileobj (ローカルのパスまたはファイルオブジェクト) の groups の参照インデックスを作成する.
+    チャンクの参照先は url にする.
+    """
+    refs = {".zgroup": json.dumps({"zarr_format": 2})}
+    with h5py.File(fileobj, "r") as f:
+        for group in groups:
+            if group and group not in f:
+                continue
+            prefix = f"{group}/" if group else ""
+            raw = xr.open_dataset(
+                fileobj, engine="h5netcdf", group=group, decode_cf=False
+            )
+            h5group = f[group] if group else f
+            refs[f"{prefix}.zgroup"] = json.dumps({"zarr_format": 2})
+            refs[f"{prefix}.zattrs"] = json.dumps(
+                {k: _json_value(v) for k, v in raw.attrs.items()}
+            )
+            for name, var in raw.variables.items():
+                refs.update(
+                    variable_references(f"{prefix}{name}", h5group[name], var, url)
+                )
+            raw.close()
+    return {"version": 1, "refs": refs}
+
+
+def reference_opener(refs, fs=None):
+    """
+    参照インデックス refs を仮想的な Zarr ストアとして開く emit_xarray の opener を返す.
+    fs: チャンクを取得するファイルシステム (Transport.fs など. None の場合は URL から決める)
+    """
+    # Zarr はファイルシステムを非同期で使うため, 参照先のファイルシステムも非同期のものを作り直す
+    options = {"fo": refs, "asynchronous": True}
+    if fs is not None:
+        protocol = fs.protocol if isinstance(fs.protocol, str) else fs.protocol[0]
+        remote_options = dict(fs.storage_options)
+        if fs.async_impl:
+            remote_options["asynchronous"] = True
+        options.update(remote_protocol=protocol, remote_options=remote_options)
+    fs = fsspec.filesystem("reference", **options)
+
+    def opener(filepath, group=None):
+        return xr.open_dataset(
+            fs.get_mapper(group or ""), engine="zarr", consolidated=False, chunks=None
+        )
+
+    return opener
+
+
+class ReferenceCache:
+    """
+    グラニュール ID ごとの参照インデックスを cache_dir に json で保存するキャッシュ.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, url):
+        granule_id = url.rstrip("/").split("/")[-1].split(".")[0]
+        return self.cache_dir / f"{granule_id}.json"
+
+    def get(self, url, transport):
+        """
+        url の参照インデックスを返す. キャッシュにない場合は transport で開いて作成し保存する.
+        """
+        path = self.path(url)
+        if path.exists():
+            return json.loads(path.read_text(encoding="utf-8"))
+        with transport.open(url) as f:
+            refs = build_references(f, transport.url(url))
+        # 書き込み途中のファイルを他のプロセスが読まないように, 一時ファイルから置き換える
+        # 同じグラニュールを同時に処理するワーカーの書き込みが混ざらないよう, 一時ファイルの名前は保存ごとに変える
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, prefix=f"{path.name}.", suffix=".tmp", delete=False
+        ) as f:
+            tmp = Path(f.name)
+        try:
+            with tmp.open("w", encoding="utf-8") as out:
+                json.dump(refs, out)
+            tmp.replace(path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        return refs
@@ -0,0 +1,147 @@
+"""
+近接する geojson のフットプリントをクラスタにまとめて, クラスタごとに1回だけ検索するためのモジュール
+
+1. フットプリントの bbox をクラスタリングする
+2. クラスタの凸包と日付範囲で EMITL2ARFL, EMITL2BCH4PLM を検索してペアを作成する
+3. 空間インデックス (FootprintIndex) でペアのグラニュールと各 geojson の交差を調べて割り当てる
+"""
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry.polygon import orient
+
+from granule_pairing import pair_date_range
+from footprint_index import FootprintIndex
+
+
+def cluster_footprints(footprints, max_distance=0.5, max_extent=5.0):
+    """
+    bbox 同士の距離が max_distance (度) 以下のフットプリントを同じクラスタにまとめる.
+    クラスタ全体の bbox の幅・高さは max_extent (度) を超えないようにする.
+
+    Returns:
+    labels: footprints と同じ長さのクラスタ番号の配列
+    """
+    boxes = shapely.box(
+        footprints["minx"].values,
+        footprints["miny"].values,
+        footprints["maxx"].values,
+        footprints["maxy"].values,
+    )
+    tree = shapely.STRtree(boxes)
+    left, right = tree.query(boxes, predicate="dwithin", distance=max_distance)
+
+    # union-find でクラスタをまとめる (クラスタの bbox も合わせて管理する)
+    parent = np.arange(len(boxes))
+    extent = footprints[["minx", "miny", "maxx", "maxy"]].to_numpy(
+        dtype=float, copy=True
+    )
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(left, right):
+        root_i, root_j = find(i), find(j)
+        if root_i == root_j:
+            continue
+        merged = np.concatenate(
+            [
+                np.minimum(extent[root_i, :2], extent[root_j, :2]),
+                np.maximum(extent[root_i, 2:], extent[root_j, 2:]),
+            ]
+        )
+        if (merged[2:] - merged[:2]).max() > max_extent:
+            continue
+        parent[root_j] = root_i
+        extent[root_i] = merged
+
+    roots = np.array([find(i) for i in range(len(boxes))], dtype=int)
+    return np.unique(roots, return_inverse=True)[1]
+
+
+def plan_searches(footprints, max_distance=0.5, max_extent=5.0):
+    """
+    クラスタごとの検索計画を作成する.
+
+    Returns:
+    plans: cluster, geojson_ids, polygon (検索用の凸包の座標リスト) を持つ辞書のリスト
+    """
+    labels = cluster_footprints(footprints, max_distance, max_extent)
+    plans = []
+    for label in np.unique(labels):
+        members = footprints[labels == label]
+        hull = shapely.convex_hull(shapely.union_all(members.geometry.values))
+        if hull.geom_type != "Polygon":
+            # 点や線になった場合は小さくバッファして面にする
+            hull = hull.buffer(1e-4)
+        hull = orient(hull, sign=1.0)
+        plans.append(
+            {
+                "cluster": int(label),
+                "geojson_ids": members["geojson_id"].tolist(),
+                "polygon": list(hull.exterior.coords),
+            }
+        )
+    return plans
+
+
+def assign_pairs(pairs, footprints, index=None):
+    """
+    L2A, L2B 両方のグラニュールのフットプリントと交差する geojson にペアを割り当てる.
+    index (FootprintIndex) を指定した場合はその空間インデックスで検索し, footprints の geojson に絞り込む.
+
+    Returns:
+    assigned: geojson_id 列を追加したペアの DataFrame (geojson_id ごとに L2A の雲量で昇順)
+    """
+    if pairs.empty or footprints.empty:
+        return pairs.assign(geojson_id=pd.Series(dtype=str)).iloc[0:0]
+    if index is None:
+        index = FootprintIndex(footprints)
+    geoms = index.geometries
+    geojson_ids = index.footprints["geojson_id"].values
+    pair_idx, fp_idx = index.query_granules(pairs["geometry_l2b"].values)
+    hit = shapely.intersects(pairs["geometry_l2a"].values[pair_idx], geoms[fp_idx])
+    hit &= np.isin(geojson_ids[fp_idx], footprints["geojson_id"].values)
+    pair_idx, fp_idx = pair_idx[hit], fp_idx[hit]
+
+    assigned = pairs.iloc[pair_idx].reset_index(drop=True)
+    assigned.insert(0, "geojson_id", geojson_ids[fp_idx])
+    return assigned.sort_values(
+        ["geojson_id", "cloud_cover_l2a"], kind="stable"
+    ).reset_index(drop=True)
+
+
+def search_by_clusters(
+    footprints,
+    date_range,
+    tolerance="1s",
+    max_distance=0.5,
+    max_extent=5.0,
+    index=None,
+):
+    """
+    クラスタごとに1回だけ検索し, 各 geojson にペアを割り当てる.
+    index: 割り当てに使う FootprintIndex (None の場合は footprints から作成する)
+    """
+    if index is None:
+        index = FootprintIndex(footprints)
+    plans = plan_searches(footprints, max_distance, max_extent)
+    print(f"{len(footprints)} 件の geojson を {len(plans)} 個のクラスタで検索します.")
+    assigned = []
+    for plan in plans:
+        members = footprints[footprints["geojson_id"].isin(plan["geojson_ids"])]
+        pairs = pair_date_range(
+            date_range, polygon=plan["polygon"], tolerance=tolerance
+        )
+        assigned.append(assign_pairs(pairs, members, index))
+        print(
+            f"クラスタ {plan['cluster']}\t: {len(plan['geojson_ids'])} 件の geojson, "
+            f"{len(pairs)} 件のペア"
+        )
+    if not assigned:
+        return pd.DataFrame(columns=["geojson_id"])
+    return pd.concat(assigned, ignore_index=True)
@@ -0,0 +1,88 @@
+"""
+データセット作成を複数ノードで分担するためのモジュール
+
+geojson_id などのキーのハッシュで決定的にシャードを割り当てるため,
+ノード間で調整をしなくても同じキーを2つのノードで処理することはない.
+"""
+
+import hashlib
+from pathlib import Path
+
+from lazy_import import lazy_module
+
+# マージの時だけ使うため, シャードの選択だけならば pandas は import しない
+pd = lazy_module("pandas")
+
+
+def parse_shard(spec):
+    """
+    "i/N" 形式の文字列を (i, N) に変換する. spec が None の場合は None を返す.
+    """
+    if spec is None:
+        return None
+    try:
+        index, count = (int(value) for value in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"シャードの指定 {spec} は i/N の形式で指定してください.")
+    if count <= 0 or not 0 <= index < count:
+        raise ValueError(f"シャードの指定 {spec} は 0 <= i < N を満たす必要があります.")
+    return index, count
+
+
+def shard_of(key, count):
+    """
+    キーが属するシャード番号を返す (Python の hash と違い実行ごとに変わらない).
+    """
+    digest = hashlib.md5(str(key).encode("utf-8")).hexdigest()
+    return int(digest, 16) % count
+
+
+def select_shard(keys, shard):
+    """
+    keys のうち shard (i, N) に属するものだけを順序を保って返す. shard が None の場合は全て返す.
+    """
+    if shard is None:
+        return list(keys)
+    index, count = shard
+    return [key for key in keys if shard_of(key, count) == index]
+
+
+def shard_path(path, shard):
+    """
+    shard ごとの出力パスを返す. (dataset.csv -> dataset.shard-0001-of-0004.csv)
+    """
+    path = Path(path)
+    if shard is None:
+        return path
+    index, count = shard
+    return path.with_name(f"{path.stem}.shard-{index:04d}-of-{count:04d}{path.suffix}")
+
+
+def shard_paths(path):
+    """
+    shard_path で作成された path のシャードのパスを全て返す.
+    """
+    path = Path(path)
+    return sorted(path.parent.glob(f"{path.stem}.shard-*-of-*{path.suffix}"))
+
+
+def merge_csv_manifests(path, key="geojson_id"):
+    """
+    path のシャードの csv を1つにまとめて path に書き出す.
+    既に path が存在する場合はその内容も含め, key が重複する行は後のものを残す.
+    """
+    path = Path(path)
+    paths = shard_paths(path)
+    if path.exists():
+        paths = [path] + paths
+    if not paths:
+        raise FileNotFoundError(f"{path} のシャードが見つかりませんでした.")
+    merged = pd.concat(
+        [pd.read_csv(p, dtype={key: str}) for p in paths], ignore_index=True
+    )
+    merged = merged.drop_duplicates(subset=key, keep="last")
+    merged = merged.sort_values(
+        key, key=lambda ids: ids.str.zfill(ids.str.len().max()), kind="stable"
+    )
+    merged.to_csv(path, index=False)
+    return merged
@@ -0,0 +1,167 @@
+"""
+L2A 反射率のバンドを選択・ビニングするためのモジュール
+
+emit_xarray(ortho=False) で遅延読み込みしたデータセットに対してオルソ補正の前に適用し,
+不要なバンドを読み込み・オルソ補正・保存しないようにする.
+ビニングはシーン全体を読み込まないように split_binning でバンド選択と分け,
+binned_encoder で GLT が参照する画素を集めた後に bin_values で行う.
+"""
+
+import numpy as np
+
+# CH4 の SWIR 吸収帯を含む波長範囲 (nm)
+CH4_WINDOWS = {
+    "ch4_swir": [(2100, 2450)],
+    "ch4_all": [(1600, 1750), (2100, 2450)],
+}
+
+
+def band_indices(wavelengths, good_wavelengths=None, bands=None, windows=None):
+    """
+    条件を全て満たすバンドのインデックスを昇順で返す.
+
+    Parameters:
+    wavelengths: 各バンドの中心波長 (nm)
+    good_wavelengths: 1 が有効なバンドを表す配列 (水蒸気吸収帯などを除外する)
+    bands: 使用するバンドのインデックスのリスト
+    windows: 使用する波長範囲 (nm) の (min, max) のリスト
+    """
+    wavelengths = np.asarray(wavelengths)
+    selected = np.ones(len(wavelengths), dtype=bool)
+    if good_wavelengths is not None:
+        selected &= np.asarray(good_wavelengths) == 1
+    if bands is not None:
+        in_subset = np.zeros(len(wavelengths), dtype=bool)
+        in_subset[list(bands)] = True
+        selected &= in_subset
+    if windows:
+        in_window = np.zeros(len(wavelengths), dtype=bool)
+        for low, high in windows:
+            in_window |= (wavelengths >= low) & (wavelengths <= high)
+        selected &= in_window
+    return np.flatnonzero(selected)
+
+
+def select_spectral(ds, bands=None, good_only=False, window=None):
+    """
+    emit_xarray(ortho=False) のデータセットのバンドを選択する. ビニングは binned_encoder で行う.
+
+    Parameters:
+    ds: emit_xarray で開いたオルソ補正前のデータセット (遅延読み込み)
+    bands: 使用するバンドのインデックスのリスト
+    good_only: True の場合 good_wavelengths が 1 のバンドのみを使用する
+    window: CH4_WINDOWS のキー, または (min, max) のリスト
+
+    Returns:
+    ds: バンドを選択したデータセット
+    """
+    if isinstance(window, str):
+        window = CH4_WINDOWS[window]
+    if bands is not None or good_only or window:
+        indices = band_indices(
+            ds["wavelengths"].values,
+            ds["good_wavelengths"].values if good_only else None,
+            bands,
+            window,
+        )
+        if len(indices) == 0:
+            raise ValueError("選択条件に一致するバンドがありません.")
+        ds = ds.isel(wavelengths=indices)
+    return ds
+
+
+def bin_values(values, factor, fill_value=-9999):
+    """
+    (..., bands) の配列の隣り合う factor 個のバンドを平均する.
+    欠損値は平均から除外し, 全て欠損の場合は fill_value にする. 端の余ったバンドは捨てる.
+    """
+    values = np.asarray(values)
+    n = values.shape[-1] // factor * factor
+    grouped = values[..., :n].reshape(*values.shape[:-1], n // factor, factor)
+    valid = (grouped != fill_value) & ~np.isnan(grouped)
+    count = valid.sum(axis=-1)
+    total = np.where(valid, grouped, 0).sum(axis=-1, dtype=np.float64)
+    mean = np.divide(
+        total, count, out=np.full(total.shape, fill_value, float), where=count > 0
+    )
+    return mean.astype(values.dtype)
+
+
+def binned_wavelengths(ds, factor):
+    """
+    bin_values と同じく端の余ったバンドを捨て, ビニング後の各バンドの中心波長 (平均) を返す.
+    """
+    return ds["wavelengths"].coarsen(wavelengths=factor, boundary="trim").mean().values
+
+
+def split_binning(spectral):
+    """
+    spectral_options の引数からビニングを分け, (select_spectral の引数 (無い場合は None), bin_factor) を返す.
+    """
+    if not spectral:
+        return None, None
+    options = dict(spectral)
+    bin_factor = options.pop("bin_factor", None)
+    if not bin_factor or bin_factor <= 1:
+        bin_factor = None
+    return (options if any(options.values()) else None), bin_factor
+
+
+def binned_encoder(encode, factor, fill_value=-9999):
+    """
+    GLT で集めた画素 (N, bands) をビニングしてから encode (precision.encoder) する関数を返す.
+    factor が None の場合は encode をそのまま返す.
+    """
+    if not factor:
+        return encode
+
+    def encode_binned(values):
+        values = bin_values(values, factor, fill_value)
+        return encode(values) if encode is not None else values
+
+    return encode_binned
+
+
+def add_spectral_arguments(parser):
+    """
+    バンド選択のコマンドライン引数を parser に追加する.
+    """
+    parser.add_argument(
+        "--bands",
+        type=lambda s: [int(band) for band in s.split(",")],
+        default=None,
+        help="Comma separated band indices to keep (e.g. 0,1,2)",
+    )
+    parser.add_argument(
+        "--good_wavelengths",
+        action="store_true",
+        help="Drop bands flagged as bad in good_wavelengths (water absorption)",
+    )
+    parser.add_argument(
+        "--wavelength_window",
+        type=str,
+        default=None,
+        help=f"Wavelength window to keep: {', '.join(CH4_WINDOWS)} or MIN,MAX in nm",
+    )
+    parser.add_argument(
+        "--bin", type=int, default=None, help="Average every N adjacent bands"
+    )
+
+
+def spectral_options(args):
+    """
+    add_spectral_arguments で追加した引数から, バンド選択とビニングの引数を作成する (split_binning で分ける).
+    バンド選択をしない場合は None を返す.
+    """
+    window = args.wavelength_window
+    if window and window not in CH4_WINDOWS:
+        window = [tuple(float(w) for w in window.split(","))]
+    options = {
+        "bands": args.bands,
+        "good_only": args.good_wavelengths,
+        "window": window,
+        "bin_factor": args.bin,
+    }
+    if not any(options.values()):
+        return None
+    return options
@@ -0,0 +1,220 @@
+"""
+EMIT のグラニュールを取得するための転送方法 (S3 直接アクセス / HTTPS) をまとめたモジュール
+
+LP DAAC のデータは us-west-2 の S3 に置かれているため, 同じリージョンで実行する場合は S3 に直接アクセスし,
+それ以外は HTTPS でアクセスする. どちらも fsspec のファイルシステムとして扱い,
+ブロックサイズと同時接続数を調整した open と, 複数のバイト範囲を並列に取得する fetch_ranges を提供する.
+endpoint_url を指定すると MinIO などのローカルの S3 互換サーバーで動作を確認できる.
+"""
+
+import os
+import re
+
+from units import parse_memory
+from lazy_import import lazy_module
+
+aiohttp = lazy_module("aiohttp")
+earthaccess = lazy_module("earthaccess")
+fsspec = lazy_module("fsspec")
+
+TRANSPORTS = ["auto", "s3", "https"]
+
+# LP DAAC のバケットのリージョン
+LPDAAC_REGION = "us-west-2"
+
+# https://data.lpdaac.earthdatacloud.nasa.gov/<bucket>/<key> -> s3://<bucket>/<key>
+HTTPS_URL_PATTERN = r"^https://data\.lpdaac\.earthdatacloud\.nasa\.gov/(?P<path>.+)$"
+
+# HDF5 のチャンク (EMIT の reflectance は数 MB) 単位で読めるように既定値 (5MB) より大きくする
+DEFAULT_BLOCK_SIZE = 16 * 2**20
+DEFAULT_MAX_CONNECTIONS = 32
+
+
+def to_s3_url(url):
+    """
+    LP DAAC の HTTPS の URL を S3 の URL に変換する. 変換できない URL はそのまま返す.
+    """
+    match = re.match(HTTPS_URL_PATTERN, url)
+    return f"s3://{match.group('path')}" if match else url
+
+
+def in_region():
+    """
+    LP DAAC と同じリージョン (us-west-2) で実行しているかを環境変数から判定する.
+    """
+    region = os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION")
+    return region == LPDAAC_REGION
+
+
+class Transport:
+    """
+    fsspec のファイルシステムをブロックサイズ・同時接続数の設定とともに保持するクラス.
+
+    mode: "s3" または "https"
+    block_size: open したファイルの1回の読み込みのサイズ
+    max_connections: fetch_ranges で同時に投げるリクエスト数 (接続プールの大きさにも使う)
+    """
+
+    def __init__(
+        self,
+        fs,
+        mode,
+        block_size=DEFAULT_BLOCK_SIZE,
+        max_connections=DEFAULT_MAX_CONNECTIONS,
+        cache_type="blockcache",
+    ):
+        self.fs = fs
+        self.mode = mode
+        self.block_size = block_size
+        self.max_connections = max_connections
+        self.cache_type = cache_type
+
+    def url(self, url):
+        """
+        mode に応じた URL を返す (s3 の場合は HTTPS の URL を S3 の URL に変換する).
+        """
+        return to_s3_url(url) if self.mode == "s3" else url
+
+    def open(self, url):
+        """
+        url のファイルを開く. HDF5 のランダムアクセスに向くよう, 読んだブロックを保持する blockcache を使う.
+        """
+        return self.fs.open(
+            self.url(url),
+            mode="rb",
+            block_size=self.block_size,
+            cache_type=self.cache_type,
+        )
+
+    def fetch_ranges(self, url, ranges):
+        """
+        url の (start, end) のバイト範囲のリストを並列に取得し, bytes のリストを返す.
+        取得に失敗した範囲がある場合は例外を送出する.
+        """
+        if not ranges:
+            return []
+        starts, ends = zip(*ranges)
+        return self.fs.cat_ranges(
+            [self.url(url)] * len(ranges),
+            list(starts),
+            list(ends),
+            batch_size=self.max_connections,
+            # 失敗した範囲を例外のオブジェクトのまま返さず, その場で送出する
+            on_error="raise",
+        )
+
+    def size(self, url):
+        return self.fs.size(self.url(url))
+
+
+def s3_filesystem(endpoint_url=None, max_connections=DEFAULT_MAX_CONNECTIONS):
+    """
+    S3 のファイルシステムを返す.
+    endpoint_url を指定した場合はその S3 互換サーバーに環境変数の認証情報で接続し,
+    指定しない場合は earthaccess で LP DAAC の一時的な認証情報を取得する.
+    """
+    config_kwargs = {"max_pool_connections": max_connections}
+    if endpoint_url:
+        return fsspec.filesystem(
+            "s3",
+            client_kwargs={"endpoint_url": endpoint_url},
+            config_kwargs=config_kwargs,
+        )
+    credentials = earthaccess.get_s3_credentials(daac="LPDAAC")
+    return fsspec.filesystem(
+        "s3",
+        key=credentials["accessKeyId"],
+        secret=credentials["secretAccessKey"],
+        token=credentials["sessionToken"],
+        client_kwargs={"region_name": LPDAAC_REGION},
+        config_kwargs=config_kwargs,
+    )
+
+
+async def pooled_client(loop=None, max_connections=DEFAULT_MAX_CONNECTIONS, **kwargs):
+    """
+    HTTPFileSystem の get_client. 同じホストへの接続を max_connections 本まで張り, 使い回す aiohttp のセッションを返す.
+    aiohttp の既定 (全体で 100 本, ホストごとの上限なし) では cat_ranges の並列数と接続数が揃わないため, 上限を揃える.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=max_connections,
+        limit_per_host=max_connections,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+    )
+    return aiohttp.ClientSession(connector=connector, **kwargs)
+
+
+def https_filesystem(max_connections=DEFAULT_MAX_CONNECTIONS):
+    """
+    HTTPS のファイルシステムを返す.
+    earthaccess のセッションの認証ヘッダをそのまま使い, 接続プールの大きさだけを max_connections に合わせる.
+    """
+    session = earthaccess.get_fsspec_https_session()
+    return fsspec.filesystem(
+        "https",
+        client_kwargs=dict(session.client_kwargs, max_connections=max_connections),
+        get_client=pooled_client,
+    )
+
+
+def get_transport(
+    mode="auto",
+    endpoint_url=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    max_connections=DEFAULT_MAX_CONNECTIONS,
+):
+    """
+    mode (auto, s3, https) に応じた Transport を返す.
+    auto は endpoint_url を指定した場合か us-west-2 で実行している場合に s3, それ以外は https を選ぶ.
+    https の場合は事前に earthaccess.login しておく必要がある.
+    """
+    if mode == "auto":
+        mode = "s3" if endpoint_url or in_region() else "https"
+    if mode == "s3":
+        fs = s3_filesystem(endpoint_url, max_connections)
+    elif mode == "https":
+        fs = https_filesystem(max_connections)
+    else:
+        raise ValueError(f"未対応の転送方法です: {mode}")
+    return Transport(fs, mode, block_size, max_connections)
+
+
+def add_transport_arguments(parser):
+    """
+    転送方法のコマンドライン引数を parser に追加する.
+    """
+    parser.add_argument(
+        "--transport",
+        type=str,
+        choices=TRANSPORTS,
+        default="auto",
+        help="Direct S3 access (in us-west-2) or HTTPS (auto: choose by region)",
+    )
+    parser.add_argument(
+        "--endpoint_url",
+        type=str,
+        default=None,
+        help="S3-compatible endpoint to use instead of LP DAAC (e.g. a local MinIO)",
+    )
+    parser.add_argument(
+        "--block_size",
+        type=str,
+        default="16MiB",
+        help="Read block size for remote files",
+    )
+    parser.add_argument(
+        "--max_connections",
+        type=int,
+        default=DEFAULT_MAX_CONNECTIONS,
+        help="Concurrent ranged requests / connection pool size",
+    )
+
+
+def transport_from_args(args):
+    return get_transport(
+        args.transport,
+        endpoint_url=args.endpoint_url,
+        block_size=parse_memory(args.block_size),
+        max_connections=args.max_connections,
+    )
@@ -13,8 +13,6 @@ import pandas as pd
 import geopandas as gpd
 import shapely
 import earthaccess
-import asyncio
-import aiohttp
 
 
 def convert_bounds(bbox, invert_y=False):
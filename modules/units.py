@@ -0,0 +1,20 @@
+"""
+コマンドライン引数などで使う単位付きの値を解釈するモジュール
+"""
+
+import re
+
+
+def parse_memory(value):
+    """
+    "8GB", "512MiB" のようなメモリ量をバイト数に変換する. None の場合は None を返す.
+    """
+    if value is None:
+        return None
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)(i?)B?\s*", str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"メモリ量 {value} を解釈できません.")
+    number, unit, binary = match.groups()
+    base = 1024 if binary else 1000
+    exponent = " KMGT".index(unit.upper() or " ")
+    return int(float(number) * base**exponent)
@@ -0,0 +1,55 @@
+"""
+dataset_reader の BatchLoader でデータセットを1周読み込み, スループット (samples/sec) を表示するスクリプト
+"""
+
+import argparse
+import sys
+
+sys.path.append("modules")
+from dataset_reader import BatchLoader, EmitDataset
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure dataset reader throughput.")
+    parser.add_argument(
+        "--dataset", "-d", type=str, default="data/dataset", help="Dataset directory"
+    )
+    parser.add_argument(
+        "--l2a_dir", type=str, default="EMITL2ARFL", help="L2A subdirectory"
+    )
+    parser.add_argument(
+        "--l2b_dir", type=str, default="EMITL2BCH4PLM", help="L2B subdirectory"
+    )
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size")
+    parser.add_argument("--size", type=int, default=64, help="Patch size (pixels)")
+    parser.add_argument(
+        "--bands", type=int, nargs="*", default=None, help="Band indices to read"
+    )
+    parser.add_argument("--workers", type=int, default=4, help="Reader threads")
+    parser.add_argument("--prefetch", type=int, default=4, help="Batches to prefetch")
+    parser.add_argument("--epochs", type=int, default=1, help="Number of passes")
+    args = parser.parse_args()
+
+    dataset = EmitDataset(args.dataset, args.l2a_dir, args.l2b_dir)
+    if len(dataset) == 0:
+        print(f"{args.dataset} にサンプルが見つかりませんでした")
+        sys.exit(1)
+    loader = BatchLoader(
+        dataset,
+        batch_size=args.batch_size,
+        size=args.size,
+        bands=args.bands,
+        workers=args.workers,
+        prefetch=args.prefetch,
+    )
+    for epoch in range(args.epochs):
+        for _ in loader:
+            pass
+        print(
+            f"epoch {epoch}: {loader.samples} サンプル, {loader.elapsed:.2f} 秒, "
+            f"{loader.samples_per_second:.1f} samples/sec"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+転送方法・ブロックサイズ・同時接続数ごとにグラニュールの取得時間を計測するスクリプト
+
+1. open したファイルを先頭から順に読む (h5netcdf の読み込みに近い)
+2. ファイル全体を --range_size ごとの範囲に分けて fetch_ranges で並列に取得する
+--endpoint_url にローカルの S3 互換サーバーを指定すると, LP DAAC に接続せずに確認できる.
+"""
+
+import argparse
+import sys
+import time
+
+sys.path.append("modules")
+from transport import add_transport_arguments, transport_from_args
+from units import parse_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure granule fetch time.")
+    parser.add_argument("url", type=str, help="Granule URL (HTTPS or s3://)")
+    parser.add_argument(
+        "--range_size", type=str, default="8MiB", help="Size of each ranged request"
+    )
+    add_transport_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.endpoint_url:
+        import earthaccess
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        earthaccess.login(strategy="environment", persist=True)
+    transport = transport_from_args(args)
+    size = transport.size(args.url)
+    print(f"転送方法: {transport.mode}, サイズ: {size / 2**20:.1f} MiB")
+
+    start = time.perf_counter()
+    with transport.open(args.url) as f:
+        while f.read(transport.block_size):
+            pass
+    elapsed = time.perf_counter() - start
+    print(f"順次読み込み\t: {elapsed:.2f} 秒 ({size / 2**20 / elapsed:.1f} MiB/s)")
+
+    range_size = parse_memory(args.range_size)
+    ranges = [(i, min(i + range_size, size)) for i in range(0, size, range_size)]
+    start = time.perf_counter()
+    transport.fetch_ranges(args.url, ranges)
+    elapsed = time.perf_counter() - start
+    print(
+        f"並列取得 ({len(ranges)} 範囲)\t: {elapsed:.2f} 秒 ({size / 2**20 / elapsed:.1f} MiB/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+L2A グラニュールの参照インデックス (チャンク -> URL, バイト範囲) を事前に作成してキャッシュするスクリプト
+
+URL を指定しない場合は dataset.csv の EMITL2ARFL_url を対象にする.
+作成したインデックスは make_dataset.py --reference_cache <cache_dir> で使われる.
+--endpoint_url にローカルの S3 互換サーバーを指定すると, LP DAAC に接続せずに確認できる.
+"""
+
+import argparse
+import sys
+import time
+
+import pandas as pd
+
+sys.path.append("modules")
+from transport import add_transport_arguments, transport_from_args
+from references import ReferenceCache, reference_opener
+from emit_tools import emit_xarray
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build chunk reference indexes.")
+    parser.add_argument("urls", type=str, nargs="*", help="L2A granule URLs")
+    parser.add_argument(
+        "--csv",
+        type=str,
+        default="data/dataset/dataset.csv",
+        help="Dataset CSV to take EMITL2ARFL_url from when no URL is given",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="data/references",
+        help="Directory to store <granule_id>.json",
+    )
+    add_transport_arguments(parser)
+    args = parser.parse_args()
+
+    urls = args.urls or list(pd.read_csv(args.csv)["EMITL2ARFL_url"].unique())
+    if not args.endpoint_url:
+        import earthaccess
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        earthaccess.login(strategy="environment", persist=True)
+    transport = transport_from_args(args)
+    cache = ReferenceCache(args.cache_dir)
+
+    for url in urls:
+        start = time.perf_counter()
+        try:
+            refs = cache.get(url, transport)
+        except ValueError as e:
+            print(f"{url} の参照インデックスを作成できませんでした: {e}")
+            continue
+        built = time.perf_counter() - start
+        # キャッシュしたインデックスから開く時間 (HDF5 のメタデータは読まない)
+        start = time.perf_counter()
+        emit_xarray(url, ortho=False, opener=reference_opener(refs, transport.fs))
+        opened = time.perf_counter() - start
+        print(
+            f"{cache.path(url)}\t: 作成 {built:.2f} 秒, 開く {opened:.2f} 秒"
+            f" ({len(refs['refs'])} 件)"
+        )
+
+
+if __name__ == "__main__":
+    main()
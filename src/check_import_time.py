@@ -0,0 +1,91 @@
+"""
+modules 以下のモジュールの import 時間を計測し, 予算を超えていないか確認するスクリプト
+
+各モジュールを新しい Python プロセスで import し, 最も速かった時間を予算と比較する.
+ワーカープロセスの起動や短いコマンドの実行が遅くならないように, 重い依存は lazy_import で遅延させること.
+"""
+
+import argparse
+import subprocess
+import sys
+
+# モジュールごとの import 時間の予算 (秒)
+IMPORT_BUDGETS = {
+    "emit_tools": 0.3,
+    "labels": 0.3,
+    "chips": 0.3,
+    "precision": 0.3,
+    "spectral_select": 0.3,
+    "sharding": 0.2,
+    "executors": 0.2,
+    "granule_cache": 0.3,
+    "h5_mmap": 0.2,
+    "transport": 0.2,
+    "h5_planner": 0.2,
+    "references": 0.2,
+    "browse": 0.3,
+    "manifest": 0.3,
+    "band_stats": 0.2,
+    "dataset_reader": 0.3,
+    "mosaic": 0.2,
+    "dataset_tools": 0.3,
+}
+
+MEASURE_CODE = """
+import sys, time
+sys.path.append("modules")
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+
+def measure_import_time(module, repeat=3):
+    """
+    module の import 時間 (秒) を repeat 回計測し, 最小値を返す.
+    """
+    times = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", MEASURE_CODE.format(module=module)],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        times.append(float(result.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check import time budgets.")
+    parser.add_argument(
+        "--modules",
+        type=str,
+        nargs="*",
+        default=list(IMPORT_BUDGETS),
+        help="Modules to measure",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions")
+    args = parser.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        budget = IMPORT_BUDGETS.get(module)
+        try:
+            elapsed = measure_import_time(module, args.repeat)
+        except subprocess.CalledProcessError as e:
+            print(f"{module}\t: import に失敗しました\n{e.stderr}")
+            over_budget.append(module)
+            continue
+        status = "OK" if budget is None or elapsed <= budget else "OVER"
+        print(f"{module}\t: {elapsed * 1000:.1f} ms (budget {budget}s) {status}")
+        if status == "OVER":
+            over_budget.append(module)
+
+    if over_budget:
+        print(f"予算を超えたモジュール: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
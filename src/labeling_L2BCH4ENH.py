@@ -1,21 +1,105 @@
+"""
+L2B (CH4ENH, CH4PLM) の .npy をまとめて2値化し, ビットに詰めたラベルを作成するスクリプト
+
+出力先には <id>.npz (bits, shape) と, 各サンプルのプルーム画素数をまとめた labels.csv を書き出す.
+"""
+
 import argparse
-import numpy as np
+import concurrent.futures
+import csv
+import sys
 from pathlib import Path
 
+sys.path.append("modules")
+from labels import find_l2b_files, label_file
+
+MAX_WORKERS = 8
+
+
+def labels_dir(directory):
+    """
+    directory の隣の <name>_labels を返す. "." のような相対パスでも名前が取れるように絶対パスにしてから求める.
+    """
+    directory = Path(directory).resolve()
+    return directory.with_name(directory.name + "_labels")
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--l2b", type=str, help="L2BCH4PLM numpy data path")
+    parser.add_argument(
+        "--l2b_dir",
+        type=str,
+        help="Directory of L2B numpy data (labels all .npy and sparse .npz)",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Output directory (default: <l2b_dir>_labels)",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=None,
+        help="Label pixels greater than this value as plume (default: every non-zero, non-nodata pixel)",
+    )
+    parser.add_argument(
+        "--nonzero",
+        action="store_true",
+        help="Label every non-zero (and non-nodata) pixel as plume even if --threshold is given",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=MAX_WORKERS, help="Number of worker processes"
+    )
     args = parser.parse_args()
 
-    l2b_path = args.l2b
+    if args.l2b:
+        l2b_paths = [Path(args.l2b)]
+        default_outdir = labels_dir(Path(args.l2b).parent)
+    elif args.l2b_dir:
+        # 出力先を --l2b_dir にした場合も, 書き出したラベルの .npz は入力に含めない
+        l2b_paths = find_l2b_files(args.l2b_dir)
+        default_outdir = labels_dir(args.l2b_dir)
+    else:
+        parser.error("--l2b または --l2b_dir を指定してください")
+    if not l2b_paths:
+        print("ラベルを作成する .npy, .npz ファイルが見つかりませんでした")
+        sys.exit(1)
+
+    outdir = Path(args.output) if args.output else default_outdir
+    # SparseL2B の .npz と同じディレクトリに書き出すと, ラベルの <id>.npz で入力を上書きしてしまう
+    if any(
+        path.suffix == ".npz" and (outdir / path.name).resolve() == path.resolve()
+        for path in l2b_paths
+    ):
+        print(
+            f"出力先 {outdir} に SparseL2B の .npz があり, ラベルで上書きされます. 別の --output を指定してください"
+        )
+        sys.exit(1)
+    outdir.mkdir(parents=True, exist_ok=True)
+    threshold = None if args.nonzero else args.threshold
+
+    # プロセスプールを使って並列処理
+    records = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(label_file, l2b_path, outdir, threshold): l2b_path
+            for l2b_path in l2b_paths
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                records.append(future.result())
+            except Exception as e:
+                print(f"{futures[future]} のラベル作成に失敗しました: {e}")
 
-    # L2BPLMデータ読み込み
-    l2b_data = np.load(l2b_path)
+    # 各サンプルのプルーム画素数を index として保存
+    index_path = outdir / "labels.csv"
+    with index_path.open("w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=["id", "height", "width", "plume_pixels"])
+        writer.writeheader()
+        writer.writerows(sorted(records, key=lambda record: record["id"]))
+    print(f"{len(records)} 件のラベルを {outdir} に保存しました.")
 
-    # 0のとこは0、それ以外は1にする
-    l2b_data[l2b_data == 0] = 0
-    l2b_data[l2b_data != 0] = 1
 
-    # 保存
-    output_path = Path(f"{l2b_path}.npy")
+if __name__ == "__main__":
+    main()
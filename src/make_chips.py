@@ -0,0 +1,92 @@
+"""
+ortho_file_pair で作成した L2A, L2B の .npy (L2B は SparseL2B の .npz も可) から固定サイズの学習用チップを作成するスクリプト
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append("modules")
+from chips import ChipWriter, chip_offsets, plume_pixel_counts, select_chips
+from labels import open_l2b
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cut aligned L2A/L2B pairs into chips."
+    )
+    parser.add_argument(
+        "--l2a_dir",
+        type=str,
+        default="data/dataset/EMITL2ARFL",
+        help="Directory of L2A .npy files",
+    )
+    parser.add_argument(
+        "--l2b_dir",
+        type=str,
+        default="data/dataset/EMITL2BCH4PLM",
+        help="Directory of L2B .npy files",
+    )
+    parser.add_argument(
+        "--output", type=str, default="data/chips", help="Output directory"
+    )
+    parser.add_argument("--size", type=int, default=64, help="Chip size (pixels)")
+    parser.add_argument("--stride", type=int, default=32, help="Chip stride (pixels)")
+    parser.add_argument(
+        "--pos_ratio",
+        type=float,
+        default=0.5,
+        help="Ratio of chips containing plume pixels (negative value keeps all chips)",
+    )
+    parser.add_argument(
+        "--min_plume_pixels",
+        type=int,
+        default=1,
+        help="Minimum plume pixels for a chip to count as positive",
+    )
+    parser.add_argument(
+        "--shard_size", type=int, default=1024, help="Number of chips per shard"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    l2a_dir, l2b_dir = Path(args.l2a_dir), Path(args.l2b_dir)
+    l2b_paths = sorted(l2b_dir.glob("*.np[yz]"))
+    if not l2b_paths:
+        print(f"{l2b_dir} に .npy, .npz ファイルが見つかりませんでした")
+        sys.exit(1)
+
+    rng = np.random.default_rng(args.seed)
+    pos_ratio = None if args.pos_ratio < 0 else args.pos_ratio
+    writer = ChipWriter(args.output, args.size, shard_size=args.shard_size)
+    for l2b_path in l2b_paths:
+        l2a_path = l2a_dir / f"{l2b_path.stem}.npy"
+        if not l2a_path.exists():
+            print(f"{l2a_path} が見つかりません。スキップします。")
+            continue
+        l2a = np.load(l2a_path, mmap_mode="r")
+        l2b = open_l2b(l2b_path)
+        if l2a.shape[:2] != l2b.shape[:2]:
+            print(
+                f"{l2b_path.stem} の L2A と L2B の形状が一致しません。スキップします。"
+            )
+            continue
+
+        offsets = chip_offsets(l2b.shape, args.size, args.stride)
+        counts = plume_pixel_counts(np.asarray(l2b) > 0, offsets, args.size)
+        selected = select_chips(counts, pos_ratio, args.min_plume_pixels, rng)
+        writer.add(
+            l2b_path.stem,
+            l2a,
+            l2b,
+            offsets[selected],
+            counts[selected],
+            args.min_plume_pixels,
+        )
+    writer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,95 +11,52 @@ from pathlib import Path
 from dotenv import load_dotenv
 import pandas as pd
 import geopandas as gpd
-import rasterio
-from rasterio.warp import calculate_default_transform, reproject, Resampling
-import numpy as np
 import sys
 from shapely.geometry.polygon import orient
 from typing import Tuple
 
 sys.path.append("modules")
 from emit_tools import emit_xarray
+from dataset_tools import ortho_scene
+from precision import PRECISIONS
+from spectral_select import add_spectral_arguments, spectral_options
 from tutorial_utils import results_to_geopandas, convert_bounds
-
-
-def get_asset_url(row, asset, key="Type", value="GET DATA"):
-    """
-    Retrieve a url from the list of dictionaries for a row in the _related_urls column.
-    Asset examples: CH4PLM, CH4PLMMETA, RFL, MASK, RFLUNCERT
-    """
-    # Add _ to asset so string matching works
-    asset = f"_{asset}_"
-    # Retrieve URL matching parameters
-    for _dict in row[f"_related_urls{asset}"]:
-        if _dict.get(key) == value and asset in _dict["URL"].split("/")[-1]:
-            return _dict["URL"]
-
-
-def search_by_geojson(geojson_path, date_range):
+from granule_pairing import pair_date_range, search_adjacent_l2a
+from footprint_index import FOOTPRINT_INDEX_NAME, FootprintIndex
+from search_planner import search_by_clusters
+from sharding import parse_shard, select_shard, shard_path
+from manifest import build_manifest
+from band_stats import build_band_stats
+from transport import add_transport_arguments, transport_from_args
+from h5_planner import planned_opener
+from references import ReferenceCache, reference_opener
+from labels import L2B_FORMATS
+
+# dataset.csv の列. 雲量は manifest.parquet でのフィルタに使う
+DATASET_COLUMNS = [
+    "geojson_id",
+    "timestamp",
+    "EMITL2ARFL_url",
+    "EMITL2BCH4PLM_url",
+    "cloud_cover_l2a",
+    "cloud_cover_l2b",
+]
+
+
+def search_by_geojson(geojson_path, date_range, tolerance="1s"):
     """
     geojson ファイルを用いて, 同じタイムスタンプを持つEMITL2ARFL及びEMITL2BCH4PLMのURLを取得する
 
-    * concept_id について
-    - EMITL2ARFL: "C2408750690-LPCLOUD"
-    - EMITL2BCH4PLM: "C2748088093-LPCLOUD"
+    タイムスタンプは granule_pairing.pair_granules により tolerance の誤差を許容して対応付ける.
     """
     # geojson ファイルを読み込み、関心領域のポリゴンを取得
     roi_gdf = gpd.read_file(geojson_path)
     roi = orient(roi_gdf.geometry[0], sign=1.0)
     roi = list(roi.exterior.coords)
 
-    # EMITL2ARFL, EMITL2BCH4PLMのURLを取得
-    EMITL2ARFL_concept_id = "C2408750690-LPCLOUD"
-    EMITL2BCH4PLM_concept_id = "C2748088093-LPCLOUD"
-    EMITL2ARFL_results = earthaccess.search_data(
-        concept_id=EMITL2ARFL_concept_id, temporal=date_range, polygon=roi, count=200
-    )
-    EMITL2BCH4PLM_results = earthaccess.search_data(
-        concept_id=EMITL2BCH4PLM_concept_id, temporal=date_range, polygon=roi, count=200
-    )
-
-    # cloud_cover の情報を追加して geopandas に変換
-    EMITL2ARFL_results_gdf = results_to_geopandas(
-        EMITL2ARFL_results, fields=["_cloud_cover"]
-    )
-    EMITL2BCH4PLM_results_gdf = results_to_geopandas(
-        EMITL2BCH4PLM_results, fields=["_cloud_cover"]
-    )
-
-    # cloud_cover が60未満のデータのみを取得 (雲が多すぎるとデータが使えないため)
-    # EMITL2ARFL_results_gdf = EMITL2ARFL_results_gdf[EMITL2ARFL_results_gdf["_cloud_cover"] < 60]
-    # EMITL2ARFL_results_gdf = EMITL2ARFL_results_gdf.reset_index(drop=True, inplace=True)
-    # EMITL2BCH4PLM_results_gdf = EMITL2BCH4PLM_results_gdf[EMITL2BCH4PLM_results_gdf["_cloud_cover"] < 60]
-    # EMITL2BCH4PLM_results_gdf = EMITL2BCH4PLM_results_gdf.reset_index(drop=True, inplace=True)
-
-    # cloud_cover で昇順ソート
-    EMITL2ARFL_results_gdf = EMITL2ARFL_results_gdf.sort_values(
-        by="_cloud_cover"
-    ).reset_index(drop=True)
-    EMITL2BCH4PLM_results_gdf = EMITL2BCH4PLM_results_gdf.sort_values(
-        by="_cloud_cover"
-    ).reset_index(drop=True)
-
-    # 同じタイムスタンプを持つ EMITL2ARFL, EMITL2BCH4PLM のペアの URL を取得
-    merged_results_df = pd.merge(
-        EMITL2ARFL_results_gdf,
-        EMITL2BCH4PLM_results_gdf,
-        left_on="_beginning_date_time",
-        right_on="_single_date_time",
-        suffixes=("_L2A_RFL_", "_L2B_CH4PLM_"),
-    )
-    url_pairs = []
-    for index, row in merged_results_df.iterrows():
-        EMITL2ARFL_url = get_asset_url(row, "L2A_RFL")
-        EMITL2BCH4PLM_url = get_asset_url(row, "L2B_CH4PLM")
-        if EMITL2ARFL_url and EMITL2BCH4PLM_url:
-            timestamp = row["_beginning_date_time"]
-            url_pairs.append((timestamp, EMITL2ARFL_url, EMITL2BCH4PLM_url))
-        else:
-            print(
-                f"ペア取得に失敗しました ({row['native-id_L2A_RFL_']} と {row['native-id_L2BCH4PLM_']}) "
-            )
+    # EMITL2ARFL, EMITL2BCH4PLM を検索して, cloud_cover で昇順に並んだペアを取得
+    pairs = pair_date_range(date_range, polygon=roi, tolerance=tolerance)
+    url_pairs = list(pairs[DATASET_COLUMNS[1:]].itertuples(index=False, name=None))
     if not url_pairs:
         print(
             "同じタイムスタンプを持つ L2ARFL と L2BCH4PLM のペアが見つかりませんでした."
@@ -110,68 +67,44 @@ def search_by_geojson(geojson_path, date_range):
     return url_pairs
 
 
-def ortho_file_pair(geojson_id, l2a_fp, l2b_fp, l2a_outdir, l2b_outdir):
-    # .npy ファイルの出力先パス
-    l2a_dst = l2a_outdir / f"{geojson_id}.npy"
-    l2b_dst = l2b_outdir / f"{geojson_id}.npy"
-
-    # 既に出力ファイルが存在する場合はスキップ
-    if l2a_dst.exists() and l2b_dst.exists():
-        print(
-            f"ファイル {l2a_dst} および {l2b_dst} は既に存在しています。スキップします。"
-        )
-        return
+def adjacent_finder(transport, l2a_url):
+    """
+    l2a_url と同じ軌道の隣接シーンを検索し, (開いたファイル, opener) のリストを返す関数を返す.
+    ortho_scene はプルームがシーンの外にはみ出している場合だけこの関数を呼ぶため, CMR の検索もその場合だけ行われる.
+    """
 
-    print(f"以下のファイルを処理します: \nL2A: {l2a_fp}\nL2B: {l2b_fp}")
+    def find():
+        return [
+            (transport.open(url), planned_opener(transport, url))
+            for url in search_adjacent_l2a(l2a_url)
+        ]
 
-    try:
-        # L2Aデータのオルソ処理
-        l2a_geo = emit_xarray(l2a_fp, ortho=True)
-        l2a_geo.reflectance.data[l2a_geo.reflectance.data == -9999] = 0  # 欠損値を0に
+    return find
 
-        # L2Bデータのオルソ処理
-        with rasterio.open(l2b_fp) as src:
-            # オルソ補正パラメータの計算
-            transform, width, height = calculate_default_transform(
-                src.crs, src.crs, src.width, src.height, *src.bounds
-            )
-            # 出力用配列の作成
-            l2b_geo = np.empty((src.count, height, width), dtype=src.dtypes[0])
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=rasterio.band(src, i),
-                    destination=l2b_geo[i - 1],
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=src.crs,
-                    resampling=Resampling.nearest,
-                )
-            l2b_geo = l2b_geo.squeeze()
-            # L2Bのバウンディングボックスを取得
-            bbox = src.bounds
-            print(f"bbox: {bbox}")
-
-        # L2Aデータを L2B のバウンディングボックスでくり抜く
-        l2a_cropped = l2a_geo.reflectance.sel(
-            longitude=slice(bbox.left, bbox.right),
-            latitude=slice(bbox.top, bbox.bottom),
-        )
 
-        # データを保存
-        np.save(l2a_dst, l2a_cropped.data)
-        np.save(l2b_dst, l2b_geo)
-        print(f"保存完了:   L2A -> {l2a_dst},  L2B -> {l2b_dst}")
-    except Exception as e:
+def prepare_dataset_csv(dataset_csv_path):
+    """
+    dataset_csv_path のヘッダを DATASET_COLUMNS に揃える.
+    ファイルがない場合はヘッダだけを書き込み, 以前の列構成 (雲量の列がない) の場合は足りない列を空欄で追加して書き直す.
+    DATASET_COLUMNS に含まれない列がある場合は追記すると列がずれるため, 終了する.
+    """
+    if not dataset_csv_path.exists():
+        with open(dataset_csv_path, "w") as f:
+            f.write(",".join(DATASET_COLUMNS) + "\n")
+        return
+    with open(dataset_csv_path) as f:
+        header = f.readline().strip().split(",")
+    if header == DATASET_COLUMNS:
+        return
+    if header[0] != DATASET_COLUMNS[0] or not set(header) <= set(DATASET_COLUMNS):
         print(
-            f"{geojson_id}.json のペアの処理でエラーが発生しました。エラー内容: {e}. このペアはスキップします。"
+            f"{dataset_csv_path} の列 ({','.join(header)}) が想定している列 ({','.join(DATASET_COLUMNS)}) と一致しません. "
+            "ファイルを移動または削除してから再実行してください."
         )
-        # 途中で生成されたファイルがあれば削除
-        if l2a_dst.exists():
-            l2a_dst.unlink()
-        if l2b_dst.exists():
-            l2b_dst.unlink()
-        return
+        sys.exit(1)
+    dataset = pd.read_csv(dataset_csv_path, dtype=str)
+    dataset.reindex(columns=DATASET_COLUMNS).to_csv(dataset_csv_path, index=False)
+    print(f"{dataset_csv_path} の列を {','.join(DATASET_COLUMNS)} に更新しました.")
 
 
 def main():
@@ -182,7 +115,58 @@ def main():
         default=("2023-01-01", "2024-12-31"),
         help="Date range for search (YYYY-MM-DD)",
     )
+    parser.add_argument(
+        "--tolerance",
+        type=str,
+        default="1s",
+        help="Time tolerance for pairing L2A and L2B granules (e.g. 1s, 500ms)",
+    )
+    parser.add_argument(
+        "--batch_search",
+        action="store_true",
+        help="Search once per spatial cluster of GeoJSONs instead of once per GeoJSON",
+    )
+    parser.add_argument(
+        "--cluster_distance",
+        type=float,
+        default=0.5,
+        help="Max bbox distance (degrees) between GeoJSONs in the same search cluster",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=list(PRECISIONS),
+        default="float32",
+        help="Storage precision of reflectance (int16 is scaled, see meta/<id>.json)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        default=None,
+        help="Process only shard i of N (i/N), writing dataset.shard-i-of-N.csv",
+    )
+    parser.add_argument(
+        "--reference_cache",
+        type=str,
+        default=None,
+        help="Directory of per-granule chunk reference indexes (open L2A as virtual Zarr)",
+    )
+    parser.add_argument(
+        "--l2b_format",
+        type=str,
+        choices=L2B_FORMATS,
+        default="npy",
+        help="Store L2B as a dense .npy or as run-length encoded plume pixels (.npz)",
+    )
+    parser.add_argument(
+        "--stitch_adjacent",
+        action="store_true",
+        help="Fill plume pixels outside the L2A swath from adjacent scenes of the same orbit",
+    )
+    add_spectral_arguments(parser)
+    add_transport_arguments(parser)
     args = parser.parse_args()
+    shard = parse_shard(args.shard)
 
     # .env ファイルから Earthdata Login 情報を取得してログイン
     load_dotenv()
@@ -191,8 +175,10 @@ def main():
         print("Earthdata Login に失敗しました.")
         sys.exit(1)
 
-    # HTTPS セッションを取得
-    fs = earthaccess.get_fsspec_https_session()
+    # S3 (us-west-2 で実行している場合) または HTTPS でグラニュールを取得する
+    transport = transport_from_args(args)
+    print(f"転送方法: {transport.mode}")
+    references = ReferenceCache(args.reference_cache) if args.reference_cache else None
 
     # data/dataset/geojsons にある geojson ファイルを使用してEMITL2ARFL, EMITL2BCH4PLM の URL を取得し1組ずつ csv に書き込む
     geojson_dir = Path("data/dataset/geojsons")
@@ -202,36 +188,100 @@ def main():
     if not geojson_paths:
         print(f"No GeoJSON files found in {geojson_dir}")
         sys.exit(1)
+    # --shard を指定した場合は, このノードが担当する geojson のみを処理する
+    geojson_ids = set(select_shard([path.stem for path in geojson_paths], shard))
+    geojson_paths = [path for path in geojson_paths if path.stem in geojson_ids]
+    if not geojson_paths:
+        # 担当が無いのはエラーではないため, ジョブスケジューラが失敗と扱わないように正常終了する
+        print("このシャードが担当する geojson はありません")
+        return
 
-    # dataset.csv に書き込む
-    dataset_csv_path = Path("data/dataset/dataset.csv")
-    if not dataset_csv_path.exists():
-        with open(dataset_csv_path, "w") as f:
-            f.write("geojson_id,timestamp,EMITL2ARFL_url,EMITL2BCH4PLM_url\n")
+    # dataset.csv (シャードの場合は dataset.shard-i-of-N.csv) に書き込む
+    dataset_csv_path = shard_path("data/dataset/dataset.csv", shard)
+    prepare_dataset_csv(dataset_csv_path)
+    # クラスタ単位でまとめて検索し, 各 geojson にペアを割り当てておく
+    if args.batch_search:
+        # フットプリントの空間インデックスは追加・更新された geojson だけを読み直す
+        index = FootprintIndex.update(
+            geojson_dir, geojson_dir.parent / FOOTPRINT_INDEX_NAME
+        )
+        footprints = index.footprints
+        assigned = search_by_clusters(
+            footprints[footprints["geojson_id"].isin(geojson_ids)],
+            args.date_range,
+            tolerance=args.tolerance,
+            max_distance=args.cluster_distance,
+            index=index,
+        )
+        url_pairs_by_id = {
+            geojson_id: list(
+                group[DATASET_COLUMNS[1:]].itertuples(index=False, name=None)
+            )
+            for geojson_id, group in assigned.groupby("geojson_id", sort=False)
+        }
+
+    # geojson ごとにペアを決め, 同じ L2A グラニュールを使う geojson をまとめる
+    scenes = {}  # {EMITL2ARFL_url: [(geojson_id, EMITL2BCH4PLM_url), ...]}
     for geojson_path in geojson_paths:
-        url_pairs = search_by_geojson(geojson_path, args.date_range)
+        if args.batch_search:
+            url_pairs = url_pairs_by_id.get(geojson_path.stem, [])
+        else:
+            url_pairs = search_by_geojson(geojson_path, args.date_range, args.tolerance)
+        if not url_pairs:
+            continue
         url_pair = url_pairs[0]  # 一番目のペアのみを使用
         with open(dataset_csv_path, "a") as f:
-            f.write(f"{geojson_path.stem},{url_pair[0]},{url_pair[1]},{url_pair[2]}\n")
-
-        # HTTPS ストリームを開いてデータを取得
-        EMITL2ARFL_fp = fs.open(url_pair[1])
-        EMITL2BCH4PLM_fp = fs.open(url_pair[2])
-
-        # .npy ファイルの出力先ディレクトリを作成
-        EMITL2ARFL_outdir = Path("data/dataset/EMITL2ARFL")
-        EMITL2BCH4PLM_outdir = Path("data/dataset/EMITL2BCH4PLM")
-        EMITL2ARFL_outdir.mkdir(parents=True, exist_ok=True)
-        EMITL2BCH4PLM_outdir.mkdir(parents=True, exist_ok=True)
-
-        # データを処理して .npy ファイルに書き込む
-        ortho_file_pair(
-            geojson_path.stem,
-            EMITL2ARFL_fp,
-            EMITL2BCH4PLM_fp,
-            EMITL2ARFL_outdir,
-            EMITL2BCH4PLM_outdir,
-        )
+            f.write(",".join(map(str, (geojson_path.stem, *url_pair))) + "\n")
+        scenes.setdefault(url_pair[1], []).append((geojson_path.stem, url_pair[2]))
+
+    # .npy ファイルの出力先ディレクトリを作成
+    EMITL2ARFL_outdir = Path("data/dataset/EMITL2ARFL")
+    EMITL2BCH4PLM_outdir = Path("data/dataset/EMITL2BCH4PLM")
+    EMITL2ARFL_outdir.mkdir(parents=True, exist_ok=True)
+    EMITL2BCH4PLM_outdir.mkdir(parents=True, exist_ok=True)
+
+    for EMITL2ARFL_url, pairs in scenes.items():
+        # ストリームを開いてデータを取得 (L2A はグラニュールごとに1回だけ開く)
+        EMITL2ARFL_fp = transport.open(EMITL2ARFL_url)
+        EMITL2BCH4PLM_fps = [
+            (geojson_id, transport.open(url)) for geojson_id, url in pairs
+        ]
+        # 必要な HDF5 のチャンクはまとめて並列に取得する
+        opener = planned_opener(transport, EMITL2ARFL_url)
+        if references is not None:
+            # 参照インデックスがあれば HDF5 のメタデータを読まずに仮想的な Zarr として開く
+            try:
+                refs = references.get(EMITL2ARFL_url, transport)
+                opener = reference_opener(refs, transport.fs)
+            except ValueError as e:
+                print(f"参照インデックスを使わずに読み込みます: {e}")
+        adjacent = None
+        if args.stitch_adjacent:
+            # 隣接シーンの検索と読み込みは L2B がシーンの外にはみ出している場合だけ ortho_scene の中で行われる
+            adjacent = adjacent_finder(transport, EMITL2ARFL_url)
+
+        # L2A の各 L2B の範囲だけをオルソ補正して .npy ファイルに書き込む
+        try:
+            ortho_scene(
+                EMITL2ARFL_fp,
+                EMITL2BCH4PLM_fps,
+                EMITL2ARFL_outdir,
+                EMITL2BCH4PLM_outdir,
+                spectral=spectral_options(args),
+                precision=args.precision,
+                opener=opener,
+                adjacent=adjacent,
+                l2b_format=args.l2b_format,
+            )
+        finally:
+            EMITL2ARFL_fp.close()
+            for _, EMITL2BCH4PLM_fp in EMITL2BCH4PLM_fps:
+                EMITL2BCH4PLM_fp.close()
+
+    # シャードの場合は merge_manifests.py でまとめた後にマニフェストを作成する
+    if shard is None:
+        build_manifest("data/dataset")
+        build_band_stats("data/dataset")
 
 
 if __name__ == "__main__":
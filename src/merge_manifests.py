@@ -0,0 +1,52 @@
+"""
+--shard i/N で分割して作成したデータセットのマニフェストを1つにまとめるスクリプト
+
+dataset.shard-i-of-N.csv -> dataset.csv
+meta/*.json, dataset.csv -> manifest.parquet
+stats/*.npz -> band_stats.npz, band_stats.json
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.append("modules")
+from sharding import merge_csv_manifests, shard_paths
+from manifest import MANIFEST_NAME, build_manifest
+from band_stats import BAND_STATS_NAME, build_band_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge sharded dataset manifests.")
+    parser.add_argument(
+        "--dataset",
+        "-d",
+        type=str,
+        default="data/dataset",
+        help="Dataset directory containing the manifest shards",
+    )
+    args = parser.parse_args()
+
+    dataset_dir = Path(args.dataset)
+    # ortho_dataset.py のシャードは dataset.csv を持たないため, meta だけからマニフェストを作成する
+    if (dataset_dir / "dataset.csv").exists() or shard_paths(
+        dataset_dir / "dataset.csv"
+    ):
+        merged = merge_csv_manifests(dataset_dir / "dataset.csv")
+        print(f"{len(merged)} 件を {dataset_dir / 'dataset.csv'} にまとめました.")
+    try:
+        manifest = build_manifest(dataset_dir)
+        band_stats = build_band_stats(dataset_dir)
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit(1)
+    print(
+        f"{len(manifest)} 件のマニフェストを {dataset_dir / MANIFEST_NAME} に作成しました."
+    )
+    print(
+        f"{band_stats.bands} バンドの統計量を {dataset_dir / BAND_STATS_NAME}.json に作成しました."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,80 +1,22 @@
 import argparse
-import rasterio
-from rasterio.warp import calculate_default_transform, reproject, Resampling
-import numpy as np
 import sys
 from pathlib import Path
-import concurrent.futures
 
-sys.path.append("python/modules/")
-from emit_tools import emit_xarray
+sys.path.append("modules")
+from dataset_tools import ortho_scene
+from sharding import parse_shard, select_shard
+from executors import add_executor_arguments, executor_from_args
+from granule_cache import granule_key, orbit_key
+from mosaic import adjacent_granules
+from labels import L2B_FORMATS
+from manifest import build_manifest
+from band_stats import build_band_stats
+from precision import PRECISIONS
+from spectral_select import add_spectral_arguments, spectral_options
 
 MAX_WORKERS = 8
 
 
-def ortho_file_pair(geojson_id, l2a_file, l2b_file, l2a_outdir, l2b_outdir):
-    # 出力ファイル名を生成
-    l2a_dst = l2a_outdir / f"{geojson_id}.npy"
-    l2b_dst = l2b_outdir / f"{geojson_id}.npy"
-
-    if l2a_dst.exists() and l2b_dst.exists():
-        print(
-            f"\nファイル {l2a_dst} および {l2b_dst} は既に存在しています。スキップします。"
-        )
-        return
-
-    print(f"\nProcessing file pair:\n  L2A: {l2a_file}\n  L2B: {l2b_file}")
-
-    try:
-        # L2Aデータのオルソ処理
-        l2a_geo = emit_xarray(str(l2a_file), ortho=True)
-        l2a_geo.reflectance.data[l2a_geo.reflectance.data == -9999] = 0  # 欠損値を0に
-
-        # L2Bデータのオルソ処理
-        with rasterio.open(str(l2b_file)) as src:
-            # オルソ補正パラメータの計算
-            transform, width, height = calculate_default_transform(
-                src.crs, src.crs, src.width, src.height, *src.bounds
-            )
-            # 出力用配列の作成
-            l2b_ortho = np.empty((src.count, height, width), dtype=src.dtypes[0])
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=rasterio.band(src, i),
-                    destination=l2b_ortho[i - 1],
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=src.crs,
-                    resampling=Resampling.nearest,
-                )
-            l2b_ortho = l2b_ortho.squeeze()
-            # L2Bのバウンディングボックスを取得
-            bbox = src.bounds
-            print(f"bbox: {bbox}")
-
-        # L2Aデータを L2B のバウンディングボックスでくり抜く
-        l2a_cropped = l2a_geo.reflectance.sel(
-            longitude=slice(bbox.left, bbox.right),
-            latitude=slice(bbox.top, bbox.bottom),
-        )
-
-        # データを保存
-        np.save(l2a_dst, l2a_cropped.data)
-        np.save(l2b_dst, l2b_ortho)
-        print(f"保存完了: \n  L2A -> {l2a_dst}\n  L2B -> {l2b_dst}")
-    except Exception as e:
-        print(
-            f"{geojson_id} の処理でエラーが発生しました。エラー内容: {e}. このペアはスキップします。"
-        )
-        # 途中で生成されたファイルがあれば削除
-        if l2a_dst.exists():
-            l2a_dst.unlink()
-        if l2b_dst.exists():
-            l2b_dst.unlink()
-        return
-
-
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -100,6 +42,33 @@ def main():
         default="data/dataset",
         help="Output directory",
     )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=list(PRECISIONS),
+        default="float32",
+        help="Storage precision of reflectance (int16 is scaled, see meta/<id>.json)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        default=None,
+        help="Process only shard i of N (i/N) of the file pairs",
+    )
+    parser.add_argument(
+        "--l2b_format",
+        type=str,
+        choices=L2B_FORMATS,
+        default="npy",
+        help="Store L2B as a dense .npy or as run-length encoded plume pixels (.npz)",
+    )
+    parser.add_argument(
+        "--stitch_adjacent",
+        action="store_true",
+        help="Fill plume pixels outside the L2A swath from adjacent scenes in --l2a_dir",
+    )
+    add_spectral_arguments(parser)
+    add_executor_arguments(parser, max_workers=MAX_WORKERS)
     args = parser.parse_args()
 
     l2a_dir = Path(args.l2a_dir)
@@ -138,25 +107,65 @@ def main():
         print("有効なファイルペアが見つかりませんでした")
         sys.exit(1)
 
-    # プロセスプールを使って並列処理
-    with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = []
+    # 同じ L2A グラニュールのペアをまとめ, グラニュールごとに1回だけ L2A を開いてオルソ補正する
+    scenes = {}  # {granule_key: (l2a_file, [(geojson_id, l2b_file), ...])}
+    for geojson_id in sorted(valid_pairs):
+        l2a_file, l2b_file = valid_pairs[geojson_id]
+        l2a_file, pairs = scenes.setdefault(granule_key(l2a_file), (l2a_file, []))
+        pairs.append((geojson_id, l2b_file))
+
+    # --shard を指定した場合は, このノードが担当するグラニュールのペアのみを処理する
+    # (グラニュール単位で分けるため, 同じ L2A を複数のノードで開かずに済む)
+    shard_keys = select_shard(sorted(scenes), parse_shard(args.shard))
+    scenes = {key: scenes[key] for key in shard_keys}
+    if not scenes:
+        # 担当が無いのはエラーではないため, ジョブスケジューラが失敗と扱わないように正常終了する
+        print("このシャードが担当するファイルペアはありません")
+        return
+    print(
+        f"{sum(len(pairs) for _, pairs in scenes.values())} 件のペアを "
+        f"{len(scenes)} 件の L2A グラニュールで処理します"
+    )
 
-        # L2A, L2Bのファイルペアごとに処理
-        for geojson_id, (l2a_file, l2b_file) in valid_pairs.items():
-            futures.append(
-                executor.submit(
-                    ortho_file_pair,
-                    geojson_id,
-                    l2a_file,
-                    l2b_file,
-                    l2a_outdir,
-                    l2b_outdir,
-                )
+    # グラニュールごとのタスクを選択したエグゼキュータで並列処理
+    options = {
+        "spectral": spectral_options(args),
+        "precision": args.precision,
+        "l2b_format": args.l2b_format,
+    }
+    tasks = [
+        ((l2a_file, pairs, l2a_outdir, l2b_outdir), options)
+        for l2a_file, pairs in scenes.values()
+    ]
+    if args.stitch_adjacent:
+        # --l2a_dir にある同じ軌道の隣接シーンを, シーンの外にはみ出したプルームの補完に使う
+        candidates = sorted(l2a_dir.glob("*.nc"))
+        tasks = [
+            (
+                task,
+                dict(
+                    options,
+                    adjacent=[
+                        (fp, None) for fp in adjacent_granules(task[0], candidates)
+                    ],
+                ),
             )
+            for task, options in tasks
+        ]
+    # affinity では同じ軌道のシーンを同じワーカーに割り当てる.
+    # シーンごとのキーでは各キーのタスクが1つしかなく, 隣接シーンのつなぎ合わせで開いたファイルと GLT を使い回せない
+    keys = [orbit_key(l2a_file) for l2a_file, _ in scenes.values()]
+    executor = executor_from_args(args)
+    try:
         # 全タスクの完了を待機
-        for future in concurrent.futures.as_completed(futures):
-            future.result()
+        for _ in executor.run(ortho_scene, tasks, keys=keys):
+            pass
+    finally:
+        executor.close()
+    # シャードの場合は merge_manifests.py でまとめた後にマニフェストを作成する
+    if args.shard is None:
+        build_manifest(outdir)
+        build_band_stats(outdir)
     print("\n全ての処理が完了しました。")
 
 
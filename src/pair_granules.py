@@ -0,0 +1,83 @@
+"""
+日付範囲内の EMITL2ARFL と EMITL2BCH4PLM のグラニュールを一括でペアにし, csv に書き出すスクリプト
+--match_scene では軌道番号・シーン番号を持つ EMITL2BCH4ENH と対応付ける.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import earthaccess
+from dotenv import load_dotenv
+
+sys.path.append("modules")
+from granule_pairing import pair_date_range
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pair EMITL2ARFL and EMITL2BCH4PLM granules in a date range."
+    )
+    parser.add_argument(
+        "--start_date",
+        type=str,
+        default="2023-01-01",
+        help="Start date for search (YYYY-MM-DD)",
+    )
+    parser.add_argument(
+        "--end_date",
+        type=str,
+        default="2024-12-31",
+        help="End date for search (YYYY-MM-DD)",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=str,
+        default="1s",
+        help="Time tolerance for pairing L2A and L2B granules (e.g. 1s, 500ms)",
+    )
+    parser.add_argument(
+        "--match_scene",
+        action="store_true",
+        help="Only pair granules with the same orbit and scene number (pairs with EMITL2BCH4ENH)",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="data/dataset/granule_pairs.csv",
+        help="Output csv path",
+    )
+    args = parser.parse_args()
+
+    load_dotenv()
+    auth = earthaccess.login(strategy="environment", persist=True)
+    if not auth:
+        print("Earthdata Login に失敗しました.")
+        sys.exit(1)
+
+    pairs = pair_date_range(
+        (args.start_date, args.end_date),
+        tolerance=args.tolerance,
+        match_scene=args.match_scene,
+    )
+    if pairs.empty:
+        print("ペアが見つかりませんでした.")
+        sys.exit(1)
+
+    output_path = Path(args.output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    l2b_product = "CH4ENH" if args.match_scene else "CH4PLM"
+    columns = [
+        "timestamp",
+        "native_id_l2a",
+        "native_id_l2b",
+        "cloud_cover_l2a",
+        "EMITL2ARFL_url",
+        f"EMITL2B{l2b_product}_url",
+    ]
+    pairs[columns].to_csv(output_path, index=False)
+    print(f"{len(pairs)} 件のペアを {output_path} に書き出しました.")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,13 @@ from dotenv import load_dotenv
 import earthaccess
 import earthaccess
 import rasterio
-from rasterio.warp import calculate_default_transform, reproject, Resampling
 import numpy as np
 import sys
 from pathlib import Path
 
-sys.path.append("../modules/")
+sys.path.append("modules")
 from emit_tools import emit_xarray
+from dataset_tools import read_l2b
 
 
 def main():
@@ -42,30 +42,8 @@ def main():
 
     # L2Bデータのオルソ化
     with rasterio.open(l2b_path) as src:
-        # オルソ補正のための変換パラメータを計算する
-        transform, width, height = calculate_default_transform(
-            src.crs, src.crs, src.width, src.height, *src.bounds
-        )
-
-        # オルソ補正されたデータを格納するためのメタデータを更新
-        kwargs = src.meta.copy()
-        kwargs.update(
-            {"crs": src.crs, "transform": transform, "width": width, "height": height}
-        )
-
-        # オルソ補正してデータを保存
-        l2b_ortho = np.empty((src.count, height, width), dtype=src.dtypes[0])
-        for i in range(1, src.count + 1):
-            reproject(
-                source=rasterio.band(src, i),
-                destination=l2b_ortho[i - 1],
-                src_transform=src.transform,
-                src_crs=src.crs,
-                dst_transform=transform,
-                dst_crs=src.crs,
-                resampling=Resampling.nearest,  # 最近傍補間
-            )
-        l2b_ortho = l2b_ortho.squeeze()
+        # L2B は既にグリッド化されているため, 再投影せずそのまま読み込む
+        l2b_ortho, _ = read_l2b(src)
         # l2b_orthoの欠損値処理
         # l2b_ortho[l2b_ortho == -9999] = np.nan
         l2b_ortho[l2b_ortho == -9999] = 0
@@ -0,0 +1,83 @@
+"""
+L2A のブラウズ画像 (PNG) をまとめてオルソ補正し, Cloud Optimized GeoTIFF またはタイル分割した PNG に書き出すスクリプト
+
+--l2a_dir の .nc ごとに, --browse_dir にある同じ名前の .png をブラウズ画像として使う.
+同じ L2A グラニュールの画像は affinity のエグゼキュータで同じワーカーに割り当て, GLT の復号を1回で済ませる.
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.append("modules")
+from browse import BROWSE_FORMATS, render_browses
+from executors import add_executor_arguments, executor_from_args
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Orthorectify EMIT browse images.")
+    parser.add_argument(
+        "--l2a_dir",
+        type=str,
+        default="data/dataset/l2a",
+        help="L2A data directory (e.g. containing .nc files)",
+    )
+    parser.add_argument(
+        "--browse_dir",
+        type=str,
+        default=None,
+        help="Directory of browse PNGs named like the L2A files (default: l2a_dir)",
+    )
+    parser.add_argument(
+        "--out_dir", type=str, default="data/browse", help="Output directory"
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=BROWSE_FORMATS,
+        default="cog",
+        help="Cloud-optimized GeoTIFF or tiled PNG with world files",
+    )
+    parser.add_argument(
+        "--black_background",
+        action="store_true",
+        help="Fill pixels outside the swath with black instead of white",
+    )
+    add_executor_arguments(parser)
+    args = parser.parse_args()
+
+    browse_dir = Path(args.browse_dir or args.l2a_dir)
+    out_dir = Path(args.out_dir)
+    suffix = ".tif" if args.format == "cog" else ".png"
+    jobs = []
+    for l2a_file in sorted(Path(args.l2a_dir).glob("*.nc")):
+        browse_file = browse_dir / f"{l2a_file.stem}.png"
+        if browse_file.exists():
+            jobs.append(
+                (l2a_file, str(browse_file), out_dir / f"{l2a_file.stem}{suffix}")
+            )
+    if not jobs:
+        print("ブラウズ画像が見つかりませんでした")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    executor = executor_from_args(args)
+    try:
+        paths = render_browses(
+            jobs,
+            executor,
+            fmt=args.format,
+            white_background=not args.black_background,
+        )
+    finally:
+        executor.close()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{len(jobs)} 枚のブラウズ画像を {elapsed:.1f} 秒で書き出しました"
+        f" ({len(jobs) / elapsed:.1f} 枚/秒, {len(paths)} ファイル)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,94 @@
-import json
-import folium
+import sys
 import argparse
 from pathlib import Path
-from shapely.geometry import shape, box
 
-
-def create_bbox_feature(file, bbox):
+import geopandas as gpd
+import shapely
+
+sys.path.append("modules")
+from footprints import load_footprints
+from footprint_index import FootprintIndex
+
+# --export fgb で FlatGeobuf と一緒に書き出す軽量ビューア
+# FlatGeobuf の空間インデックスを使い, 表示範囲のフィーチャだけを HTTP の Range リクエストで読み込む
+VIEWER_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Plume footprints</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<script src="https://unpkg.com/flatgeobuf@3.36.0/dist/flatgeobuf-geojson.min.js"></script>
+<style>
+  html, body, #map {{ height: 100%; margin: 0; }}
+  #status {{ position: absolute; bottom: 10px; left: 10px; z-index: 1000;
+             background: white; padding: 4px 8px; font: 12px sans-serif; }}
+</style>
+</head>
+<body>
+<div id="map"></div>
+<div id="status"></div>
+<script>
+const FGB_URL = "{fgb_name}";
+const MAX_FEATURES = {max_features};
+const map = L.map("map").fitBounds([[{miny}, {minx}], [{maxy}, {maxx}]]);
+L.tileLayer("https://{{s}}.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png", {{
+  attribution: "&copy; OpenStreetMap contributors",
+}}).addTo(map);
+const layer = L.geoJSON(null, {{
+  style: {{ color: "blue", fillColor: "blue", fillOpacity: 0.2, weight: 2 }},
+  onEachFeature: (feature, l) => l.bindTooltip(feature.properties.name),
+}}).addTo(map);
+const status = document.getElementById("status");
+let generation = 0;
+
+async function load() {{
+  const current = ++generation;
+  const b = map.getBounds();
+  const rect = {{ minX: b.getWest(), minY: b.getSouth(), maxX: b.getEast(), maxY: b.getNorth() }};
+  const features = [];
+  for await (const feature of flatgeobuf.deserialize(FGB_URL, rect)) {{
+    if (current !== generation) return;
+    features.push(feature);
+    if (features.length >= MAX_FEATURES) break;
+  }}
+  layer.clearLayers();
+  layer.addData(features);
+  status.textContent = features.length >= MAX_FEATURES
+    ? `${{MAX_FEATURES}} 件まで表示しています (拡大してください)`
+    : `${{features.length}} 件`;
+}}
+map.on("moveend", load);
+load();
+</script>
+</body>
+</html>
+"""
+
+
+def bbox_frame(footprints):
     """
-    bbox (minx, miny, maxx, maxy) からポリゴンを生成し、
-    GeoJSON の Feature として返す。
+    フットプリントの bbox のポリゴン (shapely.box でまとめて作成) の GeoDataFrame を返す.
     """
-    # shapely の box を利用してポリゴンを作成
-    poly = box(*bbox)
-    feature = {
-        "type": "Feature",
-        "geometry": poly.__geo_interface__,
-        "properties": {"name": file.name, "bbox": bbox},
-    }
-    return feature
+    bounds = footprints[["minx", "miny", "maxx", "maxy"]].to_numpy()
+    return gpd.GeoDataFrame(
+        {"name": footprints["name"].to_numpy(), "bbox": bounds.tolist()},
+        geometry=shapely.box(*bounds.T),
+        crs=footprints.crs,
+    )
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="GeoJSONファイルのbboxを地図上に表示する"
-    )
-    parser.add_argument(
-        "--geojson_dir",
-        type=str,
-        default="data/dataset/geojsons",
-        help="GeoJSONファイルが保存されているディレクトリ",
-    )
-    args = parser.parse_args()
-    geojson_dir = Path(args.geojson_dir)
-    if not geojson_dir.exists():
-        print(f"ディレクトリが存在しません: {geojson_dir}")
-        return
+def export_html(footprints, output_map):
+    """
+    全ての bbox を folium の地図に埋め込んで1つの HTML に保存する (数千件程度まで).
+    """
+    import folium
 
     # 地図の作成
     m = folium.Map(location=[0, 0], zoom_start=2)
 
-    features = []  # 各ファイルのbboxを格納するリスト
-
-    for file in geojson_dir.glob("*.json"):
-        try:
-            data = json.loads(file.read_text(encoding="utf-8"))
-            features_list = data.get("features", [])
-            if not features_list:
-                continue
-
-            # 各ファイル内のフィーチャの bbox を個別に計算し、全体の bbox を求める
-            file_bounds = []
-            for feature in features_list:
-                geom = feature.get("geometry")
-                if not geom:
-                    continue
-                shp = shape(geom)
-                file_bounds.append(shp.bounds)
-            if file_bounds:
-                minx = min(bounds[0] for bounds in file_bounds)
-                miny = min(bounds[1] for bounds in file_bounds)
-                maxx = max(bounds[2] for bounds in file_bounds)
-                maxy = max(bounds[3] for bounds in file_bounds)
-                bbox = (minx, miny, maxx, maxy)
-                feat = create_bbox_feature(file, bbox)
-                features.append(feat)
-        except Exception as e:
-            print(f"{file} の読み込みに失敗: {e}")
-
     # 作成した bbox を FeatureCollection としてまとめる
-    feature_collection = {"type": "FeatureCollection", "features": features}
+    feature_collection = bbox_frame(footprints)
 
     # style_function により bbox の表示スタイルを定義
     def style_function(feature):
@@ -80,7 +100,7 @@ def main():
         }
 
     folium.GeoJson(
-        feature_collection,
+        feature_collection.to_json(),
         name="GeoJSON Bounding Boxes",
         style_function=style_function,
         tooltip=folium.GeoJsonTooltip(
@@ -89,14 +109,8 @@ def main():
     ).add_to(m)
 
     # 全てのbbox を囲む範囲を計算して、地図の表示範囲を自動調整する
-    if features:
-        minx = min(feat["properties"]["bbox"][0] for feat in features)
-        miny = min(feat["properties"]["bbox"][1] for feat in features)
-        maxx = max(feat["properties"]["bbox"][2] for feat in features)
-        maxy = max(feat["properties"]["bbox"][3] for feat in features)
-        m.fit_bounds([[miny, minx], [maxy, maxx]])
-    else:
-        print("有効な bounding box が見つかりませんでした。")
+    minx, miny, maxx, maxy = footprints.total_bounds
+    m.fit_bounds([[miny, minx], [maxy, maxx]])
 
     # 凡例（カスタムHTML）の追加
     # legend_html = """
@@ -115,10 +129,90 @@ def main():
     # m.get_root().html.add_child(folium.Element(legend_html))
 
     # 地図をHTMLファイルとして保存
-    output_map = Path("geojsons_bbox_map.html")
     m.save(str(output_map))
     print(f"地図を {output_map} として出力しました。")
 
 
+def export_flatgeobuf(footprints, output_dir, max_features=5000):
+    """
+    フットプリントを空間インデックス付きの FlatGeobuf に書き出し, 表示範囲だけを読み込むビューアを作成する.
+    ビューアは Range リクエストに対応した HTTP サーバー (nginx, npx http-server, S3 など) で配信する.
+    python -m http.server は Range リクエストに対応していないため使えない.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    fgb_path = output_dir / "footprints.fgb"
+    footprints.to_file(fgb_path, driver="FlatGeobuf", SPATIAL_INDEX="YES")
+    minx, miny, maxx, maxy = footprints.total_bounds
+    viewer_path = output_dir / "index.html"
+    viewer_path.write_text(
+        VIEWER_HTML.format(
+            fgb_name=fgb_path.name,
+            max_features=max_features,
+            minx=minx,
+            miny=miny,
+            maxx=maxx,
+            maxy=maxy,
+        ),
+        encoding="utf-8",
+    )
+    print(f"{len(footprints)} 件のフットプリントを {fgb_path} に出力しました。")
+    print(
+        f"ビューア: {output_dir} を Range リクエストに対応した HTTP サーバー"
+        f" (npx http-server {output_dir} など) で配信して index.html を開いてください。"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="GeoJSONファイルのbboxを地図上に表示する"
+    )
+    parser.add_argument(
+        "--geojson_dir",
+        type=str,
+        default="data/dataset/geojsons",
+        help="GeoJSONファイルが保存されているディレクトリ",
+    )
+    parser.add_argument(
+        "--export",
+        type=str,
+        choices=["html", "fgb"],
+        default="html",
+        help="html: 1つの folium の地図, fgb: FlatGeobuf と表示範囲だけを読み込むビューア",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="footprints_map",
+        help="--export fgb の出力先ディレクトリ",
+    )
+    parser.add_argument(
+        "--index",
+        type=str,
+        default=None,
+        help="Footprint index (GeoParquet) to update incrementally instead of reading every GeoJSON",
+    )
+    args = parser.parse_args()
+    geojson_dir = Path(args.geojson_dir)
+    if not geojson_dir.exists():
+        print(f"ディレクトリが存在しません: {geojson_dir}")
+        return
+
+    # 各ファイル内のフィーチャを結合したフットプリントの bbox を取得
+    if args.index:
+        index = FootprintIndex.update(geojson_dir, args.index)
+        footprints = index.footprints.drop(columns=["mtime_ns", "size"])
+    else:
+        footprints = load_footprints(geojson_dir)
+    if footprints.empty:
+        print("有効な bounding box が見つかりませんでした。")
+        return
+
+    if args.export == "fgb":
+        export_flatgeobuf(footprints, args.output_dir)
+    else:
+        export_html(footprints, Path("geojsons_bbox_map.html"))
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# src/ のスクリプトと同じく modules/ のモジュールを直接 import する
+sys.path.append(str(Path(__file__).resolve().parents[1] / "modules"))
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from band_stats import BandStats, build_band_stats, merge_band_stats
+from precision import encoder, precision_spec
+
+
+@pytest.fixture
+def cubes():
+    rng = np.random.default_rng(0)
+    cubes = [
+        rng.normal(0.3 + 0.1 * k, 0.05 * (k + 1), (8 + k, 6, 4)).astype(np.float32)
+        for k in range(3)
+    ]
+    # 1つのサンプルの1バンドは全て欠損 (件数 0 のサンプルのマージ)
+    cubes[1][..., 3] = 0
+    return cubes
+
+
+def single_pass(cubes, spec):
+    """
+    全サンプルの有効な画素をまとめて numpy で計算した統計量.
+    """
+    values = np.concatenate([c.reshape(-1, c.shape[-1]) for c in cubes])
+    values = values.astype(np.float64)
+    valid = values != spec["nodata"]
+    values = values * spec["scale"] + spec["offset"]
+    columns = [values[valid[:, b], b] for b in range(values.shape[1])]
+    return columns
+
+
+@pytest.mark.parametrize("name", ["float32", "int16"])
+def test_merge_matches_single_pass(cubes, tmp_path, name):
+    spec = precision_spec(name)
+    encoded = [encoder(spec)(cube) for cube in cubes]
+    for k, cube in enumerate(encoded):
+        BandStats.from_cube(cube, spec).save(tmp_path / f"{k}.npz")
+    merged = merge_band_stats(sorted(tmp_path.glob("*.npz")))
+
+    columns = single_pass(encoded, spec)
+    assert merged.count.tolist() == [len(c) for c in columns]
+    np.testing.assert_allclose(merged.mean, [c.mean() for c in columns], rtol=1e-12)
+    np.testing.assert_allclose(merged.std, [c.std() for c in columns], rtol=1e-9)
+    np.testing.assert_array_equal(merged.min, [c.min() for c in columns])
+    np.testing.assert_array_equal(merged.max, [c.max() for c in columns])
+    # 範囲外の値は両端のビンに入る
+    low, high = merged.value_range
+    bins = merged.hist.shape[1]
+    hist = [
+        np.bincount(
+            np.clip(np.floor((c - low) / (high - low) * bins), 0, bins - 1).astype(int),
+            minlength=bins,
+        )
+        for c in columns
+    ]
+    np.testing.assert_array_equal(merged.hist, hist)
+    assert merged.hist.sum(axis=1).tolist() == merged.count.tolist()
+
+
+def test_merge_rejects_mismatched_bands():
+    with pytest.raises(ValueError):
+        BandStats(4).merge(BandStats(3))
+    with pytest.raises(ValueError):
+        BandStats(4).merge(BandStats(4, value_range=(0, 1)))
+
+
+def test_build_band_stats_summary(cubes, tmp_path):
+    stats_dir = tmp_path / "stats"
+    stats_dir.mkdir()
+    BandStats.from_cube(cubes[0]).save(stats_dir / "1.npz")
+    BandStats(4).save(stats_dir / "2.npz")
+    merged = build_band_stats(tmp_path)
+    assert (tmp_path / "band_stats.npz").exists()
+    np.testing.assert_allclose(
+        merged.mean, cubes[0].reshape(-1, 4).mean(axis=0), rtol=1e-6
+    )
+    # 有効な画素がないバンドは null になる
+    summary = BandStats(2).summary()
+    assert summary["mean"] == [None, None] and summary["std"] == [None, None]
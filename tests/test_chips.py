@@ -0,0 +1,109 @@
+import csv
+
+import numpy as np
+import pytest
+
+from chips import ChipWriter, chip_offsets, plume_pixel_counts, select_chips
+from labels import SparseL2B
+
+
+@pytest.mark.parametrize(
+    "shape, size, stride",
+    [((100, 70), 32, 16), ((64, 64), 32, 32), ((65, 40), 32, 32), ((20, 50), 32, 8)],
+)
+def test_chip_offsets_cover_image(shape, size, stride):
+    offsets = chip_offsets(shape, size, stride)
+    covered = np.zeros(shape, dtype=bool)
+    for row, col in offsets:
+        covered[row : row + size, col : col + size] = True
+    assert covered.all()
+    # チップは画像からはみ出さない (画像が小さい場合は 0 から始める)
+    assert (offsets[:, 0] <= max(shape[0] - size, 0)).all()
+    assert (offsets[:, 1] <= max(shape[1] - size, 0)).all()
+    assert len(np.unique(offsets, axis=0)) == len(offsets)
+
+
+def test_chip_offsets_align_last_chip_to_edge():
+    offsets = chip_offsets((70, 64), 32, 32)
+    assert sorted(set(offsets[:, 0].tolist())) == [0, 32, 38]
+    assert sorted(set(offsets[:, 1].tolist())) == [0, 32]
+
+
+def test_plume_pixel_counts_match_brute_force():
+    rng = np.random.default_rng(0)
+    mask = rng.random((45, 37)) > 0.8
+    for size, stride in [(16, 8), (50, 10)]:
+        offsets = chip_offsets(mask.shape, size, stride)
+        expected = [
+            mask[row : row + size, col : col + size].sum() for row, col in offsets
+        ]
+        assert plume_pixel_counts(mask, offsets, size).tolist() == expected
+
+
+def test_select_chips_balances_positives_and_negatives():
+    counts = np.array([0] * 20 + [3] * 5 + [1] * 5)
+    selected = select_chips(
+        counts, 0.5, min_plume_pixels=2, rng=np.random.default_rng(0)
+    )
+    positives = selected[counts[selected] >= 2]
+    negatives = selected[counts[selected] < 2]
+    assert positives.tolist() == list(range(20, 25))
+    assert len(negatives) == 5
+    assert (np.diff(selected) > 0).all()
+
+    # 正例の比率を下げると負例が増える (負例の数を超えない)
+    assert len(select_chips(counts, 0.25, 2, np.random.default_rng(0))) == 20
+    assert len(select_chips(counts, 0.1, 2, np.random.default_rng(0))) == 30
+    # None は全て, 0 以下は全ての負例を残す
+    assert select_chips(counts, None).tolist() == list(range(30))
+    assert len(select_chips(counts, 0, 2, np.random.default_rng(0))) == 30
+
+
+def test_select_chips_is_reproducible_with_seed():
+    counts = np.array([0] * 50 + [1] * 10)
+    first = select_chips(counts, 0.5, rng=np.random.default_rng(3))
+    second = select_chips(counts, 0.5, rng=np.random.default_rng(3))
+    assert first.tolist() == second.tolist()
+
+
+def test_chip_writer_shards_and_index(tmp_path):
+    rng = np.random.default_rng(0)
+    l2a = rng.random((40, 30, 3)).astype(np.float32)
+    l2b = np.where(rng.random((40, 30)) > 0.9, 5.0, 0.0).astype(np.float32)
+    size = 16
+    offsets = chip_offsets(l2b.shape, size, 16)
+    counts = plume_pixel_counts(l2b > 0, offsets, size)
+
+    writer = ChipWriter(tmp_path, size, shard_size=4)
+    writer.add("7", l2a, SparseL2B.from_dense(l2b), offsets, counts)
+    # チップより小さいサンプルは 0 で埋めて1チップにする
+    writer.add("8", l2a[:10, :12], l2b[:10, :12], np.array([[0, 0]]), np.array([0]))
+    with open(writer.close(), encoding="utf-8") as f:
+        index = list(csv.DictReader(f))
+
+    assert len(index) == len(offsets) + 1
+    shards = {}
+    for record in index:
+        name = record["shard"]
+        if name not in shards:
+            shards[name] = (
+                np.load(tmp_path / f"{name}.l2a.npy"),
+                np.load(tmp_path / f"{name}.l2b.npy"),
+            )
+        chip_l2a, chip_l2b = (a[int(record["offset"])] for a in shards[name])
+        row, col = int(record["row"]), int(record["col"])
+        if record["geojson_id"] == "7":
+            np.testing.assert_array_equal(
+                chip_l2a, l2a[row : row + size, col : col + size]
+            )
+            np.testing.assert_array_equal(
+                chip_l2b, l2b[row : row + size, col : col + size]
+            )
+            assert int(record["plume_pixels"]) == int((chip_l2b > 0).sum())
+            assert record["label"] == str(int(int(record["plume_pixels"]) >= 1))
+        else:
+            assert chip_l2a.shape == (size, size, 3)
+            np.testing.assert_array_equal(chip_l2a[:10, :12], l2a[:10, :12])
+            assert not chip_l2a[10:].any() and not chip_l2a[:, 12:].any()
+    assert all(len(a) <= 4 for a, _ in shards.values())
+    assert len(shards) == -(-len(index) // 4)
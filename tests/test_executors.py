@@ -0,0 +1,87 @@
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from executors import AffinityExecutor, LocalExecutor
+
+
+def work(i, crash=(), flaky_dir=None):
+    """
+    crash に含まれるタスクはワーカーを落とす. flaky_dir を指定した場合は最初の1回だけ落とす.
+    """
+    if i in crash:
+        marker = os.path.join(flaky_dir, str(i)) if flaky_dir else None
+        if marker is None or not os.path.exists(marker):
+            if marker is not None:
+                open(marker, "w").close()
+            os._exit(1)
+    return i
+
+
+def fail_once(i, flaky_dir):
+    """
+    最初の1回だけ例外を送出する (dask の retries の確認用).
+    """
+    marker = os.path.join(flaky_dir, str(i))
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        raise RuntimeError(f"task {i} failed")
+    return i
+
+
+def tasks(n, **kwargs):
+    return [((i,), kwargs) for i in range(n)]
+
+
+@pytest.fixture(params=["local", "affinity"])
+def executor(request):
+    if request.param == "local":
+        executor = LocalExecutor(max_workers=2, retries=1)
+    else:
+        executor = AffinityExecutor(max_workers=2, retries=1)
+    yield executor
+    executor.close()
+
+
+def test_retry_after_worker_crash(executor, tmp_path):
+    results = executor.run(work, tasks(4, crash=(2,), flaky_dir=str(tmp_path)))
+    assert sorted(results) == [0, 1, 2, 3]
+    assert os.path.exists(tmp_path / "2")
+
+
+def test_crash_beyond_retries_raises(executor):
+    with pytest.raises(BrokenProcessPool):
+        list(executor.run(work, tasks(4, crash=(1,))))
+
+
+def test_affinity_reuses_executor_after_crash(tmp_path):
+    executor = AffinityExecutor(max_workers=2, retries=1)
+    try:
+        keys = ["a", "a", "b", "b"]
+        first = executor.run(work, tasks(4, crash=(0,), flaky_dir=str(tmp_path)), keys)
+        assert sorted(first) == [0, 1, 2, 3]
+        # 作り直したワーカーで次の run も実行できる
+        assert sorted(executor.run(work, tasks(4), keys)) == [0, 1, 2, 3]
+    finally:
+        executor.close()
+
+
+def test_affinity_assigns_same_key_to_same_worker():
+    executor = AffinityExecutor(max_workers=2)
+    assignment = executor.assign(["a", "b", "a", "c", "a"])
+    assert assignment[0] == assignment[2] == assignment[4]
+    assert assignment[1] != assignment[0]
+    assert assignment[3] != assignment[0]
+
+
+def test_dask_local_cluster_retries(tmp_path):
+    pytest.importorskip("dask.distributed")
+    from executors import DaskExecutor
+
+    executor = DaskExecutor(max_workers=2, retries=1)
+    try:
+        results = executor.run(fail_once, tasks(3, flaky_dir=str(tmp_path)))
+        assert sorted(results) == [0, 1, 2]
+    finally:
+        executor.close()
@@ -0,0 +1,70 @@
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+
+from granule_pairing import pair_granules
+
+URL = "https://data.lpdaac.earthdatacloud.nasa.gov/lp-prod-protected"
+
+
+def granules(product, native_ids, time_column, times):
+    """
+    results_to_geopandas と同じ列を持つ検索結果を作成する.
+    """
+    return gpd.GeoDataFrame(
+        {
+            "native-id": native_ids,
+            "_related_urls": [
+                [{"Type": "GET DATA", "URL": f"{URL}/{product}/{native_id}.nc"}]
+                for native_id in native_ids
+            ],
+            time_column: times,
+            "_cloud_cover": [10.0 * k for k in range(len(native_ids))],
+        },
+        geometry=[box(0, 0, 1, 1)] * len(native_ids),
+    )
+
+
+L2A = granules(
+    "EMITL2ARFL.001",
+    [
+        "EMIT_L2A_RFL_001_20241020T170504_2429411_003",
+        "EMIT_L2A_RFL_001_20241020T170516_2429411_004",
+    ],
+    "_beginning_date_time",
+    ["2024-10-20T17:05:04Z", "2024-10-20T17:05:16Z"],
+)
+
+
+def test_match_scene_pairs_ch4enh_by_orbit_and_scene():
+    # CH4ENH の scene 004 は時刻では scene 003 の方が近いが, 軌道番号・シーン番号で対応付ける
+    l2b = granules(
+        "EMITL2BCH4ENH.001",
+        [
+            "EMIT_L2B_CH4ENH_001_20241020T170504_2429411_003",
+            "EMIT_L2B_CH4ENH_001_20241020T170506_2429411_004",
+        ],
+        "_beginning_date_time",
+        ["2024-10-20T17:05:04Z", "2024-10-20T17:05:06Z"],
+    )
+    pairs = pair_granules(
+        L2A, l2b, tolerance="1min", match_scene=True, l2b_product="CH4ENH"
+    )
+    assert len(pairs) == 2
+    assert (pairs["orbit_l2a"] == 2429411).all()
+    for row in pairs.itertuples():
+        assert row.native_id_l2a[-3:] == row.native_id_l2b[-3:]
+        assert row.EMITL2BCH4ENH_url.endswith(f"{row.native_id_l2b}.nc")
+
+
+def test_match_scene_rejects_ch4plm():
+    l2b = granules(
+        "EMITL2BCH4PLM.001",
+        ["EMIT_L2B_CH4PLM_001_20241020T170504_000123"],
+        "_single_date_time",
+        ["2024-10-20T17:05:04Z"],
+    )
+    with pytest.raises(ValueError):
+        pair_granules(L2A, l2b, match_scene=True)
+    pairs = pair_granules(L2A, l2b)
+    assert pairs["native_id_l2a"].tolist() == [L2A["native-id"][0]]
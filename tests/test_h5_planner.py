@@ -0,0 +1,171 @@
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+
+from h5_planner import (
+    H5Z_FILTER_DEFLATE,
+    H5Z_FILTER_FLETCHER32,
+    H5Z_FILTER_SHUFFLE,
+    ChunkIndex,
+    coalesce,
+    open_group_planned,
+    plan_chunks,
+    read_selection,
+)
+
+FILTERS = {
+    "none": {},
+    "deflate": {"compression": "gzip"},
+    "shuffle_deflate": {"compression": "gzip", "shuffle": True},
+    "fletcher32_shuffle_deflate": {
+        "compression": "gzip",
+        "shuffle": True,
+        "fletcher32": True,
+    },
+}
+
+
+def file_fetcher(path, calls=None):
+    """
+    ローカルのファイルからバイト範囲を読む fetch (Transport.fetch_ranges の代わり).
+    """
+
+    def fetch(ranges):
+        if calls is not None:
+            calls.append(list(ranges))
+        with open(path, "rb") as f:
+            blocks = []
+            for start, end in ranges:
+                f.seek(start)
+                blocks.append(f.read(end - start))
+        return blocks
+
+    return fetch
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    return rng.random((23, 17, 5)).astype(np.float32)
+
+
+def write(path, data, dtype=None, **options):
+    with h5py.File(path, "w") as f:
+        f.create_dataset(
+            "reflectance",
+            data=data if dtype is None else data.astype(dtype),
+            chunks=(8, 6, 5),
+            fillvalue=-9999,
+            **options,
+        )
+
+
+@pytest.mark.parametrize("name", list(FILTERS))
+@pytest.mark.parametrize("dtype", [None, "int16", ">f4"])
+def test_read_selection_decodes_filters(tmp_path, data, name, dtype):
+    path = tmp_path / "a.h5"
+    expected = data if dtype is None else data.astype(dtype)
+    write(path, expected, **FILTERS[name])
+    with h5py.File(path, "r") as f:
+        index = ChunkIndex.from_dataset(f["reflectance"])
+    assert index is not None
+    selection = [np.array([0, 3, 9, 22]), np.arange(4, 17), np.array([1, 4])]
+    got = read_selection(index, selection, file_fetcher(path))
+    np.testing.assert_array_equal(got, expected[np.ix_(*selection)])
+    assert got.dtype == expected.dtype
+
+
+def test_filter_order_matches_h5py(tmp_path, data):
+    path = tmp_path / "a.h5"
+    write(path, data, **FILTERS["fletcher32_shuffle_deflate"])
+    with h5py.File(path, "r") as f:
+        index = ChunkIndex.from_dataset(f["reflectance"])
+    assert index.filters == [
+        H5Z_FILTER_SHUFFLE,
+        H5Z_FILTER_DEFLATE,
+        H5Z_FILTER_FLETCHER32,
+    ]
+
+
+def test_unallocated_chunks_use_fillvalue(tmp_path):
+    path = tmp_path / "a.h5"
+    with h5py.File(path, "w") as f:
+        dset = f.create_dataset(
+            "reflectance", shape=(16, 12), dtype="f4", chunks=(8, 6), fillvalue=-9999
+        )
+        dset[:8, :6] = 1.0
+    with h5py.File(path, "r") as f:
+        index = ChunkIndex.from_dataset(f["reflectance"])
+        expected = f["reflectance"][:]
+    assert len(index.chunks) == 1
+    got = read_selection(index, [np.arange(16), np.arange(12)], file_fetcher(path))
+    np.testing.assert_array_equal(got, expected)
+
+
+def test_filter_mask_skips_filters(tmp_path, data):
+    # filter_mask のビットが立っているフィルタ (deflate) を適用せずに書き込んだチャンク
+    path = tmp_path / "a.h5"
+    write(path, data, **FILTERS["shuffle_deflate"])
+    chunk = np.full((8, 6, 5), 0.5, dtype=np.float32)
+    shuffled = chunk.view(np.uint8).reshape(-1, 4).T.tobytes()
+    with h5py.File(path, "a") as f:
+        f["reflectance"].id.write_direct_chunk((8, 6, 0), shuffled, filter_mask=0b10)
+        expected = f["reflectance"][:]
+    with h5py.File(path, "r") as f:
+        index = ChunkIndex.from_dataset(f["reflectance"])
+    assert index.chunks[(8, 6, 0)][2] == 0b10
+    selection = [np.arange(23), np.arange(17), np.arange(5)]
+    got = read_selection(index, selection, file_fetcher(path))
+    np.testing.assert_array_equal(got, expected)
+    np.testing.assert_array_equal(got[8:16, 6:12], chunk)
+
+
+def test_unsupported_filters_fall_back(tmp_path, data):
+    path = tmp_path / "a.h5"
+    with h5py.File(path, "w") as f:
+        f.create_dataset("lzf", data=data, chunks=(8, 6, 5), compression="lzf")
+        f.create_dataset("contiguous", data=data)
+    with h5py.File(path, "r") as f:
+        assert ChunkIndex.from_dataset(f["lzf"]) is None
+        assert ChunkIndex.from_dataset(f["contiguous"]) is None
+
+
+def test_plan_and_coalesce(tmp_path, data):
+    path = tmp_path / "a.h5"
+    write(path, data)
+    with h5py.File(path, "r") as f:
+        index = ChunkIndex.from_dataset(f["reflectance"])
+    selection = [np.array([7, 8]), np.array([0]), np.arange(5)]
+    assert plan_chunks(index, selection) == [(0, 0, 0), (8, 0, 0)]
+    assert coalesce([(50, 60), (0, 10), (12, 20)], max_gap=2) == [(0, 20), (50, 60)]
+    assert coalesce([(0, 10), (30, 40)], max_gap=5) == [(0, 10), (30, 40)]
+
+    calls = []
+    read_selection(index, selection, file_fetcher(path, calls), max_gap=2**20)
+    assert len(calls) == 1 and len(calls[0]) == 1
+
+
+def test_open_group_planned_matches_h5netcdf(tmp_path, data):
+    xr = pytest.importorskip("xarray")
+    pytest.importorskip("h5netcdf")
+    path = tmp_path / "a.nc"
+    ds = xr.Dataset(
+        {"reflectance": (("downtrack", "crosstrack", "bands"), data)},
+        attrs={"title": "test"},
+    )
+    encoding = {
+        "reflectance": {
+            "chunksizes": (8, 6, 5),
+            "zlib": True,
+            "shuffle": True,
+            "fletcher32": True,
+            "_FillValue": -9999.0,
+        }
+    }
+    ds.to_netcdf(path, engine="h5netcdf", encoding=encoding)
+    with open(path, "rb") as f:
+        planned = open_group_planned(f, None, file_fetcher(path))
+        window = planned["reflectance"][3:20, 2:11].values
+    expected = xr.open_dataset(path, engine="h5netcdf")["reflectance"][3:20, 2:11]
+    np.testing.assert_array_equal(window, expected.values)
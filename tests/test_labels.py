@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from labels import (
+    SparseL2B,
+    binarize,
+    find_l2b_files,
+    load_packed_mask,
+    open_l2b,
+    save_packed_mask,
+)
+
+
+@pytest.fixture
+def l2b():
+    rng = np.random.default_rng(0)
+    data = rng.random((20, 30)).astype(np.float32) * 100
+    data[rng.random(data.shape) > 0.2] = 0
+    data[0, :5] = -9999
+    data[7, 28:] = -9999
+    return data
+
+
+def test_round_trip(l2b, tmp_path):
+    sparse = SparseL2B.from_dense(l2b)
+    sparse.save(tmp_path / "1.npz")
+    loaded = SparseL2B.load(tmp_path / "1.npz")
+    assert loaded.shape == l2b.shape
+    assert loaded.dtype == l2b.dtype
+    np.testing.assert_array_equal(loaded.dense(), l2b)
+    np.testing.assert_array_equal(np.asarray(loaded), l2b)
+    assert loaded.plume_pixels == int(np.count_nonzero(binarize(l2b)))
+    np.testing.assert_array_equal(loaded.mask(), binarize(l2b))
+
+
+def test_round_trip_without_nodata(tmp_path):
+    data = np.zeros((4, 5), dtype=np.float32)
+    data[1, 2:4] = [3.0, 4.0]
+    sparse = SparseL2B.from_dense(data, nodata=None)
+    sparse.save(tmp_path / "1.npz")
+    loaded = SparseL2B.load(tmp_path / "1.npz")
+    assert loaded.nodata is None
+    np.testing.assert_array_equal(loaded.dense(), data)
+    assert loaded.bbox == (1, 2, 2, 4)
+
+
+@pytest.mark.parametrize(
+    "key",
+    [
+        (slice(2, 9), slice(3, 20)),
+        slice(1, 5),
+        (slice(-5, None), slice(-10, -2)),
+        (slice(None, None, 2), slice(1, 9)),
+        (slice(None), slice(None, None, -3)),
+        (slice(15, 40), slice(25, 40)),
+        (slice(5, 2), slice(None)),
+        3,
+        -1,
+        (3, 4),
+        (slice(None), 2),
+        (Ellipsis, slice(2, 5)),
+        Ellipsis,
+        np.array([1, 4]),
+    ],
+)
+def test_getitem_matches_dense(l2b, key):
+    sparse = SparseL2B.from_dense(l2b)
+    np.testing.assert_array_equal(sparse[key], l2b[key])
+
+
+def test_find_l2b_files_skips_labels(l2b, tmp_path):
+    np.save(tmp_path / "1.npy", l2b)
+    SparseL2B.from_dense(l2b).save(tmp_path / "2.npz")
+    save_packed_mask(tmp_path / "3.npz", binarize(l2b))
+    assert [path.name for path in find_l2b_files(tmp_path)] == ["1.npy", "2.npz"]
+    assert isinstance(open_l2b(tmp_path / "2.npz"), SparseL2B)
+    np.testing.assert_array_equal(load_packed_mask(tmp_path / "3.npz"), binarize(l2b))
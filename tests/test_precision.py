@@ -0,0 +1,38 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from band_stats import BandStats
+from manifest import sample_record
+from precision import EMIT_FILL_VALUE, decode, encoder, precision_spec
+
+VALUES = np.array([[0.1, np.nan, EMIT_FILL_VALUE, 0.0]], dtype=np.float32)
+
+
+@pytest.mark.parametrize("name", ["float32", "float16", "int16"])
+def test_encoder_treats_nan_as_missing(name):
+    spec = precision_spec(name)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        encoded = encoder(spec)(VALUES)
+    assert encoded.dtype == np.dtype(spec["dtype"])
+    assert (encoded[0, 1:3] == spec["nodata"]).all()
+    # int16 では 0 は有効な反射率として残る
+    if name == "int16":
+        assert encoded[0, 3] == 0
+        assert np.isnan(decode(encoded, spec)[0, 1:3]).all()
+
+
+def test_band_stats_and_sample_record_ignore_nan(tmp_path):
+    cube = np.array([[[0.2, 0.4], [np.nan, np.nan]]], dtype=np.float32)
+    stats = BandStats(2).update(cube, precision_spec("float32"))
+    assert stats.count.tolist() == [1, 1]
+    np.testing.assert_allclose(stats.mean, [0.2, 0.4], rtol=1e-6)
+
+    l2a_path, l2b_path = tmp_path / "a.npy", tmp_path / "b.npy"
+    l2b = np.zeros(cube.shape[:2], dtype=np.float32)
+    np.save(l2a_path, cube)
+    np.save(l2b_path, l2b)
+    record = sample_record(l2a_path, cube, l2b_path, l2b, nodata=0)
+    assert record["valid_fraction"] == 0.5
@@ -0,0 +1,57 @@
+import pytest
+
+from transport import get_transport, to_s3_url
+
+pytest.importorskip("s3fs")
+moto_server = pytest.importorskip("moto.server")
+
+BUCKET = "lp-prod-protected"
+KEY = "EMITL2ARFL.001/EMIT_L2A_RFL_001_20241020T170504_2429411_003.nc"
+DATA = bytes(range(256)) * 64
+
+
+@pytest.fixture(scope="module")
+def endpoint_url():
+    # LP DAAC の代わりにローカルの S3 互換サーバー (moto) を使う
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    yield f"http://{host}:{port}"
+    server.stop()
+
+
+@pytest.fixture
+def transport(endpoint_url, monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    transport = get_transport(
+        "auto", endpoint_url=endpoint_url, block_size=1024, max_connections=4
+    )
+    if not transport.fs.exists(BUCKET):
+        transport.fs.mkdir(BUCKET)
+    transport.fs.pipe(f"{BUCKET}/{KEY}", DATA)
+    return transport
+
+
+def test_https_url_is_read_from_s3(transport):
+    url = f"https://data.lpdaac.earthdatacloud.nasa.gov/{BUCKET}/{KEY}"
+    assert transport.mode == "s3"
+    assert to_s3_url(url) == f"s3://{BUCKET}/{KEY}"
+    assert transport.size(url) == len(DATA)
+    with transport.open(url) as f:
+        f.seek(5000)
+        assert f.read(3000) == DATA[5000:8000]
+
+
+def test_fetch_ranges(transport):
+    url = f"s3://{BUCKET}/{KEY}"
+    ranges = [(0, 10), (4000, 4100), (len(DATA) - 5, len(DATA))]
+    chunks = transport.fetch_ranges(url, ranges)
+    assert chunks == [DATA[start:end] for start, end in ranges]
+    assert transport.fetch_ranges(url, []) == []
+
+
+def test_fetch_ranges_raises_on_missing_object(transport):
+    with pytest.raises(FileNotFoundError):
+        transport.fetch_ranges(f"s3://{BUCKET}/missing.nc", [(0, 10)])